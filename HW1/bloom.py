@@ -0,0 +1,437 @@
+import hashlib, math, os, struct
+
+from heapfile import HeapFile
+
+# Returns the pair of 32-bit hashes from which a key's filter positions are
+# derived. Hashes are stable across processes, so filters can be stored.
+def keyHashes(key):
+  if isinstance(key, int):
+    data = key.to_bytes(8, 'little', signed=True)
+  elif isinstance(key, float):
+    data = struct.pack("<d", key)
+  elif isinstance(key, str):
+    data = key.encode()
+  else:
+    data = bytes(key)
+  h = int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+  return (h & 0xFFFFFFFF, (h >> 32) | 1)
+
+class BloomFilter:
+  """
+  A Bloom filter over hashed keys.
+
+  A key is added by setting 'numHashes' bits of the filter, at positions
+  derived from two hashes of the key. A key whose bits are not all set was
+  never added, while a key whose bits are all set was added, unless it is a
+  false positive. Keys cannot be removed.
+
+  >>> bf = BloomFilter.forCapacity(100, bitsPerKey=10)
+  >>> (bf.numBits, bf.numHashes)
+  (1000, 7)
+  >>> for key in range(100): bf.add(key)
+  >>> all(bf.mayContain(key) for key in range(100))
+  True
+  >>> sum(bf.mayContain(key) for key in range(100, 10100)) < 200
+  True
+  >>> bf.estimatedFpr() < 0.02
+  True
+  >>> BloomFilter.unpack(bf.pack())[0].bits == bf.bits
+  True
+  """
+
+  # Binary representation of a filter's header: the number of bits and hash
+  # functions, and the number of keys added. The filter's bits follow.
+  binrepr = struct.Struct("<III")
+
+  def __init__(self, numBits, numHashes, count=0, bits=None):
+    self.numBits   = max(8, numBits)
+    self.numHashes = max(1, numHashes)
+    self.count     = count
+    self.bits      = bits if bits is not None else bytearray((self.numBits + 7) // 8)
+
+  # Returns a filter with 'bitsPerKey' bits per key for 'capacity' keys, and
+  # the number of hash functions minimizing its false-positive rate.
+  @classmethod
+  def forCapacity(cls, capacity, bitsPerKey=10):
+    return cls(max(1, capacity) * bitsPerKey, round(bitsPerKey * math.log(2)))
+
+  def positions(self, hashes):
+    (h1, h2) = hashes
+    m = self.numBits
+    return [(h1 + i * h2) % m for i in range(self.numHashes)]
+
+  def addHashes(self, hashes):
+    bits = self.bits
+    for p in self.positions(hashes):
+      bits[p >> 3] |= 1 << (p & 7)
+    self.count += 1
+
+  def mayContainHashes(self, hashes):
+    bits = self.bits
+    for p in self.positions(hashes):
+      if not bits[p >> 3] & (1 << (p & 7)):
+        return False
+    return True
+
+  def add(self, key):
+    self.addHashes(keyHashes(key))
+
+  def mayContain(self, key):
+    return self.mayContainHashes(keyHashes(key))
+
+  # Returns the false-positive rate implied by the fraction of bits set.
+  def estimatedFpr(self):
+    setBits = bin(int.from_bytes(self.bits, 'little')).count('1')
+    return (setBits / self.numBits) ** self.numHashes
+
+  def pack(self):
+    return self.binrepr.pack(self.numBits, self.numHashes, self.count) + bytes(self.bits)
+
+  # Constructs a filter from the front of a binary representation.
+  # Returns the filter and the number of bytes it used.
+  @classmethod
+  def unpack(cls, buffer, offset=0):
+    (numBits, numHashes, count) = cls.binrepr.unpack_from(buffer, offset)
+    start = offset + cls.binrepr.size
+    end   = start + (numBits + 7) // 8
+    if numBits < 8 or end > len(buffer):
+      raise ValueError("Truncated Bloom filter")
+    return (cls(numBits, numHashes, count, bytearray(buffer[start: end])), end - offset)
+
+
+class KeyFilters:
+  """
+  Bloom filters over a key column of a heap file: one per page, and one for
+  the whole file.
+
+  Page filters are sized for a full page of tuples. The file filter grows
+  with the file: once it holds its capacity of keys, further keys go to a
+  new stage twice as large, with one more bit per key, so the combined
+  false-positive rate stays bounded however many keys are added.
+
+  Filters are stored in a side file next to the heap file, as a header naming
+  the key column and holding the heap file's write epoch, followed by the file filter's stages and the page filters.
+
+  >>> from Catalog.Schema import DBSchema
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> kf     = KeyFilters(schema, 'id', tuplesPerPage=10, initialCapacity=16)
+  >>> for i in range(40): kf.add(i // 10, schema.pack(schema.instantiate(i, 0)))
+  >>> kf.mayContain(15), kf.candidatePages(15)
+  (True, [1])
+  >>> len(kf.fileStages), [s.count for s in kf.fileStages]
+  (2, [16, 24])
+  >>> kf.epoch = 3
+  >>> kf2 = KeyFilters.unpack(schema, kf.pack())
+  >>> kf2.candidatePages(15), len(kf2.pageFilters), len(kf2.fileStages), kf2.epoch
+  ([1], 4, 2, 3)
+  """
+
+  # Binary representation of the side file header: a magic string, the heap
+  # file's write epoch, the number of file filter stages and page filters,
+  # and the length of the key column name that follows.
+  binrepr = struct.Struct("<4sQIII")
+  magic   = b'BLMF'
+
+  # Filters constructor.
+  #
+  # column          : the name of the key column
+  # tuplesPerPage   : the number of tuples held by a full page
+  # bitsPerKey      : the number of filter bits per key
+  # initialCapacity : the number of keys held by the file filter's first stage
+  def __init__(self, schema, column, **kwargs):
+    self.column          = column
+    self.index           = list(schema.fields).index(column)
+    self.unpackTuple     = schema.binrepr.unpack
+    self.tuplesPerPage   = kwargs.get("tuplesPerPage", 64)
+    self.bitsPerKey      = kwargs.get("bitsPerKey", 10)
+    self.initialCapacity = kwargs.get("initialCapacity", 4096)
+    self.pageFilters     = []
+    self.fileStages      = []
+    self.epoch           = 0
+
+  # Returns the key of a packed tuple.
+  def key(self, tupleData):
+    return self.unpackTuple(tupleData)[self.index]
+
+  def newPageFilter(self):
+    return BloomFilter.forCapacity(self.tuplesPerPage, self.bitsPerKey)
+
+  def ensure(self, numPages):
+    while len(self.pageFilters) < numPages:
+      self.pageFilters.append(self.newPageFilter())
+
+  # Adds a key to the file filter, starting a new stage if the last is full.
+  def addToFile(self, hashes):
+    stages = self.fileStages
+    if not stages or stages[-1].count >= self.stageCapacity(len(stages) - 1):
+      stages.append(BloomFilter.forCapacity(self.stageCapacity(len(stages)),
+                                            self.bitsPerKey + len(stages)))
+    stages[-1].addHashes(hashes)
+
+  def stageCapacity(self, stage):
+    return self.initialCapacity << stage
+
+  # Adds the key of a packed tuple held by the given page.
+  def add(self, pageIndex, tupleData):
+    self.ensure(pageIndex + 1)
+    hashes = keyHashes(self.key(tupleData))
+    self.pageFilters[pageIndex].addHashes(hashes)
+    self.addToFile(hashes)
+
+  # Rebuilds the filter of a page from all of its packed tuples. Keys are
+  # also added to the file filter, which cannot drop removed keys.
+  def summarize(self, pageIndex, tuples, addToFile=True):
+    self.ensure(pageIndex + 1)
+    self.pageFilters[pageIndex] = pageFilter = self.newPageFilter()
+    for tupleData in tuples:
+      hashes = keyHashes(self.key(tupleData))
+      pageFilter.addHashes(hashes)
+      if addToFile:
+        self.addToFile(hashes)
+
+  # Returns whether the file may hold a key.
+  def mayContain(self, key, hashes=None):
+    hashes = hashes or keyHashes(key)
+    return any(stage.mayContainHashes(hashes) for stage in self.fileStages)
+
+  # Returns the indexes of the pages that may hold a key.
+  def candidatePages(self, key):
+    hashes = keyHashes(key)
+    if not self.mayContain(key, hashes):
+      return []
+    return [i for (i, f) in enumerate(self.pageFilters) if f.mayContainHashes(hashes)]
+
+  # Returns the estimated false-positive rates of the page and file filters.
+  def estimatedFprs(self):
+    pages = [f.estimatedFpr() for f in self.pageFilters]
+    return { 'pageFpr' : sum(pages) / len(pages) if pages else 0.0,
+             'fileFpr' : 1 - math.prod(1 - s.estimatedFpr() for s in self.fileStages) }
+
+  def pack(self):
+    name  = self.column.encode()
+    parts = [self.binrepr.pack(self.magic, self.epoch, len(self.fileStages), len(self.pageFilters), len(name)),
+             name]
+    parts.extend(f.pack() for f in self.fileStages)
+    parts.extend(f.pack() for f in self.pageFilters)
+    return b''.join(parts)
+
+  # Constructs filters from their binary representation. Returns None if the
+  # representation does not hold filters over a column of the schema.
+  @classmethod
+  def unpack(cls, schema, buffer, **kwargs):
+    if len(buffer) < cls.binrepr.size:
+      return None
+    (magic, epoch, numStages, numPages, length) = cls.binrepr.unpack_from(buffer)
+    if magic != cls.magic:
+      return None
+    offset = cls.binrepr.size
+    column = bytes(buffer[offset: offset + length]).decode()
+    if column not in schema.fields:
+      return None
+    kf       = cls(schema, column, **kwargs)
+    kf.epoch = epoch
+    offset  += length
+    try:
+      for i in range(numStages + numPages):
+        (f, size) = BloomFilter.unpack(buffer, offset)
+        (kf.fileStages if i < numStages else kf.pageFilters).append(f)
+        offset += size
+    except (ValueError, struct.error):
+      return None
+    if offset != len(buffer):
+      return None
+    if kf.pageFilters:
+      kf.tuplesPerPage = kf.pageFilters[0].numBits // kf.bitsPerKey
+    return kf
+
+
+class BloomHeapFile(HeapFile):
+  """
+  A heap file maintaining Bloom filters over a key column, for point lookups.
+
+  Filters are built during bulk loads, and kept up to date by inserts,
+  updates and deletes. A lookup first checks the file filter, and then reads
+  only the pages whose filters may hold the key, so lookups of absent keys
+  read almost no pages, even on a cold file. Filters are saved alongside the
+  free-space map, and rebuilt from the pages if their side file is missing,
+  stale, or filters another column.
+
+  'lookupStats' counts, for the last lookup, the pages read and skipped, and
+  the false positives: pages read that did not hold the key. 'filterStats'
+  accumulates these over all lookups, along with the lookups rejected by the
+  file filter, and reports the observed and estimated false-positive rates.
+
+  >>> import tempfile, os
+  >>> from Catalog.Identifiers import FileId
+  >>> from Catalog.Schema      import DBSchema
+
+  # Test harness setup.
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> path   = os.path.join(tempfile.mkdtemp(), 'employee.heap')
+  >>> hf     = BloomHeapFile(path, FileId(1), schema=schema, pageSize=256, bloomColumn='id')
+  >>> hf.bulkLoad([b''.join(schema.pack(schema.instantiate(2 * i, i % 50)) for i in range(1000))])
+  1000
+
+  # Lookups read only the pages whose filters hold the key.
+  >>> [schema.unpack(t) for (_, t) in hf.lookup(500)]
+  [employee(id=500, age=0)]
+  >>> hf.lookupStats
+  {'pagesRead': 1, 'pagesSkipped': 32, 'falsePositives': 0}
+
+  # Filters follow inserts and updates.
+  >>> tId = hf.insertTuple(schema.pack(schema.instantiate(5001, 1)))
+  >>> len(list(hf.lookup(5001)))
+  1
+  >>> hf.putTuple(tId, schema.pack(schema.instantiate(5003, 1)))
+  >>> len(list(hf.lookup(5003))), len(list(hf.lookup(5001))), hf.lookupStats['pagesRead']
+  (1, 0, 0)
+
+  # Lookups of absent keys on a cold file touch almost no pages.
+  >>> hf.close()
+  >>> hf = BloomHeapFile(path, FileId(1), schema=schema, bloomColumn='id')
+  >>> sum(len(list(hf.lookup(2 * i + 1))) for i in range(1000))
+  0
+  >>> stats = hf.filterStats()
+  >>> stats['lookups'], stats['fileRejects'] > 950, stats['pagesRead'] < 60
+  (1000, True, True)
+  >>> stats['observedPageFpr'] < 0.02, stats['estimatedFileFpr'] < 0.02
+  (True, True)
+
+  # Filters saved before later page writes are rebuilt, e.g., after a crash
+  # following the eviction of a dirty page.
+  >>> hf.putTuple(tId, schema.pack(schema.instantiate(7001, 1)))
+  >>> hf.bufferPool.flushPages()
+  >>> hf.file.close()
+  >>> hf = BloomHeapFile(path, FileId(1), schema=schema, bloomColumn='id')
+  >>> [schema.unpack(t).id for (_, t) in hf.lookup(7001)]
+  [7001]
+  >>> hf.close()
+
+  # The key column must be given.
+  >>> BloomHeapFile(path, FileId(1), schema=schema)
+  Traceback (most recent call last):
+  ...
+  ValueError: Bloom heap files require a 'bloomColumn' argument
+  """
+
+  # Bloom heap file constructor. In addition to the heap file arguments:
+  #
+  # bloomColumn  : the name of the key column, which is required
+  # bitsPerKey   : the number of filter bits per key, 10 giving about 1%
+  #                false positives
+  def __init__(self, filePath, fileId, **kwargs):
+    if kwargs.get("bloomColumn", None) is None:
+      raise ValueError("Bloom heap files require a 'bloomColumn' argument")
+    super().__init__(filePath, fileId, **kwargs)
+    self.bitsPerKey  = kwargs.get("bitsPerKey", 10)
+    self.lookupStats = { 'pagesRead': 0, 'pagesSkipped': 0, 'falsePositives': 0 }
+    self.totals      = { 'lookups': 0, 'fileRejects': 0, 'pagesRead': 0, 'pagesSkipped': 0,
+                         'falsePositives': 0 }
+    self.loadFilters(kwargs["bloomColumn"])
+
+  def filtersPath(self):
+    return self.filePath + '.bloom'
+
+  # Returns the number of tuples held by a full page.
+  def tuplesPerPage(self):
+    page = self.pageClass(pageId=self.pageId(0), buffer=bytes(self.pageSize), schema=self.schema)
+    return page.tupleCapacity()
+
+  def newFilters(self, column):
+    return KeyFilters(self.schema, column, tuplesPerPage=self.tuplesPerPage(),
+                      bitsPerKey=self.bitsPerKey)
+
+  # Loads the filters, rebuilding them from the pages if their side file is
+  # missing, filters a different column, or was saved before the last writes
+  # to the heap file, i.e., at another write epoch.
+  def loadFilters(self, column):
+    kf = None
+    if os.path.exists(self.filtersPath()):
+      with open(self.filtersPath(), 'rb') as f:
+        kf = KeyFilters.unpack(self.schema, f.read(), bitsPerKey=self.bitsPerKey)
+    if kf is None or kf.column != column or kf.epoch != self.epoch \
+       or len(kf.pageFilters) != self.pageCount:
+      kf = self.newFilters(column)
+      for pageIndex in range(self.pageCount):
+        self.summarizePage(pageIndex, kf)
+    self.filters = kf
+
+  def saveFilters(self):
+    self.filters.epoch = self.epoch
+    with open(self.filtersPath(), 'wb') as f:
+      f.write(self.filters.pack())
+
+  # Rebuilds the filter of a page from the tuples held in the buffer pool.
+  def summarizePage(self, pageIndex, filters=None, addToFile=True):
+    (filters or self.filters).summarize(pageIndex,
+      [t for (_, t) in self.pageTuples(pageIndex)], addToFile)
+
+  # Heap file overrides maintaining the filters.
+
+  def allocatePage(self):
+    pageIndex = super().allocatePage()
+    self.filters.ensure(pageIndex + 1)
+    return pageIndex
+
+  def insertIntoPage(self, pageIndex, tupleData):
+    tupleId = super().insertIntoPage(pageIndex, tupleData)
+    if tupleId is not None:
+      self.filters.add(pageIndex, tupleData)
+    return tupleId
+
+  def appendedPage(self, page, tuples):
+    self.filters.summarize(page.pageId.pageIndex, tuples)
+
+  def putTuple(self, tupleId, tupleData):
+    super().putTuple(tupleId, tupleData)
+    self.summarizePage(tupleId.pageId.pageIndex, addToFile=False)
+    self.filters.addToFile(keyHashes(self.filters.key(tupleData)))
+
+  def deleteTuple(self, tupleId):
+    super().deleteTuple(tupleId)
+    self.summarizePage(tupleId.pageId.pageIndex, addToFile=False)
+
+  # Yields the (TupleId, bytes) pairs of the tuples whose key column equals
+  # 'key', reading only the pages whose filters may hold it.
+  def lookup(self, key):
+    candidates = self.filters.candidatePages(key)
+    index      = self.filters.index
+    unpack     = self.schema.binrepr.unpack
+    stats      = { 'pagesRead': len(candidates), 'pagesSkipped': self.pageCount - len(candidates),
+                   'falsePositives': 0 }
+    self.lookupStats = stats
+    self.totals['lookups'] += 1
+    if not candidates and self.pageCount:
+      self.totals['fileRejects'] += 1
+    for name in ('pagesRead', 'pagesSkipped'):
+      self.totals[name] += stats[name]
+
+    for pageIndex in candidates:
+      matches = [(tupleId, t) for (tupleId, t) in self.pageTuples(pageIndex)
+                   if unpack(t)[index] == key]
+      if not matches:
+        stats['falsePositives']        += 1
+        self.totals['falsePositives'] += 1
+      yield from matches
+
+  # Returns the lookup statistics accumulated since the file was opened,
+  # with the observed false-positive rate of page filters, i.e., the fraction
+  # of pages without the key that were read, and the estimated rates of the
+  # page and file filters.
+  def filterStats(self):
+    stats    = dict(self.totals)
+    negative = stats['falsePositives'] + stats['pagesSkipped']
+    stats['observedPageFpr'] = stats['falsePositives'] / negative if negative else 0.0
+    fprs     = self.filters.estimatedFprs()
+    stats['estimatedPageFpr'] = fprs['pageFpr']
+    stats['estimatedFileFpr'] = fprs['fileFpr']
+    return stats
+
+  def flush(self):
+    super().flush()
+    self.saveFilters()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
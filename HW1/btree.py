@@ -0,0 +1,299 @@
+import bisect, struct
+
+from Catalog.Identifiers import FileId, PageId, TupleId
+from page import PageHeader
+from heapfile import HeapFile
+
+class BTreeEntrySchema:
+  """
+  The schema of B+ tree node entries, stored as fixed-size page tuples.
+
+  Leaf entries map a key to a TupleId, as (key, pageIndex, tupleIndex).
+  Internal entries map a separator key to a child page, as (key, child, 0).
+  Node and tree metadata are stored as entries too, so every field is wide
+  enough for a page index or a FileId.
+  """
+  binrepr = struct.Struct("<QII")
+  size    = binrepr.size
+
+
+class BTree:
+  """
+  A disk-resident B+ tree index, mapping integer keys to TupleIds.
+
+  Tree nodes are ordinary pages of a heap file, accessed through its buffer
+  pool. The first tuple of each node page holds node metadata, and the
+  remaining tuples hold the node's sorted entries. Page 0 of the file is a
+  meta page recording the root page and the indexed file's FileId.
+
+  Leaves are chained in key order, so range scans walk the leaf level after
+  a single descent. Duplicate keys are supported, as needed for indexing
+  l_orderkey. Trees can be bulk-loaded bottom-up from sorted input, and
+  grown with incremental inserts.
+
+  >>> import tempfile, os
+
+  >>> d   = tempfile.mkdtemp()
+  >>> fId = FileId(7)
+  >>> tid = lambda i: TupleId(PageId(fId, i // 10), i % 10)
+
+  # Bulk load from sorted input, with two entries per key.
+  >>> bt = BTree(os.path.join(d, 'orders.idx'), FileId(2), dataFileId=fId, pageSize=256)
+  >>> bt.bulkLoad((k // 2, tid(k)) for k in range(0, 2000))
+  2000
+  >>> bt.height > 1
+  True
+  >>> bt.lookup(500) == [tid(1000), tid(1001)]
+  True
+  >>> bt.lookup(5000)
+  []
+  >>> [k for (k, _) in bt.range(10, 12)]
+  [10, 10, 11, 11, 12, 12]
+
+  # Incremental inserts split nodes as needed.
+  >>> for k in range(5000, 3000, -1):
+  ...   bt.insert(k, tid(k))
+  >>> len(list(bt.range(3000, None)))
+  2000
+  >>> bt.lookup(4321) == [tid(4321)]
+  True
+
+  # Range scans read each node on the way once.
+  >>> reads = lambda: bt.pool.hits + bt.pool.misses
+  >>> before = reads()
+  >>> [k for (k, _) in bt.range(500, 500)], reads() - before == bt.height
+  ([500, 500], True)
+
+  # The tree persists across reopening.
+  >>> bt.close()
+  >>> bt = BTree(os.path.join(d, 'orders.idx'), FileId(2))
+  >>> bt.lookup(999) == [tid(1998), tid(1999)], bt.dataFileId == fId
+  (True, True)
+  >>> keys = [k for (k, _) in bt.range(None, None)]
+  >>> keys == sorted(keys) and len(keys) == 4000
+  True
+  >>> bt.close()
+
+  # FileIds of indexed files are stored in full.
+  >>> with BTree(os.path.join(d, 'big.idx'), FileId(3), dataFileId=FileId(70000)) as bt:
+  ...   bt.bulkLoad([(1, TupleId(PageId(FileId(70000), 5), 2))])
+  1
+  >>> with BTree(os.path.join(d, 'big.idx'), FileId(3)) as bt:
+  ...   bt.dataFileId.index, bt.lookup(1)[0].pageId.pageIndex
+  (70000, 5)
+  """
+
+  # Node metadata is stored in the first tuple of a node page as
+  # (isLeaf, nextLeaf, 0). Tree metadata is stored in page 0 as
+  # (height, root, dataFileId).
+  noPage = 0xFFFFFFFF
+
+  def __init__(self, filePath, fileId, **kwargs):
+    self.file       = HeapFile(filePath, fileId, schema=BTreeEntrySchema,
+                               pageSize=kwargs.get("pageSize", HeapFile.defaultPageSize),
+                               poolPages=kwargs.get("poolPages", HeapFile.defaultPoolPages))
+    self.pool       = self.file.bufferPool
+    self.fanout     = (self.file.pageSize - PageHeader.forPageSize(self.file.pageSize).size) \
+                        // BTreeEntrySchema.size - 1
+    self.fillFactor = kwargs.get("fillFactor", 1.0)
+    if self.fanout < 3:
+      raise ValueError("Page size too small for a B+ tree node")
+
+    if self.file.numPages() == 0:
+      self.file.allocatePage()
+      root = self.file.allocatePage()
+      self.writeNode(root, True, [], self.noPage)
+      self.setMeta(1, root, kwargs.get("dataFileId", FileId(0)))
+    else:
+      (self.height, self.root, dataFile) = self.readEntries(0)[0]
+      self.dataFileId = FileId(dataFile)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self):
+    self.file.close()
+
+  def flush(self):
+    self.file.flush()
+
+  # Node page access.
+
+  def readEntries(self, pageIndex):
+    pageId = self.file.pageId(pageIndex)
+    page   = self.pool.getPage(pageId)
+    try:
+      start = page.header.headerSize()
+      end   = page.header.freeSpaceOffset
+      return list(BTreeEntrySchema.binrepr.iter_unpack(page.getbuffer()[start: end]))
+    finally:
+      self.pool.unpinPage(pageId)
+
+  def writeEntries(self, pageIndex, entries):
+    pageId = self.file.pageId(pageIndex)
+    page   = self.pool.getPage(pageId)
+    page.header.freeSpaceOffset = page.header.headerSize()
+    page.insertPackedTuples(b''.join(BTreeEntrySchema.binrepr.pack(*e) for e in entries))
+    self.pool.unpinPage(pageId, dirty=True)
+
+  # Returns a triple of (isLeaf, entries, nextLeaf) for a node.
+  def readNode(self, pageIndex):
+    entries = self.readEntries(pageIndex)
+    (isLeaf, nextLeaf, _) = entries[0]
+    return (isLeaf == 1, entries[1:], nextLeaf)
+
+  def writeNode(self, pageIndex, isLeaf, entries, nextLeaf):
+    self.writeEntries(pageIndex, [(int(isLeaf), nextLeaf, 0)] + entries)
+
+  def setMeta(self, height, root, dataFileId):
+    self.height     = height
+    self.root       = root
+    self.dataFileId = dataFileId
+    self.writeEntries(0, [(height, root, dataFileId.index)])
+
+  def tupleId(self, entry):
+    return TupleId(PageId(self.dataFileId, entry[1]), entry[2])
+
+  # Returns the leftmost leaf that may hold 'key', as its page index, entries
+  # and next leaf, along with the path of (pageIndex, entries, child position)
+  # internal nodes leading to it. With 'rightmost' set, descends to the
+  # rightmost such leaf. A key of None descends to the leftmost leaf.
+  def descend(self, key, rightmost=False):
+    path      = []
+    pageIndex = self.root
+    while True:
+      (isLeaf, entries, nextLeaf) = self.readNode(pageIndex)
+      if isLeaf:
+        return (pageIndex, entries, nextLeaf, path)
+      if key is None:
+        child = 0
+      else:
+        keys  = [e[0] for e in entries[1:]]
+        child = (bisect.bisect_right if rightmost else bisect.bisect_left)(keys, key)
+      path.append((pageIndex, entries, child))
+      pageIndex = entries[child][1]
+
+  # Lookups.
+
+  # Returns the TupleIds of all entries with the given key.
+  def lookup(self, key):
+    return [tupleId for (_, tupleId) in self.range(key, key)]
+
+  # Yields (key, TupleId) pairs with lo <= key <= hi, in key order.
+  # A bound of None leaves that side of the range open. Each node on the
+  # way is read once.
+  def range(self, lo, hi):
+    (_, entries, nextLeaf, _) = self.descend(lo)
+    position = 0 if lo is None else bisect.bisect_left([e[0] for e in entries], lo)
+    while True:
+      for entry in entries[position:]:
+        if hi is not None and entry[0] > hi:
+          return
+        yield (entry[0], self.tupleId(entry))
+      if nextLeaf == self.noPage:
+        return
+      (_, entries, nextLeaf) = self.readNode(nextLeaf)
+      position = 0
+
+  # Modifications.
+
+  # Adds an entry mapping 'key' to 'tupleId', splitting nodes on overflow.
+  def insert(self, key, tupleId):
+    (pageIndex, entries, nextLeaf, path) = self.descend(key, rightmost=True)
+    entry = (key, tupleId.pageId.pageIndex, tupleId.tupleIndex)
+    entries.insert(bisect.bisect_right([e[0] for e in entries], key), entry)
+
+    if len(entries) <= self.fanout:
+      self.writeNode(pageIndex, True, entries, nextLeaf)
+      return
+
+    # Split the leaf, linking the new right sibling into the leaf chain.
+    middle = len(entries) // 2
+    right  = self.file.allocatePage()
+    self.writeNode(right, True, entries[middle:], nextLeaf)
+    self.writeNode(pageIndex, True, entries[:middle], right)
+    separator = (entries[middle][0], right, 0)
+
+    # Propagate separators up the path, splitting internal nodes as needed.
+    # A separator is placed right after the child that was split, which keeps
+    # children in order even when duplicate keys repeat a separator.
+    while path:
+      (pageIndex, entries, child) = path.pop()
+      entries.insert(child + 1, separator)
+      if len(entries) <= self.fanout:
+        self.writeNode(pageIndex, False, entries, self.noPage)
+        return
+      middle = len(entries) // 2
+      right  = self.file.allocatePage()
+      # The middle separator moves up, and its child becomes the leftmost
+      # child of the new right node.
+      self.writeNode(right, False, [(0, entries[middle][1], 0)] + entries[middle + 1:], self.noPage)
+      self.writeNode(pageIndex, False, entries[:middle], self.noPage)
+      separator = (entries[middle][0], right, 0)
+
+    # The root was split, so grow the tree by one level.
+    root = self.file.allocatePage()
+    self.writeNode(root, False, [(0, self.root, 0), separator], self.noPage)
+    self.setMeta(self.height + 1, root, self.dataFileId)
+
+  # Bulk loads an empty tree from (key, TupleId) pairs sorted by key.
+  # Nodes are filled to the tree's fill factor and built bottom-up.
+  # Returns the number of entries loaded.
+  def bulkLoad(self, pairs):
+    (isLeaf, entries, _) = self.readNode(self.root)
+    if not isLeaf or entries:
+      raise ValueError("Bulk loading requires an empty tree")
+
+    perNode = max(2, int(self.fanout * self.fillFactor))
+    level   = []   # (first key, page index) of each node in the level
+    pending = []
+    count   = 0
+    last    = None
+
+    # Each leaf is written once, when the page of the next leaf is known, so
+    # that it is written with its link to the next leaf. Until then, the
+    # level only records its page and entries.
+    def emitLeaf():
+      pageIndex = self.root if not level else self.file.allocatePage()
+      if level:
+        self.writeNode(level[-1][1], True, previous, pageIndex)
+      level.append((pending[0][0], pageIndex))
+
+    for (key, tupleId) in pairs:
+      if last is not None and key < last:
+        raise ValueError("Bulk loading requires keys in sorted order")
+      last = key
+      pending.append((key, tupleId.pageId.pageIndex, tupleId.tupleIndex))
+      count += 1
+      if len(pending) == perNode:
+        emitLeaf()
+        (previous, pending) = (pending, [])
+    if pending:
+      emitLeaf()
+      previous = pending
+    if not level:
+      return 0
+    self.writeNode(level[-1][1], True, previous, self.noPage)
+
+    # Build internal levels until a single root remains.
+    height = 1
+    while len(level) > 1:
+      parents = []
+      for i in range(0, len(level), perNode):
+        group     = level[i: i + perNode]
+        pageIndex = self.file.allocatePage()
+        entries   = [(0, group[0][1], 0)] + [(k, p, 0) for (k, p) in group[1:]]
+        self.writeNode(pageIndex, False, entries, self.noPage)
+        parents.append((group[0][0], pageIndex))
+      level   = parents
+      height += 1
+    self.setMeta(height, level[0][1], self.dataFileId)
+    return count
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
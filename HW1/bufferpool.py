@@ -0,0 +1,366 @@
+import mmap
+from collections import OrderedDict
+
+class LRUPolicy:
+  """
+  A least-recently-used eviction policy.
+
+  Policies track the page ids resident in a buffer pool, and choose a victim
+  among the unpinned pages when the pool needs a free frame.
+  """
+
+  def __init__(self):
+    self.order = OrderedDict()
+
+  def insert(self, pageId):
+    self.order[pageId] = None
+
+  def access(self, pageId):
+    self.order.move_to_end(pageId)
+
+  def remove(self, pageId):
+    del self.order[pageId]
+
+  # Returns the least recently used page id for which 'evictable' holds.
+  def victim(self, evictable):
+    for pageId in self.order:
+      if evictable(pageId):
+        return pageId
+    return None
+
+
+class ClockPolicy:
+  """
+  A CLOCK (second-chance) eviction policy.
+
+  Resident pages are kept in a ring with a reference bit per page, which is
+  set when a resident page is accessed again. The clock hand clears reference
+  bits as it sweeps, and evicts the first evictable page whose bit is already
+  clear. Pages touched only once, as in a sequential scan, are thus evicted
+  before re-referenced pages. Unlike LRU, accesses do not reorder pages, but
+  removals do, as the last page in the ring takes the removed page's place.
+  """
+
+  def __init__(self):
+    self.ring       = []
+    self.positions  = {}
+    self.referenced = {}
+    self.hand       = 0
+
+  def insert(self, pageId):
+    self.positions[pageId]  = len(self.ring)
+    self.referenced[pageId] = False
+    self.ring.append(pageId)
+
+  def access(self, pageId):
+    self.referenced[pageId] = True
+
+  # Removes a page in constant time by moving the last ring entry into its
+  # position. This reorders the sweep: the moved page is next visited from
+  # its new position, so it may be examined earlier, or skipped for the rest
+  # of the current sweep if the hand has already passed that position.
+  def remove(self, pageId):
+    pos  = self.positions.pop(pageId)
+    last = self.ring.pop()
+    if last != pageId:
+      self.ring[pos]       = last
+      self.positions[last] = pos
+    del self.referenced[pageId]
+    if self.hand >= len(self.ring):
+      self.hand = 0
+
+  # Sweeps the clock hand at most twice around the ring.
+  def victim(self, evictable):
+    for _ in range(2 * len(self.ring)):
+      pageId = self.ring[self.hand]
+      self.hand = (self.hand + 1) % len(self.ring)
+      if not evictable(pageId):
+        continue
+      if self.referenced[pageId]:
+        self.referenced[pageId] = False
+      else:
+        return pageId
+    return None
+
+
+class FrameArena:
+  """
+  A preallocated arena of fixed-size page frames.
+
+  Frames are consecutive slices of a single anonymous memory map, so frames
+  whose size is a multiple of the OS page size are aligned to it. Frames are
+  handed out by index and returned to a free list, so pages loaded into the
+  arena reuse the same memory instead of allocating a buffer per page.
+
+  >>> arena  = FrameArena(4096, 2)
+  >>> frames = [arena.acquire(), arena.acquire()]
+  >>> arena.acquire()
+  Traceback (most recent call last):
+  ...
+  ValueError: No free frame in arena
+  >>> arena.release(frames[0])
+  >>> arena.acquire() == frames[0], arena.inUse()
+  (True, 2)
+  >>> arena.frames[frames[1]].nbytes
+  4096
+  >>> arena.close()
+  >>> arena.memory.closed
+  True
+  """
+
+  def __init__(self, frameSize, numFrames):
+    self.frameSize = frameSize
+    self.numFrames = numFrames
+    self.memory    = mmap.mmap(-1, frameSize * numFrames)
+    view           = memoryview(self.memory)
+    self.frames    = [view[i * frameSize: (i + 1) * frameSize] for i in range(numFrames)]
+    self.free      = list(reversed(range(numFrames)))
+
+  # Returns the index of a free frame.
+  def acquire(self):
+    if not self.free:
+      raise ValueError("No free frame in arena")
+    return self.free.pop()
+
+  def release(self, frameIndex):
+    self.free.append(frameIndex)
+
+  def inUse(self):
+    return self.numFrames - len(self.free)
+
+  # Unmaps the arena. No page or view over its frames may remain in use.
+  def close(self):
+    for frame in self.frames:
+      frame.release()
+    self.frames = []
+    self.free   = []
+    self.memory.close()
+
+
+class BufferPool:
+  """
+  A buffer pool holding a bounded number of pages in memory.
+
+  Pages are keyed by their PageId, and are read through a file manager on a
+  miss. A file manager provides 'readPage(pageId)' returning a Page, and
+  'writePage(page)' storing a page's packed representation. File managers
+  used with a frame arena also provide 'readPageInto(pageId, frame)', which
+  reads a page into a frame and returns a Page wrapping it.
+
+  Pages returned by 'getPage' are pinned, and must be released with
+  'unpinPage' before they can be evicted. With a frame arena, pages are read
+  in place into preallocated frames, and a frame is reused once its page is
+  evicted, so pages should not be used after they are unpinned. Dirty pages
+  are written back when they are evicted, and when the pool is flushed. The
+  pool tracks hit, miss, eviction and write-back counters.
+
+  >>> from Catalog.Identifiers import FileId, PageId
+  >>> from Catalog.Schema      import DBSchema
+  >>> from page                import Page
+
+  # Test harness setup: an in-memory file manager.
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> class MemoryFileManager:
+  ...   def __init__(self): self.pages = {}; self.writes = 0
+  ...   def readPage(self, pageId):
+  ...     if pageId in self.pages: return Page.unpack(pageId, self.pages[pageId])
+  ...     return Page(pageId=pageId, buffer=bytes(4096), schema=schema)
+  ...   def writePage(self, page):
+  ...     self.pages[page.pageId] = page.pack(); self.writes += 1
+  >>> fm   = MemoryFileManager()
+  >>> pool = BufferPool(fm, numPages=2)
+  >>> pIds = [PageId(FileId(1), i) for i in range(3)]
+
+  # Misses load pages, and hits return the resident page.
+  >>> p0 = pool.getPage(pIds[0])
+  >>> _  = p0.insertTuple(schema.pack(schema.instantiate(1, 25)))
+  >>> pool.unpinPage(pIds[0], dirty=True)
+  >>> pool.getPage(pIds[0]) is p0
+  True
+  >>> pool.unpinPage(pIds[0])
+  >>> (pool.hits, pool.misses)
+  (1, 1)
+
+  # Pinned pages are never evicted.
+  >>> p1 = pool.getPage(pIds[1])
+  >>> p2 = pool.getPage(pIds[2])
+  >>> pool.evictions, fm.writes
+  (1, 1)
+  >>> pool.getPage(pIds[0])
+  Traceback (most recent call last):
+  ...
+  ValueError: No unpinned page available for eviction
+  >>> pool.unpinPage(pIds[1]); pool.unpinPage(pIds[2])
+  >>> pool.misses
+  3
+
+  # Written-back pages are read back with their contents.
+  >>> p0 = pool.getPage(pIds[0])
+  >>> [schema.unpack(t) for t in p0]
+  [employee(id=1, age=25)]
+  >>> pool.unpinPage(pIds[0])
+
+  # Failed write-backs leave pages dirty and resident, and failed reads are
+  # not counted as misses.
+  >>> pool = BufferPool(fm, numPages=1)
+  >>> p1   = pool.getPage(pIds[1])
+  >>> _    = p1.insertTuple(schema.pack(schema.instantiate(2, 30)))
+  >>> pool.unpinPage(pIds[1], dirty=True)
+  >>> def failingWrite(page): raise OSError('disk full')
+  >>> (fm.writePage, saved) = (failingWrite, fm.writePage)
+  >>> pool.getPage(pIds[0])
+  Traceback (most recent call last):
+  ...
+  OSError: disk full
+  >>> fm.writePage = saved
+  >>> p1.isDirty(), pIds[1] in pool, pool.misses
+  (True, True, 1)
+  >>> pool.flushPages()
+  >>> p1.isDirty(), pool.writebacks
+  (False, 1)
+
+  # The CLOCK policy gives recently referenced pages a second chance.
+  >>> pool = BufferPool(MemoryFileManager(), numPages=2, policy=ClockPolicy())
+  >>> for i in [0, 1, 0, 2, 0]:
+  ...   _ = pool.getPage(pIds[i]); pool.unpinPage(pIds[i])
+  >>> sorted(p.pageIndex for p in pool.pages)
+  [0, 2]
+  >>> pool.stats()
+  {'hits': 2, 'misses': 3, 'evictions': 1, 'writebacks': 0, 'resident': 2, 'pinned': 0}
+  """
+
+  # Buffer pool constructor.
+  #
+  # fileManager  : the file manager reading and writing pages
+  # numPages     : the maximum number of resident pages
+  # policy       : an eviction policy object, defaulting to LRU
+  # arena        : a FrameArena of at least 'numPages' frames, in which pages
+  #                are read in place with the file manager's 'readPageInto'
+  def __init__(self, fileManager, numPages, policy=None, arena=None):
+    if numPages < 1:
+      raise ValueError("A buffer pool requires at least one page")
+    self.fileManager = fileManager
+    self.numPages    = numPages
+    self.policy      = policy if policy is not None else LRUPolicy()
+    self.arena       = arena
+    self.frames      = {}
+    self.pages       = {}
+    self.pinCounts   = {}
+    self.hits        = 0
+    self.misses      = 0
+    self.evictions   = 0
+    self.writebacks  = 0
+
+  def __contains__(self, pageId):
+    return pageId in self.pages
+
+  # Returns the page with the given id, pinning it in the pool.
+  def getPage(self, pageId, pin=True):
+    page = self.pages.get(pageId)
+    if page is not None:
+      self.hits += 1
+      self.policy.access(pageId)
+    else:
+      if len(self.pages) >= self.numPages:
+        self.evictPage()
+      page = self.readPage(pageId)
+      self.misses += 1
+      self.pages[pageId]     = page
+      self.pinCounts[pageId] = 0
+      self.policy.insert(pageId)
+    if pin:
+      self.pinCounts[pageId] += 1
+    return page
+
+  # Reads a page through the file manager, into a free arena frame if the pool
+  # has an arena.
+  def readPage(self, pageId):
+    if self.arena is None:
+      return self.fileManager.readPage(pageId)
+    frameIndex = self.arena.acquire()
+    page       = None
+    try:
+      page = self.fileManager.readPageInto(pageId, self.arena.frames[frameIndex])
+    finally:
+      if page is None:
+        self.arena.release(frameIndex)
+    self.frames[pageId] = frameIndex
+    return page
+
+  # Pin and unpin operations.
+  def pinPage(self, pageId):
+    return self.getPage(pageId, pin=True)
+
+  def unpinPage(self, pageId, dirty=False):
+    if self.pinCounts.get(pageId, 0) <= 0:
+      raise ValueError("Page is not pinned")
+    if dirty:
+      self.pages[pageId].setDirty(True)
+    self.pinCounts[pageId] -= 1
+
+  def isPinned(self, pageId):
+    return self.pinCounts.get(pageId, 0) > 0
+
+  # Writes a page back through the file manager if it is dirty. The page is
+  # written clean, and stays dirty if the write fails.
+  def flushPage(self, pageId):
+    page = self.pages[pageId]
+    if page.isDirty():
+      page.setDirty(False)
+      written = False
+      try:
+        self.fileManager.writePage(page)
+        written = True
+      finally:
+        if not written:
+          page.setDirty(True)
+      self.writebacks += 1
+
+  # Writes back all dirty pages.
+  def flushPages(self):
+    for pageId in list(self.pages):
+      self.flushPage(pageId)
+
+  # Evicts an unpinned page chosen by the policy, writing it back if dirty.
+  def evictPage(self):
+    pageId = self.policy.victim(lambda pId: not self.isPinned(pId))
+    if pageId is None:
+      raise ValueError("No unpinned page available for eviction")
+    self.flushPage(pageId)
+    self.discardPage(pageId)
+    self.evictions += 1
+
+  # Removes a page from the pool without writing it back. The page's arena
+  # frame is reused by later reads, so the page must not be used afterwards.
+  def discardPage(self, pageId):
+    if pageId in self.pages:
+      del self.pages[pageId]
+      del self.pinCounts[pageId]
+      self.policy.remove(pageId)
+      if pageId in self.frames:
+        self.arena.release(self.frames.pop(pageId))
+
+  # Discards all pages without writing them back, and unmaps the pool's
+  # frame arena, if any. The pool must not be used afterwards.
+  def close(self):
+    for pageId in list(self.pages):
+      self.discardPage(pageId)
+    if self.arena is not None:
+      self.arena.close()
+
+  def stats(self):
+    return { 'hits'       : self.hits,
+             'misses'     : self.misses,
+             'evictions'  : self.evictions,
+             'writebacks' : self.writebacks,
+             'resident'   : len(self.pages),
+             'pinned'     : sum(1 for n in self.pinCounts.values() if n > 0) }
+
+  def hitRate(self):
+    accesses = self.hits + self.misses
+    return self.hits / accesses if accesses else 0.0
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
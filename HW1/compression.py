@@ -0,0 +1,263 @@
+import os, shutil, struct, sys, tempfile, time
+
+from Catalog.Identifiers import FileId, PageId
+from page import Page
+from pagecodecs import codecs, getCodec
+from parallelscan import heapFileLayout
+from prefetch import PrefetchScan, dropCache
+
+class CompressedPageFile:
+  """
+  A read-only file of compressed page images.
+
+  Heap files update pages in place at fixed offsets, so compressed pages,
+  whose sizes vary, are written to a separate file, e.g., as a compressed
+  copy of a heap file that is mostly read. Page images are written back to
+  back as produced by Page.packCompressed, and followed by a directory of
+  their offsets, so pages are readable both sequentially and by index.
+
+  File layout: a header holding a magic number, the uncompressed page size
+  and the codec id, the page images, the directory as an array of unsigned
+  long longs, and a footer holding the directory offset and the number of
+  pages.
+
+  Each read counts in 'stats' the pages read and the bytes read from the file.
+
+  >>> from Catalog.Identifiers import TupleId
+  >>> from Catalog.Schema      import DBSchema
+  >>> from heapfile            import HeapFile
+
+  # Test harness setup.
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> path   = os.path.join(tempfile.mkdtemp(), 'employee.heap')
+  >>> with HeapFile(path, FileId(1), schema=schema) as hf:
+  ...   hf.bulkLoad([b''.join(schema.pack(schema.instantiate(i, i % 50)) for i in range(10000))])
+  10000
+
+  # Compressing a heap file preserves its pages.
+  >>> stats = compressHeapFile(path, path + '.z', 'zlib')
+  >>> stats['pages'], stats['bytes'] < stats['rawBytes'] // 2
+  (20, True)
+  >>> with CompressedPageFile(path + '.z', fileId=FileId(1)) as cf:
+  ...   (cf.numPages(), cf.codec.name, [schema.unpack(t).id for p in cf for t in p] == list(range(10000)))
+  (20, 'zlib', True)
+
+  # Pages are also readable by index.
+  >>> with CompressedPageFile(path + '.z') as cf:
+  ...   page = cf.readPage(19)
+  ...   (schema.unpack(page.getTuple(TupleId(page.pageId, 0))).id, cf.stats['pages'],
+  ...    cf.stats['bytes'] == cf.offsets[20] - cf.offsets[19])
+  (9709, 1, True)
+  >>> with CompressedPageFile(path + '.z') as cf:
+  ...   cf.readPage(20)
+  Traceback (most recent call last):
+  ...
+  ValueError: No such page: 20
+
+  # Files that are not compressed page files are closed before raising.
+  >>> from unittest import mock
+  >>> with open(path + '.short', 'wb') as f:
+  ...   _ = f.write(b'CPGF')
+  >>> (realOpen, files) = (open, [])
+  >>> def tracked(*args):
+  ...   files.append(realOpen(*args)); return files[-1]
+  >>> with mock.patch('builtins.open', tracked):
+  ...   CompressedPageFile(path + '.short')  # doctest: +ELLIPSIS
+  Traceback (most recent call last):
+  ...
+  ValueError: Not a compressed page file: ...
+  >>> [f.closed for f in files]
+  [True]
+  """
+
+  magic  = b'CPGF'
+  header = struct.Struct("<4sIB")
+  footer = struct.Struct("<QI4s")
+  offset = struct.Struct("<Q")
+
+  # Compressed page file constructor.
+  #
+  # fileId    : the FileId given to the file's pages
+  # pageClass : the Page class used to unpack pages
+  def __init__(self, filePath, **kwargs):
+    self.filePath  = filePath
+    self.fileId    = kwargs.get("fileId", FileId(0))
+    self.pageClass = kwargs.get("pageClass", Page)
+    self.stats     = { 'pages': 0, 'bytes': 0 }
+    self.file      = open(filePath, 'rb')
+    try:
+      self.readDirectory()
+    except BaseException:
+      self.file.close()
+      raise
+
+  # Reads the header, footer and page directory, checking the file's layout.
+  def readDirectory(self):
+    size = self.file.seek(0, os.SEEK_END)
+    if size < self.header.size + self.footer.size:
+      raise ValueError("Not a compressed page file: " + self.filePath)
+    self.file.seek(0)
+    (magic, self.pageSize, codecId) = self.header.unpack(self.file.read(self.header.size))
+    self.file.seek(-self.footer.size, os.SEEK_END)
+    (directoryOffset, numPages, footerMagic) = self.footer.unpack(self.file.read(self.footer.size))
+    if magic != self.magic or footerMagic != self.magic \
+       or directoryOffset + (numPages + 1) * self.offset.size + self.footer.size != size:
+      raise ValueError("Not a compressed page file: " + self.filePath)
+    self.codec = getCodec(codecId)
+
+    # The directory holds one more offset than pages, ending the last image.
+    self.file.seek(directoryOffset)
+    directory    = self.file.read((numPages + 1) * self.offset.size)
+    self.offsets = [o for (o,) in self.offset.iter_unpack(directory)]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    self.file.close()
+
+  def numPages(self):
+    return len(self.offsets) - 1
+
+  # Returns the page at the given index.
+  def readPage(self, pageIndex):
+    if not 0 <= pageIndex < self.numPages():
+      raise ValueError("No such page: %d" % pageIndex)
+    (start, end) = self.offsets[pageIndex: pageIndex + 2]
+    self.file.seek(start)
+    return self.unpackImage(pageIndex, self.file.read(end - start))
+
+  # Yields all pages in file order, reading the file sequentially.
+  def __iter__(self):
+    self.file.seek(self.offsets[0])
+    for pageIndex in range(self.numPages()):
+      size = self.offsets[pageIndex + 1] - self.offsets[pageIndex]
+      yield self.unpackImage(pageIndex, self.file.read(size))
+
+  def unpackImage(self, pageIndex, image):
+    self.stats['pages'] += 1
+    self.stats['bytes'] += len(image)
+    return self.pageClass.unpack(PageId(self.fileId, pageIndex), image)
+
+  # Writes the given pages, compressed with 'codec', to a new compressed page
+  # file. Returns the number of bytes written.
+  @classmethod
+  def write(cls, filePath, pages, codec, pageSize):
+    codec   = getCodec(codec)
+    offsets = []
+    with open(filePath, 'wb') as f:
+      f.write(cls.header.pack(cls.magic, pageSize, codec.id))
+      for page in pages:
+        offsets.append(f.tell())
+        f.write(page.packCompressed(codec))
+      offsets.append(f.tell())
+      f.write(b''.join(cls.offset.pack(o) for o in offsets))
+      f.write(cls.footer.pack(offsets[-1], len(offsets) - 1, cls.magic))
+      return f.tell()
+
+# Writes a compressed copy of the heap file at 'heapPath' to 'outPath'.
+# Returns a dictionary of compression statistics.
+def compressHeapFile(heapPath, outPath, codec, pageClass=Page):
+  (pageSize, numPages) = heapFileLayout(heapPath)
+  start = time.perf_counter()
+  size  = CompressedPageFile.write(outPath, PrefetchScan(heapPath, pageClass=pageClass, window=0),
+                                   codec, pageSize)
+  return { 'pages'    : numPages,
+           'rawBytes' : numPages * pageSize,
+           'bytes'    : size,
+           'seconds'  : time.perf_counter() - start }
+
+# Compares page codecs on a heap file, trading CPU time for I/O volume.
+#
+# The heap file is compressed with each codec, and both the heap file and
+# each compressed copy are scanned, unpacking every page and counting its
+# tuples. With 'coldCache', files are dropped from the OS page cache before
+# each scan, so that scans read from the device; compressed scans read fewer
+# bytes but spend time decompressing.
+#
+# Returns a list of statistics, one per codec, preceded by those of the
+# uncompressed heap file, whose codec is None.
+def compareCodecs(heapPath, codecNames=None, **kwargs):
+  """
+  >>> from Catalog.Schema import DBSchema
+  >>> from heapfile       import HeapFile
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> path   = os.path.join(tempfile.mkdtemp(), 'employee.heap')
+  >>> with HeapFile(path, FileId(1), schema=schema) as hf:
+  ...   hf.bulkLoad([b''.join(schema.pack(schema.instantiate(i, i % 50)) for i in range(10000))])
+  10000
+  >>> results = compareCodecs(path, ['nulrun', 'zlib'], coldCache=False)
+  >>> [(r['codec'], r['pages'], r['rows'], r['ratio'] > 1) for r in results]
+  [(None, 20, 10000, False), ('nulrun', 20, 10000, True), ('zlib', 20, 10000, True)]
+  """
+  coldCache = kwargs.get("coldCache", True)
+  pageClass = kwargs.get("pageClass", Page)
+  workDir   = tempfile.mkdtemp(dir=kwargs.get("tempDir", None))
+  names     = [c.name for c in codecs.values()] if codecNames is None else codecNames
+
+  def scan(path, pages, codec, compressSeconds):
+    if coldCache:
+      dropCache(path)
+    start = time.perf_counter()
+    if codec is None:
+      rows = sum(page.header.numTuples() for page in PrefetchScan(path, pageClass=pageClass, window=0))
+    else:
+      with CompressedPageFile(path, pageClass=pageClass) as cf:
+        rows = sum(page.header.numTuples() for page in cf)
+    seconds = time.perf_counter() - start
+    return { 'codec'           : codec,
+             'pages'           : pages,
+             'rows'            : rows,
+             'bytes'           : os.path.getsize(path),
+             'ratio'           : rawBytes / os.path.getsize(path),
+             'compressSeconds' : compressSeconds,
+             'scanSeconds'     : seconds,
+             'scanMBps'        : rawBytes / seconds / 1e6 if seconds > 0 else float('inf') }
+
+  (pageSize, numPages) = heapFileLayout(heapPath)
+  rawBytes = numPages * pageSize
+  try:
+    results = [scan(heapPath, numPages, None, 0.0)]
+    for name in names:
+      path  = os.path.join(workDir, '%s.cpg' % name)
+      stats = compressHeapFile(heapPath, path, name, pageClass)
+      results.append(scan(path, numPages, getCodec(name).name, stats['seconds']))
+  finally:
+    shutil.rmtree(workDir)
+  return results
+
+# Formats codec statistics as a table, one row per codec.
+def formatResults(results):
+  lines = ['%10s %12s %7s %12s %10s %10s' % ('codec', 'bytes', 'ratio', 'compress s', 'scan s', 'scan MB/s')]
+  for r in results:
+    lines.append('%10s %12d %7.2f %12.3f %10.3f %10.1f' % (r['codec'] or 'heap', r['bytes'], r['ratio'],
+                                                          r['compressSeconds'], r['scanSeconds'], r['scanMBps']))
+  return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+  if len(sys.argv) > 1:
+    # Benchmark a binary file of packed records, e.g., as written by warmup.py.
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import warmup
+    from heapfile import HeapFile
+    from parallelload import RecordSchema
+    if len(sys.argv) != 3 or sys.argv[1] not in ('lineitem', 'orders'):
+      sys.exit("usage: compression.py (lineitem|orders) <input.bin>")
+    schema = RecordSchema(warmup.Lineitem if sys.argv[1] == 'lineitem' else warmup.Orders)
+    with open(sys.argv[2], 'rb') as f:
+      data = f.read()
+    workDir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(workDir, sys.argv[1] + '.heap')
+      with HeapFile(path, FileId(0), schema=schema) as hf:
+        hf.bulkLoad([data[:len(data) - len(data) % schema.size]])
+      print(formatResults(compareCodecs(path)))
+    finally:
+      shutil.rmtree(workDir)
+  else:
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,347 @@
+import os, shutil, sys, tempfile, time
+
+from Catalog.Identifiers import FileId
+from heapfile import HeapFile
+
+# Default memory budget of a hash join, in bytes.
+defaultMemoryLimit = 64 << 20
+
+# Estimated memory taken by an in-memory hash table beyond the packed tuples:
+# per tuple, its bytes object header and its slot in a list of matches, and
+# per distinct key, the key object, its list of matches and its dictionary
+# entry (about 170 bytes in CPython).
+tupleOverhead = sys.getsizeof(b'') + 8
+keyOverhead   = 176
+
+# Returns a function extracting the named field from packed tuples of 'schema'.
+# Schemas must provide 'binrepr' and 'fields', as DBSchema and RecordSchema do.
+def fieldKey(schema, name):
+  index  = list(schema.fields).index(name)
+  unpack = schema.binrepr.unpack
+  return lambda tupleData: unpack(tupleData)[index]
+
+
+class SpillFile:
+  """
+  A temporary heap file holding one partition of a hash join input.
+
+  Tuples are appended to an output buffer, and written out a page at a time
+  with HeapFile.appendPages, bypassing the buffer pool.
+  """
+
+  def __init__(self, filePath, schema, pageSize, pageClass):
+    self.file    = HeapFile(filePath, FileId(0), schema=schema, pageSize=pageSize,
+                            pageClass=pageClass, poolPages=4)
+    self.pending = bytearray()
+    self.rows    = 0
+
+  def append(self, tupleData):
+    self.pending += tupleData
+    self.rows    += 1
+    if len(self.pending) >= self.file.pageSize:
+      self.file.appendPages(self.pending, final=False)
+
+  # Writes out the last partial page, returning the heap file.
+  def finish(self):
+    self.file.appendPages(self.pending, final=True)
+    self.file.flush()
+    return self.file
+
+  def remove(self):
+    self.file.close()
+    self.file.bufferPool.close()
+    os.remove(self.file.filePath)
+    os.remove(self.file.fsmPath())
+
+  # Closes the heap file and unmaps its buffer pool, once its directory is
+  # about to be removed.
+  def close(self):
+    self.file.file.close()
+    self.file.bufferPool.close()
+
+
+class HashJoin:
+  """
+  An equi-join of two heap files, using a hybrid hash join.
+
+  The build input (e.g., orders) is loaded into an in-memory hash table on its
+  join key, and the probe input (e.g., lineitem) is streamed against it.
+  When the build input exceeds the memory limit, both inputs are hash
+  partitioned on the join key into temporary heap files, so that each build
+  partition fits in memory, and matching partition pairs are then joined.
+  Partitions that are still too large are partitioned again with a
+  different hash function, up to 'maxDepth' levels.
+
+  The join is hybrid: the first partition is kept in memory while the build
+  input is partitioned, and probe tuples falling into it are joined directly
+  instead of being written out. If that partition outgrows its share of the
+  memory limit, it is spilled like the others. Probe tuples whose build
+  partition is empty are dropped without being written.
+
+  Iterating over a join yields (buildTuple, probeTuple) pairs of packed
+  tuples. Statistics on partitioning, spilling and probe throughput are
+  available in 'stats' once the iteration completes. Build and probe times
+  exclude the time spent by the consumer of the join's output.
+
+  >>> import tempfile, os
+  >>> from Catalog.Schema import DBSchema
+
+  # Test harness setup.
+  >>> d        = tempfile.mkdtemp()
+  >>> oSchema  = DBSchema('orders', [('o_orderkey', 'int'), ('o_custkey', 'int')])
+  >>> lSchema  = DBSchema('lineitem', [('l_orderkey', 'int'), ('l_linenumber', 'int')])
+  >>> orders   = HeapFile(d + '/orders.heap', FileId(1), schema=oSchema, pageSize=256)
+  >>> lineitem = HeapFile(d + '/lineitem.heap', FileId(2), schema=lSchema, pageSize=256)
+  >>> orders.bulkLoad([b''.join(oSchema.pack(oSchema.instantiate(k, k % 7)) for k in range(0, 2000, 2))])
+  1000
+  >>> lineitem.bulkLoad([b''.join(lSchema.pack(lSchema.instantiate(k // 4, k % 4)) for k in range(8000))])
+  8000
+
+  # A join within the memory limit runs in memory.
+  >>> j = HashJoin(orders, lineitem, 'o_orderkey', 'l_orderkey', tempDir=d)
+  >>> pairs = [(oSchema.unpack(b), lSchema.unpack(p)) for (b, p) in j]
+  >>> len(pairs), all(b.o_orderkey == p.l_orderkey for (b, p) in pairs)
+  (4000, True)
+  >>> j.stats['partitions'], j.stats['spilledPages']
+  (0, 0)
+
+  # A smaller memory limit partitions both inputs to disk. The limit applies
+  # to the estimated size of the hash table, which is several times that of
+  # the packed build tuples.
+  >>> orders.numPages() * orders.pageSize < 32768 < j.tableBytes(j.stats['buildRows'])
+  True
+  >>> j = HashJoin(orders, lineitem, 'o_orderkey', 'l_orderkey', tempDir=d, memoryLimit=32768)
+  >>> sorted((oSchema.unpack(b), lSchema.unpack(p)) for (b, p) in j) == sorted(pairs)
+  True
+  >>> j.stats['partitions'] > 0, j.stats['spilledPartitions'] > 0, j.stats['spilledPages'] > 0
+  (True, True, True)
+  >>> j.stats['buildRows'], j.stats['probeRows'], j.stats['outputRows']
+  (1000, 8000, 4000)
+  >>> j.stats['probeRowsPerSec'] > 0
+  True
+
+  # Partitions are removed once the join completes.
+  >>> sorted(os.listdir(d))
+  ['lineitem.heap', 'orders.heap']
+
+  # Partitions are also closed and removed when a join is abandoned.
+  >>> j      = HashJoin(orders, lineitem, 'o_orderkey', 'l_orderkey', tempDir=d, memoryLimit=32768)
+  >>> it     = iter(j)
+  >>> _      = next(it)
+  >>> spills = list(j.spillFiles)
+  >>> it.close()
+  >>> len(spills) > 0, all(s.file.file.closed for s in spills), sorted(os.listdir(d))
+  (True, True, ['lineitem.heap', 'orders.heap'])
+  >>> all(s.file.bufferPool.arena.memory.closed for s in spills)
+  True
+
+  # Probe times do not include the consumer's time.
+  >>> import time
+  >>> j = HashJoin(orders, lineitem, 'o_orderkey', 'l_orderkey', tempDir=d)
+  >>> for (i, _) in enumerate(j):
+  ...   if i < 50: time.sleep(0.01)
+  >>> j.stats['probeSeconds'] < 0.25
+  True
+  """
+
+  # Hash join constructor.
+  #
+  # build        : the heap file of the build input
+  # probe        : the heap file of the probe input
+  # buildField   : the name of the join key field in the build schema
+  # probeField   : the name of the join key field in the probe schema
+  # memoryLimit  : the bytes of memory used by in-memory hash tables, as
+  #                estimated by 'tableBytes', including one output page per
+  #                partition while partitioning
+  # maxDepth     : the maximum number of recursive partitioning passes
+  # tempDir      : the directory under which partitions are spilled
+  def __init__(self, build, probe, buildField, probeField, **kwargs):
+    self.build       = build
+    self.probe       = probe
+    self.buildKey    = fieldKey(build.schema, buildField)
+    self.probeKey    = fieldKey(probe.schema, probeField)
+    self.memoryLimit = kwargs.get("memoryLimit", defaultMemoryLimit)
+    self.maxDepth    = kwargs.get("maxDepth", 4)
+    self.tempDir     = kwargs.get("tempDir", None)
+    self.stats       = {}
+
+  def __iter__(self):
+    self.stats = { 'buildRows'         : 0,
+                   'probeRows'         : 0,
+                   'outputRows'        : 0,
+                   'partitions'        : 0,
+                   'spilledPartitions' : 0,
+                   'spilledPages'      : 0,
+                   'spilledBytes'      : 0,
+                   'depth'             : 0,
+                   'overflows'         : 0,
+                   'buildSeconds'      : 0.0,
+                   'probeSeconds'      : 0.0 }
+    self.spillDir        = tempfile.mkdtemp(dir=self.tempDir)
+    self.spills          = 0
+    self.spillFiles      = []
+    self.consumerSeconds = 0.0
+    try:
+      yield from self.join(self.build, self.probe, 0)
+    finally:
+      for spillFile in self.spillFiles:
+        spillFile.close()
+      self.spillFiles = []
+      shutil.rmtree(self.spillDir)
+
+    stats = self.stats
+    stats['probeRowsPerSec'] = stats['probeRows'] / stats['probeSeconds'] \
+                                 if stats['probeSeconds'] > 0 else float('inf')
+
+  # Returns an estimate of the memory taken by a hash table of 'rows' build
+  # tuples, assuming distinct keys.
+  def tableBytes(self, rows):
+    return rows * (self.build.schema.size + tupleOverhead + keyOverhead)
+
+  # Returns the number of partitions for a build input whose hash table would
+  # take 'tableBytes' bytes, such that each partition's table fits in memory
+  # beside the output pages.
+  def partitionCount(self, tableBytes, pageSize):
+    maxPartitions = max(2, self.memoryLimit // pageSize - 1)
+    for n in range(2, maxPartitions + 1):
+      if tableBytes <= n * (self.memoryLimit - n * pageSize):
+        return n
+    return maxPartitions
+
+  # Creates a spill file, which is closed by the iteration if the join stops
+  # before the file is removed.
+  def spillFile(self, heapFile):
+    self.spills += 1
+    path = os.path.join(self.spillDir, 'part%d' % self.spills)
+    spillFile = SpillFile(path, heapFile.schema, heapFile.pageSize, heapFile.pageClass)
+    self.spillFiles.append(spillFile)
+    return spillFile
+
+  def removeSpill(self, spillFile):
+    spillFile.remove()
+    self.spillFiles.remove(spillFile)
+
+  # Yields a join result, accounting for the time the consumer holds it.
+  def output(self, match, tupleData):
+    self.stats['outputRows'] += 1
+    paused = time.perf_counter()
+    yield (match, tupleData)
+    self.consumerSeconds += time.perf_counter() - paused
+
+  def recordSpill(self, spillFile):
+    self.stats['spilledPages'] += spillFile.file.numPages()
+    self.stats['spilledBytes'] += spillFile.file.numPages() * spillFile.file.pageSize
+
+  # Yields the tuples of an input, counting rows read from the join's inputs.
+  def tuples(self, heapFile, counter, depth):
+    if depth == 0:
+      for (_, tupleData) in heapFile.scan():
+        self.stats[counter] += 1
+        yield tupleData
+    else:
+      for (_, tupleData) in heapFile.scan():
+        yield tupleData
+
+  # Yields the matches of probe tuples against an in-memory hash table.
+  def probeTable(self, table, probeTuples):
+    probeKey = self.probeKey
+    for tupleData in probeTuples:
+      for match in table.get(probeKey(tupleData), ()):
+        yield from self.output(match, tupleData)
+
+  # Joins two heap files, partitioning them when the hash table of the build
+  # input does not fit in memory. The number of build rows is known for
+  # partitions, and bounded by the number of pages for the join's inputs.
+  # Partitions are hashed on (depth, key) so that each pass splits the keys
+  # of an oversized partition differently.
+  def join(self, build, probe, depth, buildRows=None):
+    stats          = self.stats
+    stats['depth'] = max(stats['depth'], depth)
+    if buildRows is None:
+      buildRows    = build.numPages() * (build.pageSize // build.schema.size)
+    tableBytes     = self.tableBytes(buildRows)
+    buildKey       = self.buildKey
+    start          = time.perf_counter()
+
+    if tableBytes <= self.memoryLimit or depth >= self.maxDepth:
+      if tableBytes > self.memoryLimit:
+        # E.g., a single key with more tuples than fit in memory.
+        stats['overflows'] += 1
+      table = {}
+      for tupleData in self.tuples(build, 'buildRows', depth):
+        table.setdefault(buildKey(tupleData), []).append(tupleData)
+      stats['buildSeconds'] += time.perf_counter() - start
+      start    = time.perf_counter()
+      consumed = self.consumerSeconds
+      yield from self.probeTable(table, self.tuples(probe, 'probeRows', depth))
+      stats['probeSeconds'] += time.perf_counter() - start - (self.consumerSeconds - consumed)
+      return
+
+    # Build phase: partition the build input, keeping partition 0 resident
+    # while it fits in the memory left over by the other partitions' pages.
+    n               = self.partitionCount(tableBytes, build.pageSize)
+    residentBudget  = self.memoryLimit - (n - 1) * build.pageSize
+    resident        = {}
+    residentBytes   = 0
+    buildParts      = [None] + [self.spillFile(build) for _ in range(1, n)]
+    stats['partitions'] += n
+
+    for tupleData in self.tuples(build, 'buildRows', depth):
+      key = buildKey(tupleData)
+      p   = hash((depth, key)) % n
+      if p == 0 and resident is not None:
+        size = len(tupleData) + tupleOverhead + (keyOverhead if key not in resident else 0)
+        if residentBytes + size <= residentBudget:
+          resident.setdefault(key, []).append(tupleData)
+          residentBytes += size
+          continue
+        # Partition 0 overflowed its budget, so spill it as well.
+        buildParts[0] = self.spillFile(build)
+        for matches in resident.values():
+          for match in matches:
+            buildParts[0].append(match)
+        resident = None
+      buildParts[p].append(tupleData)
+
+    for part in buildParts:
+      if part is not None:
+        part.finish()
+        self.recordSpill(part)
+        if part.rows:
+          stats['spilledPartitions'] += 1
+    stats['buildSeconds'] += time.perf_counter() - start
+
+    # Probe phase: join probe tuples of the resident partition directly, and
+    # spill the others, unless their build partition is empty.
+    start      = time.perf_counter()
+    consumed   = self.consumerSeconds
+    probeKey   = self.probeKey
+    probeParts = [self.spillFile(probe) if part is not None and part.rows else None
+                    for part in buildParts]
+    for tupleData in self.tuples(probe, 'probeRows', depth):
+      key = probeKey(tupleData)
+      p   = hash((depth, key)) % n
+      if probeParts[p] is not None:
+        probeParts[p].append(tupleData)
+      elif p == 0 and resident is not None:
+        for match in resident.get(key, ()):
+          yield from self.output(match, tupleData)
+    resident = None
+    for part in probeParts:
+      if part is not None:
+        part.finish()
+        self.recordSpill(part)
+    stats['probeSeconds'] += time.perf_counter() - start - (self.consumerSeconds - consumed)
+
+    # Join the spilled partition pairs, discarding each pair once joined.
+    for (buildPart, probePart) in zip(buildParts, probeParts):
+      if probePart is not None:
+        yield from self.join(buildPart.file, probePart.file, depth + 1, buildPart.rows)
+        self.removeSpill(probePart)
+      if buildPart is not None:
+        self.removeSpill(buildPart)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,379 @@
+import os, struct
+
+from Catalog.Identifiers import PageId, TupleId
+from page import Page
+from bufferpool import BufferPool, FrameArena
+
+class HeapFile:
+  """
+  A heap file, storing a sequence of pages in a single file.
+
+  Pages are addressed by PageId, whose page index is the page's position in
+  the file following a file header of one page. All page accesses go through
+  a buffer pool, for which the heap file acts as the file manager.
+
+  The heap file keeps a free-space map with one bit per page, indicating
+  whether the page may have room for another tuple, and a stack of candidate
+  pages with their bit set. Inserts take the top candidate, so choosing an
+  insert page never scans page headers. A page's bit is cleared once it fills
+  up, and set again when a tuple is deleted from it. The free-space map is
+  stored in a side file next to the heap file, and is rebuilt from the page
+  headers if the side file is missing.
+
+  The file header also holds a write epoch, which is advanced on disk before
+  the first page write following a flush. Side files summarizing the pages,
+  such as zone maps, record the epoch at which they were saved by a flush,
+  so a side file whose epoch differs from the file's predates page writes,
+  e.g., by evictions before a crash, and must be rebuilt.
+
+  >>> import tempfile, os
+  >>> from Catalog.Identifiers import FileId
+  >>> from Catalog.Schema      import DBSchema
+
+  # Test harness setup.
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> path   = os.path.join(tempfile.mkdtemp(), 'employee.heap')
+  >>> hf     = HeapFile(path, FileId(1), schema=schema, pageSize=256)
+
+  # Inserts fill pages in turn.
+  >>> tIds = [hf.insertTuple(schema.pack(schema.instantiate(i, 20+i))) for i in range(100)]
+  >>> hf.numPages()
+  4
+  >>> schema.unpack(hf.getTuple(tIds[42]))
+  employee(id=42, age=62)
+
+  # Sequential scans yield tuple ids with their data.
+  >>> scanned = list(hf.scan())
+  >>> [tId for (tId, _) in scanned] == tIds
+  True
+  >>> schema.unpack(scanned[-1][1])
+  employee(id=99, age=119)
+
+  # Failed updates leave no page pinned.
+  >>> hf.putTuple(tIds[1], b'too short') # doctest: +IGNORE_EXCEPTION_DETAIL
+  Traceback (most recent call last):
+  ...
+  ValueError: wrong tuple size
+  >>> hf.bufferPool.stats()['pinned']
+  0
+
+  # Deleting from a full page makes it an insert candidate again.
+  >>> hf.deleteTuple(tIds[0])
+  >>> hf.insertTuple(schema.pack(schema.instantiate(100, 120))).pageId.pageIndex
+  0
+
+  # Pages and the free-space map persist across reopening.
+  >>> hf.close()
+  >>> hf = HeapFile(path, FileId(1), schema=schema)
+  >>> hf.pageSize, hf.numPages(), len(list(hf.scan()))
+  (256, 4, 100)
+
+  # Page writes after a flush advance the write epoch once.
+  >>> epoch = hf.epoch
+  >>> tId = hf.insertTuple(schema.pack(schema.instantiate(101, 121)))
+  >>> hf.deleteTuple(tId)
+  >>> hf.bufferPool.flushPages()
+  >>> hf.epoch == epoch + 1, HeapFile(path, FileId(1), schema=schema).epoch == hf.epoch
+  (True, True)
+  >>> hf.flush()
+
+  # Bulk loading appends pages built from consecutive packed tuples.
+  >>> data = b''.join(schema.pack(schema.instantiate(i, i)) for i in range(1000))
+  >>> hf.bulkLoad([data[:3000], data[3000:]])
+  1000
+  >>> hf.numPages(), len(list(hf.scan()))
+  (37, 1100)
+
+  # Each bulk loaded page is passed to the appendedPage hook with its tuples.
+  >>> appended = []
+  >>> hf.appendedPage = lambda page, tuples: appended.append(
+  ...   (page.pageId.pageIndex, [schema.unpack(t).id for t in tuples][0]))
+  >>> hf.bulkLoad([data[:800]])
+  100
+  >>> appended
+  [(37, 0), (38, 31), (39, 62), (40, 93)]
+  >>> del hf.appendedPage
+
+  >>> hf.close()
+
+  # Pages are read in place into the frames of the buffer pool's arena,
+  # which are reused as pages are evicted.
+  >>> hf = HeapFile(path, FileId(1), schema=schema, poolPages=8)
+  >>> len(list(hf.scan())), hf.bufferPool.evictions, hf.bufferPool.arena.inUse()
+  (1200, 33, 8)
+  >>> hf.close()
+  """
+
+  # Binary representation of the file header: a magic string, the page size
+  # of the file, and its write epoch.
+  binrepr = struct.Struct("4sIQ")
+  magic   = b'HEAP'
+
+  defaultPageSize  = 4096
+  defaultPoolPages = 64
+
+  # Heap file constructor.
+  #
+  # filePath     : the path of the heap file, created if it does not exist
+  # fileId       : the FileId of this file
+  # schema       : the schema for tuples stored in the file's pages
+  # pageSize     : the page size in bytes, for new files
+  # pageClass    : the Page class used for this file's pages
+  # bufferPool   : an existing buffer pool, otherwise a new pool is created,
+  #                reading pages in place into a frame arena
+  # poolPages    : the number of pages of a new buffer pool
+  def __init__(self, filePath, fileId, **kwargs):
+    self.filePath   = filePath
+    self.fileId     = fileId
+    self.schema     = kwargs.get("schema", None)
+    self.pageClass  = kwargs.get("pageClass", Page)
+
+    if os.path.exists(filePath):
+      self.file = open(filePath, 'r+b')
+      (magic, self.pageSize, self.epoch) = self.binrepr.unpack(self.file.read(self.binrepr.size))
+      if magic != self.magic:
+        raise ValueError("Not a heap file: " + filePath)
+    else:
+      self.pageSize = kwargs.get("pageSize", self.defaultPageSize)
+      self.epoch    = 0
+      self.file     = open(filePath, 'w+b')
+      self.file.write(self.binrepr.pack(self.magic, self.pageSize, self.epoch).ljust(self.pageSize, b'\x00'))
+    self.modified   = False
+
+    self.bufferPool = kwargs.get("bufferPool", None)
+    if self.bufferPool is None:
+      poolPages       = kwargs.get("poolPages", self.defaultPoolPages)
+      self.bufferPool = BufferPool(self, poolPages, arena=FrameArena(self.pageSize, poolPages))
+
+    self.pageCount = self.file.seek(0, 2) // self.pageSize - 1
+    self.loadFreeSpaceMap()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def numPages(self):
+    return self.pageCount
+
+  def pageId(self, pageIndex):
+    return PageId(self.fileId, pageIndex)
+
+  # File manager methods, used by the buffer pool.
+
+  # Reads the page with the given id from the file into a new buffer.
+  def readPage(self, pageId):
+    return self.readPageInto(pageId, bytearray(self.pageSize))
+
+  # Reads the page with the given id directly into a writable frame of the
+  # file's page size, returning a page wrapping the frame.
+  def readPageInto(self, pageId, frame):
+    self.file.seek((pageId.pageIndex + 1) * self.pageSize)
+    if self.file.readinto(frame) != self.pageSize:
+      raise ValueError("No such page: %d" % pageId.pageIndex)
+    return self.pageClass.wrap(pageId, frame)
+
+  # Writes the packed representation of a page to the file.
+  def writePage(self, page):
+    self.advanceEpoch()
+    self.file.seek((page.pageId.pageIndex + 1) * self.pageSize)
+    self.file.write(page.packView())
+
+  # Advances the write epoch in the file header, before the first page write
+  # following a flush.
+  def advanceEpoch(self):
+    if not self.modified:
+      self.epoch   += 1
+      self.modified = True
+      self.file.seek(0)
+      self.file.write(self.binrepr.pack(self.magic, self.pageSize, self.epoch))
+
+  # Free-space map methods.
+
+  def fsmPath(self):
+    return self.filePath + '.fsm'
+
+  def hasFreeSpace(self, pageIndex):
+    return (self.fsm[pageIndex >> 3] >> (pageIndex & 7)) & 1 == 1
+
+  def setFreeSpace(self, pageIndex, free):
+    if free and not self.hasFreeSpace(pageIndex):
+      self.fsm[pageIndex >> 3] |= 1 << (pageIndex & 7)
+      self.freePages.append(pageIndex)
+    elif not free:
+      self.fsm[pageIndex >> 3] &= ~(1 << (pageIndex & 7))
+
+  # Loads the free-space map, rebuilding it from page headers if its side
+  # file is missing or out of date.
+  def loadFreeSpaceMap(self):
+    size = (self.pageCount + 7) // 8
+    if os.path.exists(self.fsmPath()):
+      with open(self.fsmPath(), 'rb') as f:
+        self.fsm = bytearray(f.read())
+    else:
+      self.fsm = None
+
+    if self.fsm is not None and len(self.fsm) == size:
+      self.freePages = [i for i in range(self.pageCount) if self.hasFreeSpace(i)]
+    else:
+      self.fsm       = bytearray(size)
+      self.freePages = []
+      for i in range(self.pageCount):
+        page = self.bufferPool.getPage(self.pageId(i), pin=False)
+        self.setFreeSpace(i, page.header.hasFreeTuple())
+
+  def saveFreeSpaceMap(self):
+    with open(self.fsmPath(), 'wb') as f:
+      f.write(self.fsm)
+
+  # Appends a new, empty page to the file, returning its page index.
+  def allocatePage(self):
+    pageIndex = self.pageCount
+    page      = self.pageClass(pageId=self.pageId(pageIndex), buffer=bytes(self.pageSize),
+                               schema=self.schema)
+    self.writePage(page)
+    self.pageCount += 1
+    if len(self.fsm) * 8 < self.pageCount:
+      self.fsm.append(0)
+    self.setFreeSpace(pageIndex, True)
+    return pageIndex
+
+  # Tuple methods.
+
+  # Adds a packed tuple to a page with free space. Returns the new tuple's id.
+  def insertTuple(self, tupleData):
+    # Discard stale candidates whose free-space bit has been cleared.
+    while self.freePages and not self.hasFreeSpace(self.freePages[-1]):
+      self.freePages.pop()
+    pageIndex = self.freePages[-1] if self.freePages else self.allocatePage()
+    tupleId   = self.insertIntoPage(pageIndex, tupleData)
+    if tupleId is None:
+      # The tuple did not fit in the candidate page, so use a fresh one.
+      tupleId = self.insertIntoPage(self.allocatePage(), tupleData)
+      if tupleId is None:
+        raise ValueError("Tuple does not fit in an empty page")
+    return tupleId
+
+  # Adds a packed tuple to the given page, returning None if it does not fit.
+  def insertIntoPage(self, pageIndex, tupleData):
+    pageId = self.pageId(pageIndex)
+    page   = self.bufferPool.getPage(pageId)
+    try:
+      tupleId = page.insertTuple(tupleData)
+    except ValueError:
+      tupleId = None
+    self.bufferPool.unpinPage(pageId, dirty=tupleId is not None)
+    if not page.header.hasFreeTuple():
+      self.setFreeSpace(pageIndex, False)
+    return tupleId
+
+  # Appends consecutive packed tuples to the file, e.g., the batches produced by
+  # warmup.packBatches. Each new page is filled with one contiguous copy and
+  # written directly to the file, bypassing the buffer pool.
+  # Returns the number of tuples loaded.
+  def bulkLoad(self, batches):
+    pending = bytearray()
+    loaded  = 0
+    for batch in batches:
+      pending += batch
+      loaded  += self.appendPages(pending, final=False)
+    loaded += self.appendPages(pending, final=True)
+    return loaded
+
+  # Builds full pages from the front of 'pending', removing the consumed bytes.
+  # Unless 'final' is set, a trailing partial page is kept for the next batch.
+  # Pages are built in a single reusable frame.
+  def appendPages(self, pending, final):
+    view     = memoryview(pending)
+    frame    = bytearray(self.pageSize)
+    zeros    = bytes(self.pageSize)
+    consumed = 0
+    try:
+      while consumed < len(view):
+        pageIndex = self.pageCount
+        frame[:]  = zeros
+        (page, n) = self.pageClass.build(self.pageId(pageIndex), self.schema,
+                                         view[consumed:], self.pageSize, frame)
+        if n == 0:
+          raise ValueError("Tuple does not fit in an empty page")
+        full = not page.header.hasFreeTuple()
+        if not (full or final):
+          break
+        self.writePage(page)
+        self.pageCount += 1
+        if len(self.fsm) * 8 < self.pageCount:
+          self.fsm.append(0)
+        self.setFreeSpace(pageIndex, not full)
+        size = self.schema.size
+        self.appendedPage(page, (view[i: i + size] for i in range(consumed, consumed + n, size)))
+        consumed += n
+    finally:
+      view.release()
+    del pending[:consumed]
+    return consumed // self.schema.size
+
+  # Called for each page written by a bulk load, with the packed tuples it
+  # was built from, e.g., to maintain page summaries without reading the page
+  # back. The page's frame and the tuples are reused once this returns.
+  def appendedPage(self, page, tuples):
+    pass
+
+  # Returns a copy of the packed tuple with the given id.
+  def getTuple(self, tupleId):
+    page = self.bufferPool.getPage(tupleId.pageId)
+    try:
+      data = page.getTuple(tupleId)
+      return bytes(data) if data is not None else None
+    finally:
+      self.bufferPool.unpinPage(tupleId.pageId)
+
+  # Updates the packed tuple with the given id.
+  def putTuple(self, tupleId, tupleData):
+    page = self.bufferPool.getPage(tupleId.pageId)
+    try:
+      page.putTuple(tupleId, tupleData)
+    finally:
+      self.bufferPool.unpinPage(tupleId.pageId, dirty=True)
+
+  # Removes the tuple with the given id, marking its page as an insert candidate.
+  def deleteTuple(self, tupleId):
+    page = self.bufferPool.getPage(tupleId.pageId)
+    try:
+      page.deleteTuple(tupleId)
+    finally:
+      self.bufferPool.unpinPage(tupleId.pageId, dirty=True)
+    self.setFreeSpace(tupleId.pageId.pageIndex, True)
+
+  # Sequential scan, yielding (TupleId, bytes) pairs in file order.
+  def scan(self):
+    for pageIndex in range(self.pageCount):
+      yield from self.pageTuples(pageIndex)
+
+  # Returns a list of (TupleId, bytes) pairs copied from a page, which is
+  # unpinned before the tuples are consumed.
+  def pageTuples(self, pageIndex):
+    pageId = self.pageId(pageIndex)
+    page   = self.bufferPool.getPage(pageId)
+    try:
+      return [(tupleId, bytes(page.getTuple(tupleId))) for tupleId in page.tupleIds()]
+    finally:
+      self.bufferPool.unpinPage(pageId)
+
+  # Writes back all dirty pages and the free-space map. Side files saved by
+  # subclasses after this are current as of the file's epoch.
+  def flush(self):
+    self.bufferPool.flushPages()
+    self.file.flush()
+    self.saveFreeSpaceMap()
+    self.modified = False
+
+  def close(self):
+    if not self.file.closed:
+      self.flush()
+      self.file.close()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
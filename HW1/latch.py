@@ -0,0 +1,218 @@
+import threading
+
+from page import Page, PageCursor
+from slottedpage import SlottedPage
+
+class RWLatch:
+  """
+  A reader/writer latch.
+
+  Any number of threads may hold the latch in shared mode, or a single thread
+  may hold it in exclusive mode. Both modes are reentrant, and a thread
+  holding the latch exclusively may also acquire it in shared mode, so that
+  latched operations may call one another. A shared latch cannot be upgraded.
+  Waiting writers block new readers, so writers are not starved by a stream
+  of scans.
+
+  >>> import threading
+  >>> latch = RWLatch()
+  >>> with latch.shared():
+  ...   with latch.shared():
+  ...     latch.readers, latch.readerDepths[threading.get_ident()]
+  (1, 2)
+  >>> with latch.exclusive():
+  ...   with latch.exclusive():
+  ...     with latch.shared():
+  ...       latch.writerDepth
+  3
+  >>> latch.readers, latch.writer
+  (0, None)
+  """
+
+  def __init__(self):
+    self.cond           = threading.Condition(threading.Lock())
+    self.readers        = 0
+    self.readerDepths   = {}
+    self.writer         = None
+    self.writerDepth    = 0
+    self.waitingWriters = 0
+
+  def acquireShared(self):
+    me = threading.get_ident()
+    with self.cond:
+      if self.writer == me:
+        self.writerDepth += 1
+        return
+      if me in self.readerDepths:
+        self.readerDepths[me] += 1
+        return
+      while self.writer is not None or self.waitingWriters:
+        self.cond.wait()
+      self.readers += 1
+      self.readerDepths[me] = 1
+
+  def releaseShared(self):
+    me = threading.get_ident()
+    with self.cond:
+      if self.writer == me:
+        self.writerDepth -= 1
+        return
+      self.readerDepths[me] -= 1
+      if self.readerDepths[me] == 0:
+        del self.readerDepths[me]
+        self.readers -= 1
+        if self.readers == 0:
+          self.cond.notify_all()
+
+  def acquireExclusive(self):
+    me = threading.get_ident()
+    with self.cond:
+      if self.writer == me:
+        self.writerDepth += 1
+        return
+      self.waitingWriters += 1
+      while self.writer is not None or self.readers:
+        self.cond.wait()
+      self.waitingWriters -= 1
+      self.writer      = me
+      self.writerDepth = 1
+
+  def releaseExclusive(self):
+    with self.cond:
+      self.writerDepth -= 1
+      if self.writerDepth == 0:
+        self.writer = None
+        self.cond.notify_all()
+
+  def shared(self):
+    return LatchGuard(self.acquireShared, self.releaseShared)
+
+  def exclusive(self):
+    return LatchGuard(self.acquireExclusive, self.releaseExclusive)
+
+
+class LatchGuard:
+  def __init__(self, acquire, release):
+    self.acquire = acquire
+    self.release = release
+
+  def __enter__(self):
+    self.acquire()
+
+  def __exit__(self, *exc):
+    self.release()
+
+
+class LatchedCursor(PageCursor):
+  """
+  A page cursor that reads each tuple under the page's shared latch.
+
+  Tuples are returned as copies taken by the latched page's getTuple, so
+  they remain valid when a concurrent writer later modifies or compacts the
+  page.
+  """
+
+  def __next__(self):
+    with self.page.latch.shared():
+      return PageCursor.__next__(self)
+
+
+class LatchedPageMixin:
+  """
+  A mixin adding a reader/writer latch to a page class.
+
+  Tuple reads and iteration take the latch in shared mode, while operations
+  modifying tuples or the page header take it in exclusive mode. Each
+  iteration over a latched page uses its own cursor.
+
+  >>> from Catalog.Identifiers import FileId, PageId
+  >>> from Catalog.Schema      import DBSchema
+  >>> from concurrent.futures  import ThreadPoolExecutor
+
+  # Concurrent inserts and scans do not corrupt the page.
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> p      = LatchedPage(pageId=PageId(FileId(1), 0), buffer=bytes(4096), schema=schema)
+  >>> def insert(i):
+  ...   return p.insertTuple(schema.pack(schema.instantiate(i, i)))
+  >>> def scan(i):
+  ...   return all(schema.unpack(t).id == schema.unpack(t).age for t in p)
+  >>> with ThreadPoolExecutor(8) as pool:
+  ...   results = list(pool.map(lambda i: scan(i) if i % 2 else insert(i), range(400)))
+  >>> all(results[1::2]), sorted(schema.unpack(t).id for t in p) == list(range(0, 400, 2))
+  (True, True)
+
+  # Tuples read are copies, unaffected by later writes.
+  >>> tId = p.tupleIds()[0]
+  >>> t   = p.getTuple(tId)
+  >>> p.clearTuple(tId)
+  >>> schema.unpack(t).id == schema.unpack(t).age, schema.unpack(p.getTuple(tId)).id
+  (True, 0)
+  """
+
+  def __init__(self, **kwargs):
+    self.latch = RWLatch()
+    super().__init__(**kwargs)
+
+  def __iter__(self):
+    return LatchedCursor(self)
+
+  # Returns a copy of the tuple, taken under the latch, or None.
+  def getTuple(self, tupleId):
+    with self.latch.shared():
+      data = super().getTuple(tupleId)
+      return bytes(data) if data is not None else None
+
+  def tupleIds(self):
+    with self.latch.shared():
+      return super().tupleIds()
+
+  def putTuple(self, tupleId, tupleData):
+    with self.latch.exclusive():
+      return super().putTuple(tupleId, tupleData)
+
+  def insertTuple(self, tupleData):
+    with self.latch.exclusive():
+      return super().insertTuple(tupleData)
+
+  def insertPackedTuples(self, data):
+    with self.latch.exclusive():
+      return super().insertPackedTuples(data)
+
+  def clearTuple(self, tupleId):
+    with self.latch.exclusive():
+      return super().clearTuple(tupleId)
+
+  def deleteTuple(self, tupleId):
+    with self.latch.exclusive():
+      return super().deleteTuple(tupleId)
+
+  def pack(self):
+    with self.latch.exclusive():
+      return super().pack()
+
+  def packView(self):
+    with self.latch.exclusive():
+      return super().packView()
+
+
+class LatchedPage(LatchedPageMixin, Page):
+  pass
+
+
+class LatchedSlottedPage(LatchedPageMixin, SlottedPage):
+  # Slotted iteration scans live slots under the shared latch.
+  def __iter__(self):
+    for tupleId in self.tupleIds():
+      with self.latch.shared():
+        t = SlottedPage.getTuple(self, tupleId)
+        if t is not None:
+          yield bytes(t)
+
+  def vacuum(self):
+    with self.latch.exclusive():
+      return super().vacuum()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,7 +1,7 @@
-from io import BytesIO
 import copy, math, struct
 
 from Catalog.Identifiers import TupleId
+from pagecodecs          import getCodec
 
 class PageHeader:
   """
@@ -112,7 +112,12 @@ class PageHeader:
   size      = binrepr.size
 
   # Flag bitmasks
-  dirtyMask = 0b1
+  dirtyMask      = 0b1
+  largeMask      = 0b10
+  compressedMask = 0b100
+
+  # The largest page capacity representable in this header format.
+  maxCapacity = 0xFFFF
 
   # Page header constructor.
   #
@@ -123,14 +128,18 @@ class PageHeader:
   # flags        : a single character byte string indicating the page's status
   # tupleSize    : the tuple size in bytes
   # pageCapacity : the page size in bytes
+  # unpacked     : whether the header was unpacked from 'buffer', which is
+  #                then left unchanged, e.g., when it is read-only
   def __init__(self, **kwargs):
     buffer               = kwargs.get("buffer", None)
     self.flags           = kwargs.get("flags", b'\x00')
     self.tupleSize       = kwargs.get("tupleSize", None)
     self.pageCapacity    = kwargs.get("pageCapacity", len(buffer))
     self.freeSpaceOffset = kwargs.get("freeSpaceOffset", self.size)
-    # Preset the head binary at the beginning of buffer
-    buffer[0: self.headerSize()] = self.pack()
+    # Preset the head binary at the beginning of buffer, unless the header
+    # was unpacked from it, so that unpacking never writes to the buffer.
+    if not kwargs.get("unpacked", False):
+      buffer[0: self.headerSize()] = self.pack()
 
   # Page header equality operation based on header fields.
   def __eq__(self, other):
@@ -207,27 +216,106 @@ class PageHeader:
               self.freeSpaceOffset, self.pageCapacity)
 
   # Constructs a page header object from a binary representation held in a byte string.
+  # Headers stored in the large page format are unpacked as LargePageHeaders.
   @classmethod
   def unpack(cls, buffer):
+    if cls is PageHeader and buffer[0] & PageHeader.largeMask:
+      return LargePageHeader.unpack(buffer)
     values = PageHeader.binrepr.unpack_from(buffer)
     if len(values) == 4:
       return cls(buffer=buffer, flags=values[0], tupleSize=values[1],
-                 freeSpaceOffset=values[2], pageCapacity=values[3])
+                 freeSpaceOffset=values[2], pageCapacity=values[3], unpacked=True)
+
+  # Returns the page header class able to describe pages of the given size.
+  @staticmethod
+  def forPageSize(pageSize):
+    return PageHeader if pageSize <= PageHeader.maxCapacity else LargePageHeader
+
+
+class LargePageHeader(PageHeader):
+  """
+  A page header for pages larger than 64 KB.
+
+  Large page headers hold the same fields as page headers, with the tuple
+  size, free space offset and page capacity stored as unsigned ints rather
+  than unsigned shorts. Large headers are marked by a flag bit, which is
+  clear in the original header format, so that PageHeader.unpack reads pages
+  written in either format.
+
+  >>> import io
+  >>> buffer = io.BytesIO(bytes(1 << 20))
+  >>> ph     = LargePageHeader(buffer=buffer.getbuffer(), tupleSize=16)
+  >>> ph2    = PageHeader.unpack(buffer.getbuffer())
+  >>> type(ph2).__name__, ph == ph2
+  ('LargePageHeader', True)
+  >>> ph2.pageCapacity, ph2.freeSpace() // ph2.tupleSize
+  (1048576, 65535)
+
+  # The large format flag is independent of the dirty bit.
+  >>> ph.setDirty(True)
+  >>> ph.isDirty(), ph.flag(PageHeader.largeMask)
+  (True, True)
+  """
+
+  binrepr     = struct.Struct("cIII")
+  size        = binrepr.size
+  maxCapacity = 0xFFFFFFFF
+
+  def __init__(self, **kwargs):
+    kwargs["flags"] = bytes([ord(kwargs.get("flags", b'\x00')) | PageHeader.largeMask])
+    super().__init__(**kwargs)
+
+  def pack(self):
+    return LargePageHeader.binrepr.pack(
+              self.flags, self.tupleSize,
+              self.freeSpaceOffset, self.pageCapacity)
 
+  @classmethod
+  def unpack(cls, buffer):
+    values = LargePageHeader.binrepr.unpack_from(buffer)
+    return cls(buffer=buffer, flags=values[0], tupleSize=values[1],
+               freeSpaceOffset=values[2], pageCapacity=values[3], unpacked=True)
 
-class Page(BytesIO):
+
+class PageCursor:
+  """
+  An iteration cursor over the tuples of a page.
+
+  A cursor keeps its own position, so any number of cursors may scan the
+  same page independently. Cursors yield each tuple as a memoryview on the
+  page's buffer, in tuple index order.
+  """
+
+  def __init__(self, page):
+    self.page       = page
+    self.tupleIndex = 0
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    t = self.page.getTuple(TupleId(self.page.pageId, self.tupleIndex))
+    if t:
+      self.tupleIndex += 1
+      return t
+    else:
+      raise StopIteration
+
+
+class Page:
   """
   A page class, representing a unit of storage for database tuples.
 
   A page includes a page identifier, and a page header containing metadata
   about the state of the page (e.g., its free space offset).
 
-  Our page class inherits from an io.BytesIO, providing it an implementation
-  of a in-memory binary stream.
-
   The page constructor requires a byte buffer in which we can store tuples.
   The user has the responsibility for constructing a suitable buffer, for
-  example with Python's 'bytes()' builtin.
+  example with Python's 'bytes()' builtin. The page keeps a private copy of
+  this buffer. Alternatively, a page may wrap a writable frame in place, such
+  as a frame of a FrameArena filled directly from a file with 'readinto', in
+  which case no page contents are copied. The page's contents are accessed
+  through 'getbuffer', which returns a memoryview held by the page.
 
   The page also provides several methods to retrieve and modify its contents
   based on a tuple identifier, and where relevant, tuple data represented as
@@ -241,7 +329,8 @@ class Page(BytesIO):
   This is left to the file structure to inject into the page when constructing
   this Python object.
 
-  This class imposes no restriction on the page size.
+  This class imposes no restriction on the page size. Pages larger than 64 KB
+  use a LargePageHeader.
 
   >>> from Catalog.Identifiers import FileId, PageId, TupleId
   >>> from Catalog.Schema      import DBSchema
@@ -302,6 +391,10 @@ class Page(BytesIO):
   >>> [schema.unpack(tup).age for tup in p]
   [28, 20, 22, 24, 26, 28, 30, 32, 34, 36, 38]
 
+  # Iterators are independent of each other.
+  >>> [(schema.unpack(a).id, schema.unpack(b).id) for a in p for b in p][:3]
+  [(1, 1), (1, 0), (1, 1)]
+
   # Test clearing of first tuple
   >>> tId = TupleId(p.pageId, 0)
   >>> sizeBeforeClear = p.header.usedSpace()
@@ -329,6 +422,46 @@ class Page(BytesIO):
   >>> p.header.usedSpace() == (sizeBeforeRemove - p.header.tupleSize)
   True
 
+  # Test batch insertion
+  >>> p.insertTuples([schema.pack(schema.instantiate(i, 2*i+20)) for i in range(10, 13)])
+  [10, 11, 12]
+  >>> [schema.unpack(tup).age for tup in p][-4:]
+  [38, 40, 42, 44]
+
+  # Test bulk page building from consecutive packed tuples
+  >>> data = b''.join(schema.pack(schema.instantiate(i, i)) for i in range(1000))
+  >>> (p4, consumed) = Page.build(pId, schema, data)
+  >>> p4.header.numTuples() == consumed // schema.size == (4096 - p4.header.headerSize()) // schema.size
+  True
+  >>> schema.unpack(p4.getTuple(TupleId(pId, 10)))
+  employee(id=10, age=10)
+
+  # Test large pages
+  >>> (p5, consumed) = Page.build(pId, schema, data * 100, pageSize=1 << 20)
+  >>> consumed // schema.size, type(p5.header).__name__
+  (100000, 'LargePageHeader')
+  >>> p6 = Page.unpack(pId, p5.pack())
+  >>> p6.header == p5.header, schema.unpack(p6.getTuple(TupleId(pId, 99999)))
+  (True, employee(id=999, age=999))
+
+  # Pages provide the binary stream methods of io.BytesIO.
+  >>> _ = p4.seek(p4.header.headerSize())
+  >>> schema.unpack(p4.read(schema.size)), p4.tell() == p4.header.headerSize() + schema.size
+  (employee(id=0, age=0), True)
+  >>> p4.seek(-2, 2)
+  4094
+  >>> p4.write(b'abc')
+  Traceback (most recent call last):
+  ...
+  ValueError: Write past the end of a 4096 byte page
+
+  # Test compressed page images
+  >>> image = p4.packCompressed('zlib')
+  >>> len(image) < len(p4.pack()), Page.unpack(pId, image).pack() == p4.pack()
+  (True, True)
+  >>> Page.unpack(pId, p5.packCompressed('nulrun')).header == p5.header
+  True
+
   """
 
   headerClass = PageHeader
@@ -339,14 +472,18 @@ class Page(BytesIO):
   #
   # Constructors keyword arguments, with defaults if not present:
   # buffer       : a byte string of initial page contents.
+  # frame        : a writable buffer holding the page, used in place of a
+  #                copy of 'buffer'.
   # pageId       : a PageId instance identifying this page.
   # header       : a PageHeader instance.
   # schema       : the schema for tuples to be stored in the page.
   # Also, any keyword arguments needed to construct a PageHeader.
   def __init__(self, **kwargs):
     buffer = kwargs.get("buffer", None)
-    if buffer:
-      BytesIO.__init__(self, buffer)
+    frame  = kwargs.get("frame", None)
+    if frame is not None or buffer:
+      self.buffer   = memoryview(frame if frame is not None else bytearray(buffer))
+      self.position = 0
       self.pageId = kwargs.get("pageId", None)
       header      = kwargs.get("header", None)
       schema      = kwargs.get("schema", None)
@@ -363,26 +500,73 @@ class Page(BytesIO):
       raise ValueError("No backing buffer provided to page constructor.")
 
 
+  # Returns a memoryview over the page's contents.
+  def getbuffer(self):
+    return self.buffer
+
+  # Returns a copy of the page's contents.
+  def getvalue(self):
+    return self.buffer.tobytes()
+
+  # Binary stream methods, as provided by io.BytesIO, over the page's
+  # contents. Pages have a fixed size, so writes cannot extend them.
+
+  def read(self, size=-1):
+    end  = len(self.buffer) if size is None or size < 0 else min(len(self.buffer), self.position + size)
+    data = self.buffer[self.position: end].tobytes()
+    self.position = max(self.position, end)
+    return data
+
+  def readinto(self, b):
+    data = self.read(len(b))
+    b[: len(data)] = data
+    return len(data)
+
+  def write(self, b):
+    data = memoryview(b).cast('B')
+    end  = self.position + len(data)
+    if end > len(self.buffer):
+      raise ValueError("Write past the end of a %d byte page" % len(self.buffer))
+    self.buffer[self.position: end] = data
+    self.position = end
+    return len(data)
+
+  def seek(self, offset, whence=0):
+    base = { 0: 0, 1: self.position, 2: len(self.buffer) }[whence]
+    if base + offset < 0:
+      raise ValueError("Negative seek position %d" % (base + offset))
+    self.position = base + offset
+    return self.position
+
+  def tell(self):
+    return self.position
+
+  def readable(self):
+    return True
+
+  def writable(self):
+    return not self.buffer.readonly
+
+  def seekable(self):
+    return True
+
   # Header constructor. This can be overridden by subclasses.
   def initializeHeader(self, **kwargs):
     schema = kwargs.get("schema", None)
     if schema:
-      return PageHeader(buffer=self.getbuffer(), tupleSize=schema.size)
+      buffer = self.getbuffer()
+      return PageHeader.forPageSize(len(buffer))(buffer=buffer, tupleSize=schema.size,
+                                                 pageCapacity=kwargs.get("pageCapacity", len(buffer)))
     else:
       raise ValueError("No schema provided when constructing a page.")
 
-  # Iterator
+  # Iterator. Each iteration uses its own cursor, so scans may be nested.
   def __iter__(self):
-    self.iterTupleIdx = 0
-    return self
+    return PageCursor(self)
 
-  def __next__(self):
-    t = self.getTuple(TupleId(self.pageId, self.iterTupleIdx))
-    if t:
-      self.iterTupleIdx += 1
-      return t
-    else:
-      raise StopIteration
+  # Returns the tuple ids of all tuples in the page, in page order.
+  def tupleIds(self):
+    return [TupleId(self.pageId, i) for i in range(self.header.numTuples())]
 
   # Dirty bit accessors
   def isDirty(self):
@@ -425,7 +609,48 @@ class Page(BytesIO):
     else: 
       raise ValueError("No enough memory for insertion!")
 
-    
+  # Returns the number of additional tuples that fit in the page.
+  def tupleCapacity(self):
+    return self.header.freeSpace() // self.header.tupleSize
+
+  # Adds a sequence of packed tuples to the page.
+  # Returns the tuple indexes assigned to the new tuples.
+  def insertTuples(self, tuples):
+    return self.insertPackedTuples(b''.join(tuples))
+
+  # Adds consecutive packed tuples held in a single bytes-like object, with one
+  # contiguous copy into the page's data region. Either all tuples are added,
+  # or none are. Returns a list of the tuple indexes assigned to the new tuples.
+  def insertPackedTuples(self, data):
+    tupleSize  = self.header.tupleSize
+    (count, r) = divmod(len(data), tupleSize)
+    if r:
+      raise ValueError("Packed tuples are not a multiple of the tuple size")
+    if count > self.tupleCapacity():
+      raise ValueError("No enough memory for insertion!")
+
+    first = self.header.numTuples()
+    start = self.header.freeSpaceOffset
+    self.getbuffer()[start: start + len(data)] = data
+    self.header.freeSpaceOffset += len(data)
+    self.setDirty(True)
+    return list(range(first, first + count))
+
+  # Bulk page builder. Constructs a page holding as many of the consecutive
+  # packed tuples in 'data' as fit. Returns a pair of the page and the number
+  # of bytes of 'data' that were consumed. With 'frame', the page is built in
+  # that zero-filled writable buffer of 'pageSize' bytes, e.g., to reuse one
+  # frame for every page of a bulk load.
+  @classmethod
+  def build(cls, pageId, schema, data, pageSize=4096, frame=None):
+    if frame is not None:
+      page = cls(pageId=pageId, frame=frame, schema=schema)
+    else:
+      page = cls(pageId=pageId, buffer=bytes(pageSize), schema=schema)
+    count = min(len(data) // schema.size, page.tupleCapacity())
+    page.insertPackedTuples(data[: count * schema.size])
+    return (page, count * schema.size)
+
 
   # Zeroes out the contents of the tuple at the given tuple id.
   def clearTuple(self, tupleId):
@@ -433,8 +658,7 @@ class Page(BytesIO):
     if tupleIndex < self.header.numTuples():
       start = tupleIndex * self.header.tupleSize + self.header.headerSize()
       end = start + self.header.tupleSize
-      for i in range(start, end):
-        self.getbuffer()[i] = 0
+      self.getbuffer()[start: end] = bytes(end - start)
       self.setDirty(True)
     else:
       return None
@@ -445,10 +669,9 @@ class Page(BytesIO):
     if tupleIndex < self.header.numTuples():
       start = tupleIndex * self.header.tupleSize + self.header.headerSize()
       end = start + self.header.tupleSize
-      for i in range(0, self.header.numTuples() - tupleIndex):
-        shift = i*self.header.tupleSize
-        shift1 = (i+1) * self.header.tupleSize
-        self.getbuffer()[start+shift : end+shift] = self.getbuffer()[start+shift1 : end+shift1]
+      used = self.header.freeSpaceOffset
+      buffer = self.getbuffer()
+      buffer[start: used - self.header.tupleSize] = buffer[end: used]
       self.header.freeSpaceOffset -= self.header.tupleSize
       self.setDirty(True)
     else:
@@ -458,15 +681,63 @@ class Page(BytesIO):
   # This should refresh the binary representation of the page header contained
   # within the page by packing the header in place.
   def pack(self):
+    return self.packView().tobytes()
+
+  # Returns the binary representation of this page as a memoryview over the
+  # page's buffer, refreshing the page header in place without copying the
+  # page. E.g., for writing the page to a file.
+  def packView(self):
     self.getbuffer()[0: self.header.headerSize()] = self.header.pack()
-    return self.getvalue()
+    return self.getbuffer()
+
+  # Compressed page images: the page header, flagged as compressed, followed
+  # by the codec id, the length of the page body and the length of the
+  # compressed body, and the page body compressed by the codec.
+  compressedFrame = struct.Struct("<BII")
+
+  # Returns a compressed binary representation of this page, with the page body
+  # compressed by the given codec, or codec name (see pagecodecs.py).
+  # The page header is left uncompressed.
+  def packCompressed(self, codec):
+    codec      = getCodec(codec)
+    view       = self.packView()
+    headerSize = self.header.headerSize()
+    header     = bytearray(view[0: headerSize])
+    header[0] |= PageHeader.compressedMask
+    payload    = codec.compress(view[headerSize:])
+    return b''.join((header,
+                     Page.compressedFrame.pack(codec.id, len(view) - headerSize, len(payload)),
+                     payload))
+
+  # Returns the uncompressed page image held in a compressed binary representation.
+  @classmethod
+  def decompressImage(cls, buffer):
+    image      = bytearray(buffer)
+    headerSize = cls.headerClass.unpack(memoryview(image)).headerSize()
+    (codecId, bodySize, payloadSize) = Page.compressedFrame.unpack_from(image, headerSize)
+    start      = headerSize + Page.compressedFrame.size
+    body       = getCodec(codecId).decompress(image[start: start + payloadSize], bodySize)
+    if len(body) != bodySize:
+      raise ValueError("Corrupt compressed page: expected %d body bytes, found %d" % (bodySize, len(body)))
+    image[headerSize:] = body
+    image[0] &= ~PageHeader.compressedMask
+    return image
 
   # Creates a Page instance from the binary representation held in the buffer.
   # The pageId of the newly constructed Page instance is given as an argument.
+  # Compressed representations, as produced by packCompressed, are decompressed.
   @classmethod
   def unpack(cls, pageId, buffer):
-    header = cls.headerClass.unpack( BytesIO(buffer).getbuffer() )
-    return cls(pageId = pageId, header = header, buffer = buffer)
+    if buffer[0] & PageHeader.compressedMask:
+      return cls.wrap(pageId, cls.decompressImage(buffer))
+    return cls.wrap(pageId, bytearray(buffer))
+
+  # Creates a Page instance in place over a writable frame holding a page's
+  # binary representation, parsing its header directly from the frame.
+  @classmethod
+  def wrap(cls, pageId, frame):
+    view = memoryview(frame)
+    return cls(pageId=pageId, frame=view, header=cls.headerClass.unpack(view))
 
 
 if __name__ == "__main__":
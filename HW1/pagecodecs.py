@@ -0,0 +1,166 @@
+import bz2, lzma, re, struct, zlib
+
+class Codec:
+  """
+  A compression codec for page bodies.
+
+  Codecs are identified in compressed page images by a one-byte id, so ids
+  must never be reused. Decompression is given the length of the original
+  data, which codecs may use to preallocate their output.
+
+  >>> data = b'abc' + bytes(100) + b'de' * 20 + bytes(5000)
+  >>> [(c.name, len(c.compress(data)) < len(data), c.decompress(c.compress(data), len(data)) == data)
+  ...    for c in codecs.values()]
+  [('none', False, True), ('zlib', True, True), ('zlib-fast', True, True), ('lzma', True, True), ('bz2', True, True), ('nulrun', True, True)]
+  >>> getCodec('zlib') is getCodec(1)
+  True
+  """
+
+  def __init__(self, codecId, name):
+    self.id   = codecId
+    self.name = name
+
+  def compress(self, data):
+    return bytes(data)
+
+  def decompress(self, data, length):
+    return bytes(data)
+
+  def __repr__(self):
+    return "Codec(%d, %r)" % (self.id, self.name)
+
+
+class ZlibCodec(Codec):
+  def __init__(self, codecId, name, level):
+    super().__init__(codecId, name)
+    self.level = level
+
+  def compress(self, data):
+    return zlib.compress(data, self.level)
+
+  def decompress(self, data, length):
+    return zlib.decompress(data, bufsize=max(length, 1))
+
+
+class LzmaCodec(Codec):
+  def compress(self, data):
+    return lzma.compress(data, format=lzma.FORMAT_RAW, filters=self.filters)
+
+  def decompress(self, data, length):
+    return lzma.decompress(data, format=lzma.FORMAT_RAW, filters=self.filters)
+
+  filters = [{ 'id': lzma.FILTER_LZMA2, 'preset': 1 }]
+
+
+class Bz2Codec(Codec):
+  def compress(self, data):
+    return bz2.compress(data, 9)
+
+  def decompress(self, data, length):
+    return bz2.decompress(data)
+
+
+class NulRunCodec(Codec):
+  """
+  A cheap run-length encoding of NUL bytes, e.g., the padding of fixed-width
+  text columns and the free space of pages.
+
+  Data is encoded as a sequence of tokens, each holding a number of literal
+  bytes and a number of NUL bytes following them, and followed by the
+  literal bytes. Only runs of at least 'minRun' NULs are encoded as runs.
+
+  >>> c = NulRunCodec(5, 'nulrun')
+  >>> c.compress(b'ab' + bytes(10) + b'c\\x00d')
+  b'\\x02\\x00\\n\\x00ab\\x03\\x00\\x00\\x00c\\x00d'
+  >>> c.decompress(c.compress(bytes(200000)), 200000) == bytes(200000)
+  True
+
+  # Decoding is bounded by the expected length.
+  >>> c.decompress(c.token.pack(0, 60000), 100)
+  Traceback (most recent call last):
+  ...
+  ValueError: Corrupt NUL-run data: token exceeds 100 bytes
+  >>> c.decompress(c.compress(b'abc'), 4)
+  Traceback (most recent call last):
+  ...
+  ValueError: Corrupt NUL-run data: expected 4 bytes, found 3
+  """
+
+  token    = struct.Struct("<HH")
+  maxToken = 0xFFFF
+  minRun   = token.size + 1
+
+  def __init__(self, codecId, name):
+    super().__init__(codecId, name)
+    self.runs = re.compile(b'\x00{%d,}' % self.minRun)
+
+  def emit(self, parts, literal, run):
+    while len(literal) > self.maxToken:
+      parts.append(self.token.pack(self.maxToken, 0))
+      parts.append(literal[: self.maxToken])
+      literal = literal[self.maxToken:]
+    while run > self.maxToken:
+      parts.append(self.token.pack(len(literal), self.maxToken))
+      parts.append(literal)
+      (literal, run) = (b'', run - self.maxToken)
+    if literal or run:
+      parts.append(self.token.pack(len(literal), run))
+      parts.append(literal)
+
+  def compress(self, data):
+    data  = bytes(data)
+    parts = []
+    pos   = 0
+    for m in self.runs.finditer(data):
+      self.emit(parts, data[pos: m.start()], m.end() - m.start())
+      pos = m.end()
+    self.emit(parts, data[pos:], 0)
+    return b''.join(parts)
+
+  # Decodes into a buffer of 'length' bytes, rejecting tokens that would run
+  # past it, so corrupt data cannot expand beyond the expected output.
+  def decompress(self, data, length):
+    out    = bytearray(length)
+    unpack = self.token.unpack_from
+    pos    = 0
+    size   = 0
+    while pos < len(data):
+      if pos + self.token.size > len(data):
+        raise ValueError("Corrupt NUL-run data: truncated token")
+      (literal, run) = unpack(data, pos)
+      pos += self.token.size
+      if pos + literal > len(data) or size + literal + run > length:
+        raise ValueError("Corrupt NUL-run data: token exceeds %d bytes" % length)
+      out[size: size + literal] = data[pos: pos + literal]
+      size += literal + run
+      pos  += literal
+    if size != length:
+      raise ValueError("Corrupt NUL-run data: expected %d bytes, found %d" % (length, size))
+    return bytes(out)
+
+
+# Registered codecs, by id.
+codecs = { c.id: c for c in (Codec(0, 'none'),
+                             ZlibCodec(1, 'zlib', 6),
+                             ZlibCodec(2, 'zlib-fast', 1),
+                             LzmaCodec(3, 'lzma'),
+                             Bz2Codec(4, 'bz2'),
+                             NulRunCodec(5, 'nulrun')) }
+
+# Returns a codec given its id, name, or the codec itself.
+def getCodec(codec):
+  if isinstance(codec, Codec):
+    return codec
+  if isinstance(codec, int):
+    if codec in codecs:
+      return codecs[codec]
+  else:
+    for c in codecs.values():
+      if c.name == codec:
+        return c
+  raise ValueError("Unknown page codec: %r" % (codec,))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
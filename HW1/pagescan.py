@@ -0,0 +1,89 @@
+import numpy as np
+
+from slottedpage import SlottedPage
+from structformat import dtypeSpec
+
+# Returns a NumPy structured dtype matching the packed tuples of 'schema'.
+# Field offsets follow the alignment rules of the schema's struct format.
+def schemaDtype(schema):
+  return np.dtype(dtypeSpec(schema.binrepr.format, schema.fields, schema.size))
+
+# Returns the tuples of a page as a NumPy structured array.
+#
+# For pages storing fixed-size tuples contiguously after the header, the
+# array is a writeable view over the page's buffer, and no data is copied.
+# Slotted pages may hold their live tuples out of slot order and around
+# holes, so their tuples are gathered into a new array in slot order.
+def tupleArray(page, dtype):
+  header = page.header
+  buffer = page.getbuffer()
+  if isinstance(page, SlottedPage):
+    region  = np.frombuffer(buffer, dtype=np.uint8)
+    offsets = np.array([header.slots[t.tupleIndex][0] for t in page.tupleIds()], dtype=np.intp)
+    rows    = region[offsets[:, None] + np.arange(dtype.itemsize)]
+    return rows.view(dtype).reshape(len(offsets))
+  return np.frombuffer(buffer, dtype=dtype, count=header.numTuples(), offset=header.headerSize())
+
+
+class PageScan:
+  """
+  A vectorized scan over a sequence of pages.
+
+  Instead of yielding tuples one at a time, a page scan yields one NumPy
+  structured array per page, with a field per schema attribute. Predicates
+  and projections are evaluated on whole pages at once. Each scan is an
+  independent cursor over its pages, so scans can be run concurrently or
+  nested without interfering.
+
+  >>> from Catalog.Identifiers import FileId, PageId
+  >>> from Catalog.Schema      import DBSchema
+  >>> from page                import Page
+
+  # Test harness setup.
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> pages  = []
+  >>> for i in range(3):
+  ...   p = Page(pageId=PageId(FileId(1), i), buffer=bytes(4096), schema=schema)
+  ...   _ = p.insertTuples([schema.pack(schema.instantiate(10*i+j, 20+j)) for j in range(10)])
+  ...   pages.append(p)
+
+  # Page arrays are views over the page buffers.
+  >>> batch = tupleArray(pages[0], schemaDtype(schema))
+  >>> batch['id'].tolist()
+  [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+  >>> batch['age'][0] = 99
+  >>> schema.unpack(pages[0].getTuple(pages[0].tupleIds()[0]))
+  employee(id=0, age=99)
+
+  # Predicates are evaluated per page.
+  >>> scan = PageScan(pages, schema)
+  >>> [int(b['id'].sum()) for b in scan.filter(lambda b: b['age'] > 27)]
+  [17, 37, 57]
+  >>> sum(len(b) for b in scan)
+  30
+  """
+
+  def __init__(self, pages, schema):
+    self.pages  = pages
+    self.schema = schema
+    self.dtype  = schemaDtype(schema)
+
+  def __iter__(self):
+    for page in self.pages:
+      yield tupleArray(page, self.dtype)
+
+  # Yields, per page, the tuples satisfying a vectorized predicate, which maps
+  # a structured array to a boolean mask.
+  def filter(self, predicate):
+    for batch in self:
+      yield batch[predicate(batch)]
+
+  # Yields, per page, arrays of the given fields.
+  def project(self, *fields):
+    for batch in self:
+      yield batch[list(fields)]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,182 @@
+import os, shutil, tempfile, time
+from concurrent.futures import ProcessPoolExecutor
+
+from Catalog.Identifiers import FileId, PageId
+from page import Page
+from heapfile import HeapFile
+from structformat import parseCsvLine
+
+# Size of the chunks read by each worker from its byte range of the CSV file.
+chunkSize = 8 << 20
+
+class RecordSchema:
+  """
+  A minimal schema for pages holding packed records of a record class, such
+  as warmup.Lineitem or warmup.Orders. Pages only require a schema's size,
+  while operators decoding fields use its struct and field names.
+  """
+
+  def __init__(self, recordClass):
+    self.recordClass = recordClass
+    self.size        = recordClass.byteSize()
+    self.binrepr     = recordClass.binrepr
+    self.fields      = recordClass.columns
+
+# Splits a file into at most 'numRanges' (start, end) byte ranges, each
+# beginning at the start of a line.
+def lineRanges(inPath, numRanges):
+  size   = os.path.getsize(inPath)
+  bounds = [0]
+  with open(inPath, 'rb') as f:
+    for i in range(1, numRanges):
+      f.seek(max(size * i // numRanges, bounds[-1]))
+      if f.tell() > 0:
+        f.seek(f.tell() - 1)
+        f.readline()
+      if f.tell() > bounds[-1] and f.tell() < size:
+        bounds.append(f.tell())
+  bounds.append(size)
+  return list(zip(bounds, bounds[1:]))
+
+# Yields the lines in a byte range of a file, reading it in large chunks.
+def readLines(inPath, start, end):
+  with open(inPath, 'rb') as f:
+    f.seek(start)
+    remaining = end - start
+    partial   = b''
+    while remaining > 0:
+      chunk      = f.read(min(chunkSize, remaining))
+      remaining -= len(chunk)
+      if not chunk:
+        break
+      lines   = (partial + chunk).split(b'\n')
+      partial = lines.pop()
+      yield from lines
+    if partial:
+      yield partial
+
+# Parses and packs a byte range of a CSV file in a worker process, writing the
+# resulting page images to 'partPath'. Page indexes are local to the part.
+# Returns a triple of the number of rows, the number of pages, and the local
+# indexes of pages that are not full.
+def loadRange(inPath, start, end, recordClass, delim, pageSize, pageClass, partPath):
+  schema   = RecordSchema(recordClass)
+  sep      = delim.encode()
+  casts    = recordClass.fieldTypes
+  packInto = recordClass.binrepr.pack_into
+  rowSize  = schema.size
+
+  # Determine how many rows fit on a page of this class.
+  perPage  = pageClass.build(PageId(FileId(0), 0), schema, bytes(pageSize), pageSize)[1] // rowSize
+  if perPage == 0:
+    raise ValueError("Records do not fit in a page")
+  buf      = bytearray(perPage * rowSize)
+  frame    = bytearray(pageSize)
+  zeros    = bytes(pageSize)
+
+  numRows  = 0
+  pages    = 0
+  partial  = []
+
+  with open(partPath, 'wb') as out:
+    def emit(length):
+      nonlocal pages
+      frame[:]  = zeros
+      (page, _) = pageClass.build(PageId(FileId(0), pages), schema,
+                                  memoryview(buf)[:length], pageSize, frame)
+      if page.header.hasFreeTuple():
+        partial.append(pages)
+      out.write(page.packView())
+      pages += 1
+
+    offset = 0
+    for line in readLines(inPath, start, end):
+      values = parseCsvLine(line, sep, casts)
+      if values is None:
+        continue
+      packInto(buf, offset, *values)
+      offset  += rowSize
+      numRows += 1
+      if offset == len(buf):
+        emit(offset)
+        offset = 0
+    if offset:
+      emit(offset)
+
+  return (numRows, pages, partial)
+
+# Parallel CSV ingestion into a heap file.
+#
+# The CSV file is split at line boundaries into one byte range per worker.
+# Each worker process parses and packs its range into ready-made page images
+# in a temporary part file. The parts are then concatenated in order behind a
+# heap file header, so every page lands at the position its PageId implies,
+# and the free-space map is written from the workers' partially-full pages.
+#
+# Returns a dictionary of load statistics.
+def parallelLoad(inPath, outPath, recordClass, **kwargs):
+  """
+  >>> import os, sys, tempfile
+  >>> sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+  >>> import warmup
+
+  >>> d = tempfile.mkdtemp()
+  >>> with open(os.path.join(d, 'orders.csv'), 'w') as f:
+  ...   for i in range(1000):
+  ...     _ = f.write('%d|370|O|172799.49|1996-01-02|5-LOW|Clerk#000000951|0|comment %d|\\n' % (i, i))
+  >>> stats = parallelLoad(os.path.join(d, 'orders.csv'), os.path.join(d, 'orders.heap'),
+  ...                      warmup.Orders, workers=4, pageSize=4096)
+  >>> stats['rows'], stats['pages']
+  (1000, 36)
+
+  >>> schema = RecordSchema(warmup.Orders)
+  >>> with HeapFile(os.path.join(d, 'orders.heap'), FileId(1), schema=schema) as hf:
+  ...   keys = [warmup.Orders.binrepr.unpack(t)[0] for (_, t) in hf.scan()]
+  ...   keys == list(range(1000)), len(hf.freePages)
+  (True, 4)
+  """
+  workers   = kwargs.get("workers", None) or os.cpu_count() or 1
+  delim     = kwargs.get("delim", '|')
+  pageSize  = kwargs.get("pageSize", HeapFile.defaultPageSize)
+  pageClass = kwargs.get("pageClass", Page)
+
+  start   = time.perf_counter()
+  ranges  = lineRanges(inPath, workers)
+  tempDir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outPath)))
+  try:
+    parts = [os.path.join(tempDir, 'part%d' % i) for i in range(len(ranges))]
+    with ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+      futures = [pool.submit(loadRange, inPath, s, e, recordClass, delim,
+                             pageSize, pageClass, part)
+                   for ((s, e), part) in zip(ranges, parts)]
+      results = [f.result() for f in futures]
+
+    # Stitch the parts into one heap file, and build its free-space map.
+    numPages = sum(pages for (_, pages, _) in results)
+    fsm      = bytearray((numPages + 7) // 8)
+    base     = 0
+    with open(outPath, 'wb') as out:
+      out.write(HeapFile.binrepr.pack(HeapFile.magic, pageSize, 0).ljust(pageSize, b'\x00'))
+      for (part, (_, pages, partial)) in zip(parts, results):
+        with open(part, 'rb') as f:
+          shutil.copyfileobj(f, out, chunkSize)
+        for i in partial:
+          fsm[(base + i) >> 3] |= 1 << ((base + i) & 7)
+        base += pages
+    with open(outPath + '.fsm', 'wb') as f:
+      f.write(fsm)
+  finally:
+    shutil.rmtree(tempDir)
+
+  seconds = time.perf_counter() - start
+  numRows = sum(rows for (rows, _, _) in results)
+  return { 'rows'       : numRows,
+           'pages'      : numPages,
+           'workers'    : len(ranges),
+           'seconds'    : seconds,
+           'rowsPerSec' : numRows / seconds if seconds > 0 else float('inf') }
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
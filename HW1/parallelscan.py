@@ -0,0 +1,113 @@
+import mmap, os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import reduce
+
+from Catalog.Identifiers import FileId, PageId
+from page import Page
+from heapfile import HeapFile
+
+# Returns the page size and number of pages of a heap file.
+def heapFileLayout(filePath):
+  with open(filePath, 'rb') as f:
+    (magic, pageSize, _) = HeapFile.binrepr.unpack(f.read(HeapFile.binrepr.size))
+    if magic != HeapFile.magic:
+      raise ValueError("Not a heap file: " + filePath)
+    return (pageSize, f.seek(0, 2) // pageSize - 1)
+
+# Splits 'numPages' pages into at most 'numRanges' contiguous (start, end) ranges.
+def pageRanges(numPages, numRanges):
+  numRanges = max(1, min(numRanges, numPages))
+  step      = -(-numPages // numRanges)
+  return [(start, min(start + step, numPages)) for start in range(0, numPages, step)]
+
+# Scans a non-empty range of pages of a heap file through a read-only memory
+# map. Applies 'fn' to each page, and merges the results with 'combine'.
+# Pages are wrapped in place over the map, and unpacking their headers does
+# not write to it, so pages are neither copied nor writable, and 'fn' must
+# not modify or keep them.
+# This is module-level so that it can run in a worker process.
+def scanRange(filePath, fileId, pageClass, start, end, fn, combine):
+  pageSize = heapFileLayout(filePath)[0]
+  with open(filePath, 'rb') as f:
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+      view = memoryview(mapped)
+      page = None
+      try:
+        for pageIndex in range(start, end):
+          offset = (pageIndex + 1) * pageSize
+          page   = pageClass.wrap(PageId(fileId, pageIndex), view[offset: offset + pageSize])
+          value  = fn(page)
+          result = value if pageIndex == start else combine(result, value)
+      finally:
+        del page
+        view.release()
+  return result
+
+# Parallel scan driver.
+#
+# Splits the pages of a heap file into contiguous ranges, and scans each range
+# in a worker. Workers compute a partial aggregate by applying 'fn' to every
+# page and merging the results with 'combine'. The partial aggregates are
+# then merged in page order, starting from 'initial', so 'initial' is
+# combined exactly once and need not be an identity of 'combine', which
+# must however be associative. An empty file yields 'initial'.
+#
+# With 'processes' set, ranges are scanned in a process pool. Each worker
+# process maps the heap file itself, so pages are shared through the OS page
+# cache rather than copied between processes, and 'fn' and 'combine' must be
+# picklable (e.g., module-level functions). Otherwise a thread pool is used,
+# which scales for functions that release the GIL, such as NumPy kernels.
+#
+# Dirty pages held in a buffer pool are not visible to a parallel scan, so
+# heap files should be flushed before they are scanned.
+def parallelScan(filePath, fn, combine, initial, **kwargs):
+  """
+  >>> import tempfile, os, operator
+  >>> from Catalog.Schema import DBSchema
+
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> path   = os.path.join(tempfile.mkdtemp(), 'employee.heap')
+  >>> with HeapFile(path, FileId(1), schema=schema, pageSize=256) as hf:
+  ...   hf.bulkLoad([b''.join(schema.pack(schema.instantiate(i, i)) for i in range(1000))])
+  1000
+
+  >>> parallelScan(path, countTuples, operator.add, 0, workers=4)
+  1000
+  >>> parallelScan(path, countTuples, operator.add, 0, workers=4, processes=True)
+  1000
+
+  # The initial value is combined once, whatever the number of workers.
+  >>> [parallelScan(path, countTuples, operator.add, 10, workers=w) for w in (1, 4, 64)]
+  [1010, 1010, 1010]
+
+  # Pages are read-only views over the shared file mapping.
+  >>> parallelScan(path, lambda page: page.getbuffer().readonly, operator.and_, True, workers=4)
+  True
+  >>> parallelScan(path, lambda page: [page.pageId.pageIndex], operator.add, [-1], workers=4)[:4]
+  [-1, 0, 1, 2]
+  """
+  fileId    = kwargs.get("fileId", FileId(0))
+  pageClass = kwargs.get("pageClass", Page)
+  workers   = kwargs.get("workers", None) or os.cpu_count() or 1
+  processes = kwargs.get("processes", False)
+
+  (_, numPages) = heapFileLayout(filePath)
+  ranges        = pageRanges(numPages, workers)
+  if not ranges:
+    return initial
+
+  executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+  with executor(max_workers=len(ranges)) as pool:
+    futures = [pool.submit(scanRange, filePath, fileId, pageClass,
+                           start, end, fn, combine)
+                 for (start, end) in ranges]
+    return reduce(combine, (f.result() for f in futures), initial)
+
+# Page function counting the tuples of a page.
+def countTuples(page):
+  return page.header.numTuples()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,158 @@
+import os, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from Catalog.Identifiers import FileId, PageId
+from page import Page
+from parallelscan import heapFileLayout
+
+# Reads and unpacks a page of a heap file with a positioned read, which does
+# not share a file offset, so any number of reads may run concurrently.
+def readPage(fd, pageSize, fileId, pageClass, pageIndex):
+  data = os.pread(fd, pageSize, (pageIndex + 1) * pageSize)
+  if len(data) != pageSize:
+    raise ValueError("No such page: %d" % pageIndex)
+  return pageClass.unpack(PageId(fileId, pageIndex), data)
+
+# Asks the OS to drop a file's cached pages, e.g., to benchmark cold scans.
+# Returns whether this is supported on this platform.
+def dropCache(filePath):
+  if not hasattr(os, 'posix_fadvise'):
+    return False
+  fd = os.open(filePath, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+  finally:
+    os.close(fd)
+  return True
+
+
+class PrefetchScan:
+  """
+  A sequential page scan over a heap file, with asynchronous read-ahead.
+
+  While the consumer processes the current page, a thread pool reads and
+  unpacks a window of upcoming pages, so that waiting on I/O overlaps with
+  processing in Python. Pages are yielded in file order. A scan with a
+  window of 0 reads each page synchronously when it is requested.
+
+  Each iteration counts in 'stats' the pages yielded, and the stalls where
+  the consumer had to wait for a page that was not yet loaded, along with
+  the time spent waiting.
+
+  Pages are read directly from the file, bypassing any buffer pool, so heap
+  files should be flushed before they are scanned.
+
+  >>> import tempfile, os
+  >>> from Catalog.Schema import DBSchema
+  >>> from heapfile       import HeapFile
+
+  # Test harness setup.
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> path   = os.path.join(tempfile.mkdtemp(), 'employee.heap')
+  >>> with HeapFile(path, FileId(1), schema=schema, pageSize=256) as hf:
+  ...   hf.bulkLoad([b''.join(schema.pack(schema.instantiate(i, i)) for i in range(1000))])
+  1000
+
+  # Pages are yielded in order, whatever the window.
+  >>> scan = PrefetchScan(path, window=4, workers=2)
+  >>> [schema.unpack(t).id for page in scan for t in page] == list(range(1000))
+  True
+  >>> scan.stats['pages'], scan.stats['stalls'] <= scan.stats['pages']
+  (33, True)
+
+  # Without a window, the consumer waits on every page.
+  >>> scan = PrefetchScan(path, window=0)
+  >>> sum(page.header.numTuples() for page in scan), scan.stats['stalls']
+  (1000, 33)
+
+  # Scans may cover a range of pages.
+  >>> [page.pageId.pageIndex for page in PrefetchScan(path, start=30)]
+  [30, 31, 32]
+  """
+
+  # Prefetching scan constructor.
+  #
+  # fileId       : the FileId given to the scanned pages
+  # pageClass    : the Page class used to unpack pages
+  # window       : the number of pages read ahead of the consumer
+  # workers      : the number of reader threads
+  # start, end   : the range of page indexes to scan, by default all pages
+  def __init__(self, filePath, **kwargs):
+    self.filePath  = filePath
+    self.fileId    = kwargs.get("fileId", FileId(0))
+    self.pageClass = kwargs.get("pageClass", Page)
+    self.window    = kwargs.get("window", 8)
+    self.workers   = kwargs.get("workers", 2)
+    self.start     = kwargs.get("start", 0)
+    self.end       = kwargs.get("end", None)
+    self.stats     = {}
+
+  def __iter__(self):
+    (pageSize, numPages) = heapFileLayout(self.filePath)
+    end        = numPages if self.end is None else min(self.end, numPages)
+    self.stats = { 'pages': 0, 'stalls': 0, 'stallSeconds': 0.0, 'seconds': 0.0 }
+    start      = time.perf_counter()
+    fd         = os.open(self.filePath, os.O_RDONLY)
+    try:
+      if self.window > 0:
+        yield from self.prefetch(fd, pageSize, end)
+      else:
+        for pageIndex in range(self.start, end):
+          waitStart = time.perf_counter()
+          page      = readPage(fd, pageSize, self.fileId, self.pageClass, pageIndex)
+          self.recordStall(waitStart)
+          self.stats['pages'] += 1
+          yield page
+    finally:
+      os.close(fd)
+      self.stats['seconds'] = time.perf_counter() - start
+
+  # Yields pages while keeping up to 'window' upcoming page reads in flight.
+  def prefetch(self, fd, pageSize, end):
+    pending   = deque()
+    pageIndex = self.start
+    with ThreadPoolExecutor(max_workers=self.workers) as pool:
+      try:
+        while pageIndex < end or pending:
+          while pageIndex < end and len(pending) < self.window:
+            pending.append(pool.submit(readPage, fd, pageSize, self.fileId,
+                                       self.pageClass, pageIndex))
+            pageIndex += 1
+          future = pending.popleft()
+          if not future.done():
+            waitStart = time.perf_counter()
+            future.result()
+            self.recordStall(waitStart)
+          self.stats['pages'] += 1
+          yield future.result()
+      finally:
+        # Abandon reads ahead of a consumer that stopped early.
+        for future in pending:
+          future.cancel()
+
+  def recordStall(self, waitStart):
+    self.stats['stalls']       += 1
+    self.stats['stallSeconds'] += time.perf_counter() - waitStart
+
+# Compares a scan applying 'fn' to every page of a heap file, with and
+# without read-ahead. With 'coldCache', the file is dropped from the OS page
+# cache before each scan, so page reads wait on the device.
+# Returns a list of the scans' statistics.
+def compareScans(filePath, fn, windows=(0, 8, 32), **kwargs):
+  coldCache = kwargs.pop("coldCache", True)
+  results   = []
+  for window in windows:
+    if coldCache:
+      dropCache(filePath)
+    scan = PrefetchScan(filePath, window=window, **kwargs)
+    for page in scan:
+      fn(page)
+    results.append(dict(scan.stats, window=window))
+  return results
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,91 @@
+import os, shutil, sys, tempfile, time
+
+from Catalog.Identifiers import FileId
+from heapfile import HeapFile
+
+# Page sizes compared by default, from the default heap file page size up to
+# large pages using the LargePageHeader format.
+defaultPageSizes = (4096, 16 << 10, 64 << 10, 256 << 10, 1 << 20)
+
+# Measures sequential scans of a heap file.
+#
+# Two scans are timed: a page scan, reading and unpacking every page directly
+# from the file and counting its tuples, and a tuple scan through the heap
+# file's buffer pool. The file is likely to be resident in the OS page cache,
+# so these measure the per-page and per-tuple costs of the storage layer
+# rather than of the device.
+#
+# Returns a dictionary of scan statistics.
+def scanThroughput(filePath, schema, **kwargs):
+  poolPages = kwargs.get("poolPages", 8)
+  with HeapFile(filePath, FileId(0), schema=schema, poolPages=poolPages) as hf:
+    numBytes = hf.numPages() * hf.pageSize
+
+    start   = time.perf_counter()
+    numRows = 0
+    for pageIndex in range(hf.numPages()):
+      numRows += hf.readPage(hf.pageId(pageIndex)).header.numTuples()
+    pageSeconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in hf.scan():
+      pass
+    tupleSeconds = time.perf_counter() - start
+
+    return { 'pageSize'            : hf.pageSize,
+             'pages'               : hf.numPages(),
+             'rows'                : numRows,
+             'bytes'               : numBytes,
+             'pageScanSeconds'     : pageSeconds,
+             'pageScanMBps'        : numBytes / pageSeconds / 1e6 if pageSeconds > 0 else float('inf'),
+             'tupleScanSeconds'    : tupleSeconds,
+             'tupleScanRowsPerSec' : numRows / tupleSeconds if tupleSeconds > 0 else float('inf') }
+
+# Compares scan throughput across page sizes. Builds a heap file holding the
+# consecutive packed tuples 'data' for each page size, and scans it with
+# 'scanThroughput'. Returns a list of scan statistics, one per page size.
+def comparePageSizes(schema, data, pageSizes=defaultPageSizes, tempDir=None):
+  """
+  >>> from Catalog.Schema import DBSchema
+  >>> schema  = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> data    = b''.join(schema.pack(schema.instantiate(i, i % 50)) for i in range(100000))
+  >>> results = comparePageSizes(schema, data, [4096, 256 << 10])
+  >>> [(r['pageSize'], r['pages'], r['rows']) for r in results]
+  [(4096, 196, 100000), (262144, 4, 100000)]
+  """
+  results = []
+  workDir = tempfile.mkdtemp(dir=tempDir)
+  try:
+    for pageSize in pageSizes:
+      path = os.path.join(workDir, 'scan%d.heap' % pageSize)
+      with HeapFile(path, FileId(0), schema=schema, pageSize=pageSize) as hf:
+        hf.bulkLoad([data])
+      results.append(scanThroughput(path, schema))
+  finally:
+    shutil.rmtree(workDir)
+  return results
+
+# Formats scan statistics as a table, one row per page size.
+def formatResults(results):
+  lines = ['%10s %8s %12s %14s %16s' % ('pageSize', 'pages', 'rows', 'pageScan MB/s', 'tupleScan rows/s')]
+  for r in results:
+    lines.append('%10d %8d %12d %14.1f %16.0f' % (r['pageSize'], r['pages'], r['rows'],
+                                                 r['pageScanMBps'], r['tupleScanRowsPerSec']))
+  return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+  if len(sys.argv) > 1:
+    # Benchmark a binary file of packed records, e.g., as written by warmup.py.
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import warmup
+    from parallelload import RecordSchema
+    if len(sys.argv) != 3 or sys.argv[1] not in ('lineitem', 'orders'):
+      sys.exit("usage: scanbench.py (lineitem|orders) <input.bin>")
+    schema = RecordSchema(warmup.Lineitem if sys.argv[1] == 'lineitem' else warmup.Orders)
+    with open(sys.argv[2], 'rb') as f:
+      data = f.read()
+    print(formatResults(comparePageSizes(schema, data[:len(data) - len(data) % schema.size])))
+  else:
+    import doctest
+    doctest.testmod()
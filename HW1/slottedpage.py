@@ -0,0 +1,466 @@
+import struct
+
+from Catalog.Identifiers import TupleId
+from page import PageHeader, Page
+
+class SlottedPageHeader(PageHeader):
+  """
+  A slotted page header, supporting stable tuple identifiers and
+  variable-length tuples.
+
+  In addition to the base page header fields, a slotted page header stores a
+  slot directory, with an (offset, length) entry per slot, and a bitmap of the
+  slots currently in use. Tuple data grows downwards from the end of the page,
+  while the slot directory grows upwards after the header. The free space
+  offset therefore marks the start of the tuple data region.
+
+  A tuple's index is its slot number, which never changes while the tuple is
+  live. Deleting a tuple only clears its slot's bit, so deletes are O(1) and
+  leave a hole in the data region. Inserts reuse freed slots before growing
+  the slot directory. Holes are reclaimed by compacting the data region with
+  'vacuum' on the owning page.
+
+  A tuple size of 0 indicates that the page holds variable-length tuples.
+  Otherwise every tuple must be exactly 'tupleSize' bytes.
+
+  >>> import io
+  >>> buffer = io.BytesIO(bytes(4096))
+  >>> ph     = SlottedPageHeader(buffer=buffer.getbuffer(), tupleSize=16)
+  >>> ph2    = SlottedPageHeader.unpack(buffer.getbuffer())
+  >>> ph == ph2
+  True
+
+  ## Slot allocation tests
+  >>> ph.numTuples()
+  0
+  >>> ph.nextTupleRange()
+  (0, 4080, 4096)
+  >>> [ph.nextFreeTuple() for i in range(0, 3)]
+  [4064, 4048, 4032]
+  >>> ph.numTuples()
+  4
+
+  # Freed slots are reused, and the tuple count reflects only live slots.
+  >>> ph.freeSlot(1)
+  >>> ph.numTuples()
+  3
+  >>> ph.nextTupleRange()
+  (1, 4016, 4032)
+  >>> ph.numSlots
+  4
+
+  # The slot directory is preserved by packing.
+  >>> ph3 = SlottedPageHeader.unpack(bytearray(ph.pack()))
+  >>> ph == ph3 and ph3.slots == ph.slots
+  True
+
+  # Fill the page.
+  >>> while ph.hasFreeTuple():
+  ...   _ = ph.nextFreeTuple()
+  >>> ph.nextFreeTuple() == None
+  True
+  >>> ph.freeSpace() < ph.tupleSize + ph.slotSize
+  True
+  """
+
+  # Binary representation of the fixed part of a slotted page header:
+  # the base page header fields followed by the number of slots.
+  binrepr  = struct.Struct("cHHHH")
+  size     = binrepr.size
+
+  # Binary representation of a slot directory entry: (offset, length)
+  slotrepr = struct.Struct("HH")
+  slotSize = slotrepr.size
+
+  # Slotted page header constructor.
+  #
+  # In addition to the PageHeader keyword arguments, this accepts:
+  # slots        : a list of (offset, length) pairs, one per slot
+  # bitmap       : a bytearray indicating which slots are in use
+  def __init__(self, **kwargs):
+    buffer               = kwargs.get("buffer", None)
+    self.flags           = kwargs.get("flags", b'\x00')
+    self.tupleSize       = kwargs.get("tupleSize", 0) or 0
+    self.pageCapacity    = kwargs.get("pageCapacity", len(buffer))
+    self.freeSpaceOffset = kwargs.get("freeSpaceOffset", self.pageCapacity)
+    self.slots           = kwargs.get("slots", [])
+    self.numSlots        = len(self.slots)
+    self.bitmap          = kwargs.get("bitmap", bytearray(self.bitmapSize(self.numSlots)))
+    self.freeSlots       = [i for i in reversed(range(self.numSlots)) if not self.isUsed(i)]
+    if not kwargs.get("unpacked", False):
+      buffer[0: self.headerSize()] = self.pack()
+
+  def __eq__(self, other):
+    return (    PageHeader.__eq__(self, other)
+            and self.numSlots == other.numSlots
+            and self.bitmap == other.bitmap )
+
+  def __hash__(self):
+    return hash((PageHeader.__hash__(self), self.numSlots, bytes(self.bitmap)))
+
+  @staticmethod
+  def bitmapSize(numSlots):
+    return (numSlots + 7) // 8
+
+  def headerSize(self):
+    return self.size + self.bitmapSize(self.numSlots) + self.numSlots * self.slotSize
+
+  # Slot bitmap accessors.
+  def isUsed(self, slot):
+    return slot < self.numSlots and (self.bitmap[slot >> 3] >> (slot & 7)) & 1 == 1
+
+  def setUsed(self, slot, used):
+    if used:
+      self.bitmap[slot >> 3] |= 1 << (slot & 7)
+    else:
+      self.bitmap[slot >> 3] &= ~(1 << (slot & 7))
+
+  # Returns the (offset, length) of a live slot, or None.
+  def slot(self, slot):
+    return self.slots[slot] if self.isUsed(slot) else None
+
+  # Tuple count for the header, i.e., the number of live slots.
+  def numTuples(self):
+    return self.numSlots - len(self.freeSlots)
+
+  # Returns the contiguous space between the slot directory and the tuple data.
+  def freeSpace(self):
+    return self.freeSpaceOffset - self.headerSize()
+
+  # Returns the space used by live tuples.
+  def usedSpace(self):
+    return sum(self.slots[i][1] for i in range(self.numSlots) if self.isUsed(i))
+
+  # Returns the space that would be available after vacuuming.
+  def reclaimableSpace(self):
+    return self.pageCapacity - self.headerSize() - self.usedSpace()
+
+  # Returns the directory growth needed to allocate a slot, in bytes.
+  def slotOverhead(self):
+    if self.freeSlots:
+      return 0
+    return self.slotSize + self.bitmapSize(self.numSlots + 1) - self.bitmapSize(self.numSlots)
+
+  # Returns whether the page has contiguous free space for a tuple of the given
+  # length, defaulting to the header's tuple size.
+  def hasFreeTuple(self, length=None):
+    length = self.tupleSize if length is None else length
+    return self.freeSpace() >= length + self.slotOverhead()
+
+  # Allocates a slot and data range for a tuple of the given length.
+  # Returns a triple of (tupleIndex, start, end), or None if there is no space.
+  def allocate(self, length):
+    if not self.hasFreeTuple(length):
+      return None
+    if self.freeSlots:
+      slot = self.freeSlots.pop()
+    else:
+      slot = self.numSlots
+      self.numSlots += 1
+      self.slots.append((0, 0))
+      if len(self.bitmap) < self.bitmapSize(self.numSlots):
+        self.bitmap.append(0)
+    self.freeSpaceOffset -= length
+    self.slots[slot] = (self.freeSpaceOffset, length)
+    self.setUsed(slot, True)
+    return (slot, self.freeSpaceOffset, self.freeSpaceOffset + length)
+
+  # Marks a slot as free for reuse. The tuple's data becomes a hole.
+  def freeSlot(self, slot):
+    self.setUsed(slot, False)
+    self.slots[slot] = (0, 0)
+    self.freeSlots.append(slot)
+
+  # Returns the page offset of the next free fixed-size tuple.
+  def nextFreeTuple(self):
+    allocated = self.allocate(self.tupleSize)
+    return allocated[1] if allocated else None
+
+  # Returns a triple of (tupleIndex, start, end) for the next free fixed-size tuple.
+  def nextTupleRange(self):
+    return self.allocate(self.tupleSize)
+
+  # Returns a binary representation of this page header.
+  def pack(self):
+    return b''.join(
+      [ SlottedPageHeader.binrepr.pack(
+          self.flags, self.tupleSize, self.freeSpaceOffset,
+          self.pageCapacity, self.numSlots),
+        bytes(self.bitmap) ]
+      + [ SlottedPageHeader.slotrepr.pack(*s) for s in self.slots ])
+
+  # Constructs a slotted page header object from a binary representation.
+  @classmethod
+  def unpack(cls, buffer):
+    (flags, tupleSize, freeSpaceOffset, pageCapacity, numSlots) = \
+      SlottedPageHeader.binrepr.unpack_from(buffer)
+    bitmapStart = SlottedPageHeader.size
+    slotStart   = bitmapStart + cls.bitmapSize(numSlots)
+    bitmap      = bytearray(buffer[bitmapStart: slotStart])
+    slots       = list(SlottedPageHeader.slotrepr.iter_unpack(
+                    buffer[slotStart: slotStart + numSlots * cls.slotSize]))
+    return cls(buffer=buffer, flags=flags, tupleSize=tupleSize,
+               freeSpaceOffset=freeSpaceOffset, pageCapacity=pageCapacity,
+               slots=slots, bitmap=bitmap, unpacked=True)
+
+
+class SlottedPage(Page):
+  """
+  A slotted page class, with stable tuple identifiers and slot reuse.
+
+  Slotted pages use a SlottedPageHeader to locate tuples by slot. Deleting a
+  tuple is O(1) and does not move any other tuple, so tuple identifiers remain
+  valid for the lifetime of the tuple. Space left behind by deleted or shrunk
+  tuples is reclaimed by 'vacuum', which inserts run automatically when the
+  page has enough total space but not enough contiguous space.
+
+  Slotted pages also accept variable-length tuples, when constructed without
+  a schema or with an explicit tupleSize of 0.
+
+  >>> from Catalog.Identifiers import FileId, PageId, TupleId
+  >>> from Catalog.Schema      import DBSchema
+
+  # Test harness setup.
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> pId    = PageId(FileId(1), 100)
+  >>> p      = SlottedPage(pageId=pId, buffer=bytes(4096), schema=schema)
+
+  # Test page packing and unpacking
+  >>> len(p.pack())
+  4096
+  >>> p2 = SlottedPage.unpack(pId, p.pack())
+  >>> p.header == p2.header
+  True
+
+  # Insert, retrieve and update tuples.
+  >>> tIds = [p.insertTuple(schema.pack(schema.instantiate(i, 2*i+20))) for i in range(10)]
+  >>> schema.unpack(p.getTuple(tIds[3]))
+  employee(id=3, age=26)
+  >>> p.putTuple(tIds[3], schema.pack(schema.instantiate(3, 60)))
+  >>> schema.unpack(p.getTuple(tIds[3]))
+  employee(id=3, age=60)
+
+  # Deletion leaves the remaining tuple ids unchanged.
+  >>> p.deleteTuple(tIds[0])
+  >>> p.getTuple(tIds[0]) == None
+  True
+  >>> schema.unpack(p.getTuple(tIds[1]))
+  employee(id=1, age=22)
+  >>> p.header.numTuples()
+  9
+  >>> [schema.unpack(tup).age for tup in p]
+  [22, 24, 60, 28, 30, 32, 34, 36, 38]
+
+  # Inserts reuse the deleted slot.
+  >>> tId = p.insertTuple(schema.pack(schema.instantiate(10, 40)))
+  >>> tId.tupleIndex
+  0
+
+  # Clearing zeroes a tuple without removing it.
+  >>> p.clearTuple(tIds[2])
+  >>> schema.unpack(p.getTuple(tIds[2]))
+  employee(id=0, age=0)
+
+  # Vacuuming compacts the data region, preserving tuple ids.
+  >>> p.deleteTuple(tIds[5])
+  >>> p.header.freeSpace() < p.header.reclaimableSpace()
+  True
+  >>> p.vacuum()
+  >>> p.header.freeSpace() == p.header.reclaimableSpace()
+  True
+  >>> schema.unpack(p.getTuple(tIds[6]))
+  employee(id=6, age=32)
+
+  # Slot state survives packing and unpacking.
+  >>> p3 = SlottedPage.unpack(pId, p.pack())
+  >>> [schema.unpack(tup).age for tup in p3] == [schema.unpack(tup).age for tup in p]
+  True
+
+  # Bulk building fills the page, accounting for the slot directory.
+  >>> data = b''.join(schema.pack(schema.instantiate(i, i)) for i in range(1000))
+  >>> (p5, consumed) = SlottedPage.build(pId, schema, data)
+  >>> p5.header.numTuples() == consumed // schema.size
+  True
+  >>> p5.header.hasFreeTuple()
+  False
+
+  # Variable-length tuples.
+  >>> vp  = SlottedPage(pageId=pId, buffer=bytes(256))
+  >>> ids = [vp.insertTuple(b'x' * n) for n in (10, 50, 3)]
+  >>> [len(vp.getTuple(i)) for i in ids]
+  [10, 50, 3]
+  >>> vp.putTuple(ids[0], b'longer than ten bytes')
+  >>> bytes(vp.getTuple(ids[0]))
+  b'longer than ten bytes'
+  >>> vp.deleteTuple(ids[1])
+  >>> big = vp.insertTuple(b'y' * 180)
+  >>> [len(t) for t in vp]
+  [21, 180, 3]
+  >>> vp.tupleCapacity()
+  Traceback (most recent call last):
+  ...
+  ValueError: Tuple capacity requires a fixed tuple size
+
+  # Batch inserts reuse free slots, and return their tuple indexes.
+  >>> p6 = SlottedPage(pageId=pId, buffer=bytes(4096), schema=schema)
+  >>> p6.insertPackedTuples(b''.join(schema.pack(schema.instantiate(i, i)) for i in range(4)))
+  [0, 1, 2, 3]
+  >>> p6.deleteTuple(TupleId(pId, 1))
+  >>> p6.insertPackedTuples(b''.join(schema.pack(schema.instantiate(i, i)) for i in range(2)))
+  [1, 4]
+  """
+
+  headerClass = SlottedPageHeader
+
+  # Header constructor, allowing variable-length tuples when no schema is given.
+  def initializeHeader(self, **kwargs):
+    schema    = kwargs.get("schema", None)
+    tupleSize = kwargs.get("tupleSize", schema.size if schema else 0)
+    buffer    = self.getbuffer()
+    if len(buffer) > SlottedPageHeader.maxCapacity:
+      raise ValueError("Slotted pages are limited to 64 KB")
+    return SlottedPageHeader(buffer=buffer, tupleSize=tupleSize,
+                             pageCapacity=kwargs.get("pageCapacity", len(buffer)))
+
+  # Iterator over live tuples, in slot order.
+  def __iter__(self):
+    for i in range(self.header.numSlots):
+      t = self.getTuple(TupleId(self.pageId, i))
+      if t is not None:
+        yield t
+
+  # Returns the tuple ids of all live tuples, in slot order.
+  def tupleIds(self):
+    return [TupleId(self.pageId, i) for i in range(self.header.numSlots) if self.header.isUsed(i)]
+
+  # Tuple accessor methods
+
+  # Returns a byte string representing a packed tuple for the given tuple id.
+  def getTuple(self, tupleId):
+    slot = self.header.slot(tupleId.tupleIndex)
+    if slot:
+      (start, length) = slot
+      return self.getbuffer()[start: start + length]
+    else:
+      return None
+
+  # Updates the (packed) tuple at the given tuple id, relocating it within the
+  # page if it grows.
+  def putTuple(self, tupleId, tupleData):
+    tupleIndex = tupleId.tupleIndex
+    slot       = self.header.slot(tupleIndex)
+    if slot is None:
+      return None
+    self.checkTupleSize(tupleData)
+
+    (start, length) = slot
+    if len(tupleData) > length:
+      if self.header.reclaimableSpace() + length < len(tupleData):
+        raise ValueError("No enough memory for update!")
+      # Release the old tuple's space, and relocate it after compaction if needed.
+      self.header.slots[tupleIndex] = (start, 0)
+      if self.header.freeSpace() < len(tupleData):
+        self.vacuum()
+      self.header.freeSpaceOffset -= len(tupleData)
+      start = self.header.freeSpaceOffset
+
+    self.getbuffer()[start: start + len(tupleData)] = tupleData
+    self.header.slots[tupleIndex] = (start, len(tupleData))
+    self.setDirty(True)
+
+  # Adds a packed tuple to the page. Returns the tuple id of the newly added tuple.
+  def insertTuple(self, tupleData):
+    self.checkTupleSize(tupleData)
+    length = len(tupleData)
+    if not self.header.hasFreeTuple(length) \
+       and self.header.reclaimableSpace() >= length + self.header.slotOverhead():
+      self.vacuum()
+
+    allocated = self.header.allocate(length)
+    if allocated:
+      (tupleIndex, start, end) = allocated
+      self.getbuffer()[start: end] = tupleData
+      self.setDirty(True)
+      return TupleId(self.pageId, tupleIndex)
+    else:
+      raise ValueError("No enough memory for insertion!")
+
+  # Returns the number of additional fixed-size tuples that fit in the page,
+  # after vacuuming. Pages of variable-length tuples have no such capacity.
+  def tupleCapacity(self):
+    header    = self.header
+    space     = header.reclaimableSpace()
+    tupleSize = header.tupleSize
+    if not tupleSize:
+      raise ValueError("Tuple capacity requires a fixed tuple size")
+    reused    = min(len(header.freeSlots), space // tupleSize)
+    space    -= reused * tupleSize
+    if reused < len(header.freeSlots):
+      return reused
+    count = space // (tupleSize + header.slotSize)
+    while count and count * (tupleSize + header.slotSize) \
+                    + header.bitmapSize(header.numSlots + count) - len(header.bitmap) > space:
+      count -= 1
+    return reused + count
+
+  # Adds consecutive fixed-size packed tuples held in a single bytes-like
+  # object. Either all tuples are added, or none are. Returns a list of the
+  # tuple indexes assigned to the new tuples, which reuse free slots first.
+  def insertPackedTuples(self, data):
+    tupleSize  = self.header.tupleSize
+    if not tupleSize:
+      raise ValueError("Packed tuples require a fixed tuple size")
+    (count, r) = divmod(len(data), tupleSize)
+    if r:
+      raise ValueError("Packed tuples are not a multiple of the tuple size")
+    if count > self.tupleCapacity():
+      raise ValueError("No enough memory for insertion!")
+    view = memoryview(data)
+    return [self.insertTuple(view[i: i + tupleSize]).tupleIndex
+              for i in range(0, len(data), tupleSize)]
+
+  # Zeroes out the contents of the tuple at the given tuple id.
+  def clearTuple(self, tupleId):
+    slot = self.header.slot(tupleId.tupleIndex)
+    if slot:
+      (start, length) = slot
+      self.getbuffer()[start: start + length] = bytes(length)
+      self.setDirty(True)
+    else:
+      return None
+
+  # Removes the tuple at the given tuple id, freeing its slot for reuse.
+  # No other tuple is moved.
+  def deleteTuple(self, tupleId):
+    tupleIndex = tupleId.tupleIndex
+    if self.header.isUsed(tupleIndex):
+      self.header.freeSlot(tupleIndex)
+      self.setDirty(True)
+    else:
+      raise ValueError("No such item")
+
+  # Compacts the tuple data region to the end of the page, reclaiming holes
+  # left by deleted or shrunk tuples. Tuple ids are unchanged.
+  def vacuum(self):
+    header = self.header
+    buf    = self.getbuffer()
+    live   = sorted(((header.slots[i][0], i) for i in range(header.numSlots)
+                       if header.isUsed(i)), reverse=True)
+    offset = header.pageCapacity
+    for (start, i) in live:
+      length  = header.slots[i][1]
+      offset -= length
+      if offset != start:
+        buf[offset: offset + length] = buf[start: start + length]
+      header.slots[i] = (offset, length)
+    header.freeSpaceOffset = offset
+    self.setDirty(True)
+
+  def checkTupleSize(self, tupleData):
+    if self.header.tupleSize and len(tupleData) != self.header.tupleSize:
+      raise ValueError("Invalid tuple size for this page")
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,99 @@
+import struct
+
+# Parsing of record formats: struct format strings into per-column codes and
+# byte offsets, and CSV lines into column values.
+#
+# Record classes and tuple schemas both describe their packed layout with a
+# struct format, with one format code per column. This module holds the
+# parsing shared by the record-file and page-level storage modules. It only
+# depends on the struct module, so that page-level modules can describe
+# their tuples without importing NumPy.
+
+byteOrders = '@=<>!'
+
+# Split a struct format string into one format code per column.
+# E.g., "2Isf10s" => ["I", "I", "s", "f", "10s"]. Byte order prefixes are dropped.
+def columnFormats(fmt):
+  """
+  >>> columnFormats("4I4fss10s")
+  ['I', 'I', 'I', 'I', 'f', 'f', 'f', 'f', 's', 's', '10s']
+  >>> columnFormats("<3B2s")
+  ['B', 'B', 'B', '2s']
+  """
+  codes = []
+  count = ''
+  for c in fmt.lstrip(byteOrders):
+    if c.isdigit():
+      count += c
+    elif c == 's':
+      codes.append(count + c)
+      count = ''
+    else:
+      codes.extend([c] * int(count or 1))
+      count = ''
+  return codes
+
+# Return a list of (column, format code, byte offset) triples for records
+# packed by the struct format 'fmt', with the given column names.
+# Offsets account for the alignment used by 'fmt'.
+def formatLayout(fmt, names):
+  """
+  >>> formatLayout("ibi", ['a', 'b', 'c'])
+  [('a', 'i', 0), ('b', 'b', 4), ('c', 'i', 8)]
+  >>> formatLayout("<ibi", ['a', 'b', 'c'])
+  [('a', 'i', 0), ('b', 'b', 4), ('c', 'i', 5)]
+  """
+  order  = fmt[:1] if fmt[:1] in byteOrders else ''
+  layout = []
+  prefix = order
+  for name, code in zip(names, columnFormats(fmt)):
+    offset  = struct.calcsize(prefix + code) - struct.calcsize(order + code)
+    prefix += code
+    layout.append((name, code, offset))
+  return layout
+
+# Returns a NumPy structured dtype specification, as a dictionary of plain
+# dtype strings, matching records packed by the struct format 'fmt' into
+# 'itemsize' bytes, with the given field names. The result is passed to
+# numpy.dtype by the modules that use NumPy.
+def dtypeSpec(fmt, names, itemsize):
+  """
+  >>> dtypeSpec("<ib4s", ['a', 'b', 'c'], 9)
+  {'names': ['a', 'b', 'c'], 'formats': ['<i', '<b', 'S4'], 'offsets': [0, 4, 5], 'itemsize': 9}
+  >>> dtypeSpec("If", ['a', 'b'], 8)['formats']
+  ['=I', '=f']
+  """
+  order  = {'<': '<', '>': '>', '!': '>'}.get(fmt[:1], '=')
+  layout = formatLayout(fmt, names)
+  return { 'names'    : [name for name, _, _ in layout],
+           'formats'  : [codeDtype(code, order) for _, code, _ in layout],
+           'offsets'  : [offset for _, _, offset in layout],
+           'itemsize' : itemsize }
+
+# Map a struct format code to a NumPy dtype string, with the given byte order.
+def codeDtype(code, order='='):
+  if code.endswith('s'):
+    return 'S' + (code[:-1] or '1')
+  return order + code
+
+# Convert one line of a CSV file, as bytes, into a tuple of column values,
+# applying 'casts' (e.g., a record class's fieldTypes) to the fields split at
+# 'sep'. Fields beyond the casts, such as the empty field after a trailing
+# separator, are ignored. Returns None for blank lines.
+def parseCsvLine(line, sep, casts):
+  """
+  >>> parseCsvLine(b'1|2.5|abc|\\n', b'|', (int, float, bytes))
+  (1, 2.5, b'abc')
+  >>> parseCsvLine(b'  \\n', b'|', (int,)) is None
+  True
+  """
+  line = line.strip()
+  if not line:
+    return None
+  fields = line.split(sep)
+  return tuple(cast(field) for cast, field in zip(casts, fields[:len(casts)]))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
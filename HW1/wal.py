@@ -0,0 +1,542 @@
+import os, struct, threading, time, zlib
+
+from Catalog.Identifiers import TupleId
+from page import Page
+from slottedpage import SlottedPage
+from heapfile import HeapFile
+
+# Syncs the directory holding a file, making a rename of the file durable.
+def syncDirectory(filePath):
+  fd = os.open(os.path.dirname(os.path.abspath(filePath)), os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+class LoggedPageMixin:
+  """
+  A mixin storing a page LSN in a trailer at the end of a page.
+
+  The page LSN is the log sequence number of the last logged operation
+  applied to the page. Log replay skips records no newer than a page's LSN,
+  so each operation is redone exactly once, whichever pages were written
+  back before a crash. The trailer is excluded from the page's capacity.
+
+  >>> from Catalog.Identifiers import FileId, PageId
+  >>> from Catalog.Schema      import DBSchema
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> p      = LoggedPage(pageId=PageId(FileId(1), 0), buffer=bytes(4096), schema=schema)
+  >>> p.header.pageCapacity, p.pageLSN()
+  (4088, 0)
+  >>> p.setPageLSN(42)
+  >>> LoggedPage.unpack(p.pageId, p.pack()).pageLSN()
+  42
+  """
+
+  lsnrepr = struct.Struct("<Q")
+
+  def initializeHeader(self, **kwargs):
+    kwargs["pageCapacity"] = len(self.getbuffer()) - self.lsnrepr.size
+    return super().initializeHeader(**kwargs)
+
+  def pageLSN(self):
+    buffer = self.getbuffer()
+    return self.lsnrepr.unpack_from(buffer, len(buffer) - self.lsnrepr.size)[0]
+
+  def setPageLSN(self, lsn):
+    buffer = self.getbuffer()
+    self.lsnrepr.pack_into(buffer, len(buffer) - self.lsnrepr.size, lsn)
+
+  # Redoes a logged insert, which must assign the logged tuple index.
+  def redoInsert(self, tupleIndex, tupleData):
+    tupleId = self.insertTuple(tupleData)
+    if tupleId.tupleIndex != tupleIndex:
+      raise ValueError("Log replay diverged on page %d" % self.pageId.pageIndex)
+
+
+class LoggedPage(LoggedPageMixin, Page):
+  pass
+
+
+class LoggedSlottedPage(LoggedPageMixin, SlottedPage):
+  # Free slots are reused in the order they were freed, which is not kept
+  # across unpacking, so the logged slot is made the next one reused.
+  def redoInsert(self, tupleIndex, tupleData):
+    freeSlots = self.header.freeSlots
+    if tupleIndex in freeSlots:
+      freeSlots.remove(tupleIndex)
+      freeSlots.append(tupleIndex)
+    super().redoInsert(tupleIndex, tupleData)
+
+
+class WriteAheadLog:
+  """
+  A redo log of tuple-level page operations, with group commit.
+
+  Records are appended to an in-memory buffer, and assigned increasing log
+  sequence numbers (LSNs). Flushing writes out the buffer and syncs the log
+  file. Concurrent flushes are combined: one thread writes and syncs all
+  records appended so far, while the others wait for it, so many commits
+  share a single fsync. A group delay lets the flushing thread wait for more
+  commits to join its group.
+
+  The log file holds a header with the LSN at which the log starts, followed
+  by records of a type, page index, tuple index, data length and checksum,
+  and the data. The LSN of a record is the log position just after it.
+  Opening a log cuts off a torn or corrupt tail, left by a crash during a
+  write, so that new records follow the last valid one. Checkpoints truncate
+  the log once every logged operation is reflected in the data file.
+
+  >>> import tempfile, os
+  >>> path = os.path.join(tempfile.mkdtemp(), 'test.wal')
+  >>> log  = WriteAheadLog(path)
+  >>> lsn  = log.append(WriteAheadLog.insertRecord, 3, 0, b'tuple')
+  >>> log.commit() > lsn, log.flushedLsn == log.nextLsn
+  (True, True)
+  >>> log.close()
+  >>> [(r[1], r[2], r[4]) for r in WriteAheadLog(path).records()]
+  [(1, 3, b'tuple'), (5, 0, b'')]
+
+  # A torn tail is cut off when the log is opened, before new records.
+  >>> with open(path, 'ab') as f:
+  ...   _ = f.write(WriteAheadLog.record.pack(WriteAheadLog.insertRecord, 4, 0, 64, 0) + b'torn')
+  >>> log = WriteAheadLog(path)
+  >>> lsn = log.append(WriteAheadLog.deleteRecord, 3, 0)
+  >>> log.close()
+  >>> [(r[1], r[2]) for r in WriteAheadLog(path).records()], lsn == os.path.getsize(path) - 12
+  ([(1, 3), (5, 0), (3, 3)], True)
+
+  # Truncating keeps LSNs increasing.
+  >>> log = WriteAheadLog(path)
+  >>> end = log.nextLsn
+  >>> log.truncate()
+  >>> (list(log.records()), log.baseLsn == end, log.append(WriteAheadLog.commitRecord) > end)
+  ([], True, True)
+  >>> log.close()
+  """
+
+  header = struct.Struct("<4sQ")
+  record = struct.Struct("<BIIII")
+  magic  = b'WLOG'
+
+  # Log record types.
+  insertRecord   = 1
+  putRecord      = 2
+  deleteRecord   = 3
+  allocateRecord = 4
+  commitRecord   = 5
+
+  # Log constructor.
+  #
+  # groupDelay   : the number of seconds a flushing thread waits for further
+  #                commits before syncing the log
+  def __init__(self, filePath, **kwargs):
+    self.filePath   = filePath
+    self.groupDelay = kwargs.get("groupDelay", 0.0)
+    if os.path.exists(filePath):
+      self.file = open(filePath, 'r+b')
+      (magic, self.baseLsn) = self.header.unpack(self.file.read(self.header.size))
+      if magic != self.magic:
+        self.file.close()
+        raise ValueError("Not a log file: " + filePath)
+      self.cutTornTail()
+    else:
+      self.file    = open(filePath, 'w+b')
+      self.baseLsn = 0
+      self.file.write(self.header.pack(self.magic, self.baseLsn))
+      self.sync()
+
+    self.nextLsn    = self.baseLsn + self.file.seek(0, 2) - self.header.size
+    self.flushedLsn = self.nextLsn
+    self.pending    = bytearray()
+    self.flushing   = False
+    self.cond       = threading.Condition()
+    self.stats      = { 'records': 0, 'commits': 0, 'syncs': 0, 'bytes': 0 }
+
+  def sync(self):
+    self.file.flush()
+    os.fsync(self.file.fileno())
+
+  # Truncates the log after its last valid record, cutting off a record torn
+  # or corrupted by a crash, so that new records follow the valid ones.
+  def cutTornTail(self):
+    length = self.file.seek(0, 2) - self.header.size
+    valid  = 0
+    self.file.seek(self.header.size)
+    for (valid, _, _, _, _) in self.readRecords(self.file, length):
+      pass
+    if valid < length:
+      self.file.truncate(self.header.size + valid)
+      self.sync()
+
+  # Yields (end, type, pageIndex, tupleIndex, data) for the records read
+  # from 'f', positioned after the log header, within 'length' bytes of
+  # records. 'end' is the offset just after a record, relative to the first
+  # record. Records are read one at a time, and reading stops at the first
+  # torn or corrupt record.
+  def readRecords(self, f, length):
+    offset = 0
+    while offset + self.record.size <= length:
+      head = f.read(self.record.size)
+      (kind, pageIndex, tupleIndex, dataLength, crc) = self.record.unpack(head)
+      if offset + self.record.size + dataLength > length:
+        break
+      data = f.read(dataLength)
+      head = self.record.pack(kind, pageIndex, tupleIndex, dataLength, 0)
+      if len(data) != dataLength or zlib.crc32(data, zlib.crc32(head)) != crc:
+        break
+      offset += self.record.size + dataLength
+      yield (offset, kind, pageIndex, tupleIndex, data)
+
+  # Appends a record to the log buffer, returning its LSN.
+  def append(self, kind, pageIndex=0, tupleIndex=0, data=b''):
+    with self.cond:
+      head = self.record.pack(kind, pageIndex, tupleIndex, len(data), 0)
+      crc  = zlib.crc32(data, zlib.crc32(head))
+      self.pending += self.record.pack(kind, pageIndex, tupleIndex, len(data), crc)
+      self.pending += data
+      self.nextLsn += self.record.size + len(data)
+      self.stats['records'] += 1
+      return self.nextLsn
+
+  # Makes the log durable up to 'lsn', or up to its last record.
+  def flush(self, lsn=None):
+    with self.cond:
+      target = self.nextLsn if lsn is None else lsn
+      while self.flushedLsn < target:
+        if self.flushing:
+          self.cond.wait()
+          continue
+        self.flushing = True
+        try:
+          self.writePending()
+        finally:
+          self.flushing = False
+          self.cond.notify_all()
+
+  # Writes and syncs the buffered records. Called by the flushing thread with
+  # the log's lock held, which is released while waiting and during I/O.
+  def writePending(self):
+    if self.groupDelay > 0:
+      self.cond.wait(self.groupDelay)
+    data = bytes(self.pending)
+    end  = self.nextLsn
+    self.pending.clear()
+    self.cond.release()
+    try:
+      self.file.seek(0, 2)
+      self.file.write(data)
+      self.sync()
+    finally:
+      self.cond.acquire()
+    self.flushedLsn      = end
+    self.stats['syncs'] += 1
+    self.stats['bytes'] += len(data)
+
+  # Appends a commit record, and waits until it is durable.
+  # Returns the commit record's LSN.
+  def commit(self):
+    lsn = self.append(self.commitRecord)
+    self.flush(lsn)
+    with self.cond:
+      self.stats['commits'] += 1
+    return lsn
+
+  # Yields (lsn, type, pageIndex, tupleIndex, data) for the durable records
+  # of the log. Records are streamed from a separate handle on the log file,
+  # so appends and flushes may proceed meanwhile, and records made durable
+  # after the call are not included.
+  def records(self):
+    self.flush()
+    with self.cond:
+      baseLsn = self.baseLsn
+      length  = self.flushedLsn - baseLsn
+      f       = open(self.filePath, 'rb')
+    with f:
+      f.seek(self.header.size)
+      for (end, kind, pageIndex, tupleIndex, data) in self.readRecords(f, length):
+        yield (baseLsn + end, kind, pageIndex, tupleIndex, data)
+
+  # Discards all records, once the operations they log are durable elsewhere.
+  # LSNs keep increasing from the current LSN.
+  #
+  # The log is replaced atomically by an empty log starting at the current
+  # LSN, so a crash leaves either the old log, whose records are then no newer
+  # than their pages, or the new one, but never old records under a new LSN.
+  def truncate(self):
+    self.flush()
+    with self.cond:
+      baseLsn  = self.nextLsn
+      tempPath = self.filePath + '.tmp'
+      with open(tempPath, 'wb') as f:
+        f.write(self.header.pack(self.magic, baseLsn))
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(tempPath, self.filePath)
+      syncDirectory(self.filePath)
+      self.file.close()
+      self.file    = open(self.filePath, 'r+b')
+      self.baseLsn = baseLsn
+      self.file.seek(0, 2)
+
+  def close(self):
+    if not self.file.closed:
+      self.flush()
+      self.file.close()
+
+
+class LoggedHeapFile(HeapFile):
+  """
+  A heap file whose tuple modifications are made durable by a redo log.
+
+  Inserts, updates, deletes and page allocations append compact log records
+  holding the affected tuple, and stamp the page with the record's LSN.
+  Modified pages stay in the buffer pool, and a page is only written back
+  once the log is durable up to its LSN. Committing forces the log only,
+  so small writes cost sequential log I/O rather than random page writes,
+  and concurrent commits share fsyncs through group commit.
+
+  Checkpoints write back all dirty pages, sync the data file, and truncate
+  the log. They run in a background thread every 'checkpointInterval'
+  seconds, and when the file is closed. On opening, the log is replayed,
+  redoing each record newer than its page's LSN.
+
+  Logging is redo-only: operations are not rolled back, and a crash keeps
+  every operation whose records reached the log, including any logged after
+  the last commit. Bulk loads are not logged, but synced to the data file.
+  Methods may be called from several threads.
+
+  >>> import tempfile, os
+  >>> from Catalog.Identifiers import FileId
+  >>> from Catalog.Schema      import DBSchema
+
+  # Test harness setup.
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> path   = os.path.join(tempfile.mkdtemp(), 'employee.heap')
+  >>> hf     = LoggedHeapFile(path, FileId(1), schema=schema, pageSize=256,
+  ...                         checkpointInterval=None)
+  >>> tIds   = [hf.insertTuple(schema.pack(schema.instantiate(i, 20))) for i in range(100)]
+  >>> hf.putTuple(tIds[5], schema.pack(schema.instantiate(5, 99)))
+  >>> hf.deleteTuple(tIds[0])
+  >>> hf.commit() > 0
+  True
+
+  # Simulate a crash: drop the buffer pool without writing back any page.
+  >>> hf.log.close(); hf.file.close(); hf.stopCheckpoints()
+  >>> os.path.getsize(path) // 256 - 1
+  4
+
+  # Reopening replays the log onto the pages on disk.
+  >>> hf = LoggedHeapFile(path, FileId(1), schema=schema)
+  >>> hf.recovered
+  102
+  >>> rows = sorted((schema.unpack(t).id, schema.unpack(t).age) for (_, t) in hf.scan())
+  >>> len(rows), rows[:2], rows[4]
+  (99, [(1, 20), (2, 20)], (5, 99))
+
+  # Checkpoints write back pages and truncate the log.
+  >>> hf.checkpoint()
+  >>> list(hf.log.records())
+  []
+
+  # Simulate a crash while a checkpoint truncates the log: the old records
+  # are kept, and are found no newer than the pages written back.
+  >>> hf.insertTuple(schema.pack(schema.instantiate(500, 20))) is not None
+  True
+  >>> from unittest import mock
+  >>> with mock.patch('os.replace', side_effect=OSError('crash')):
+  ...   hf.checkpoint()
+  Traceback (most recent call last):
+  ...
+  OSError: crash
+  >>> len(list(hf.log.records()))
+  1
+  >>> hf.log.close(); hf.file.close(); hf.stopCheckpoints()
+  >>> hf = LoggedHeapFile(path, FileId(1), schema=schema, checkpointInterval=None)
+  >>> hf.recovered, len(list(hf.scan()))
+  (0, 100)
+
+  # Scans do not hold the lock while their consumer runs.
+  >>> import threading
+  >>> scan = hf.scan()
+  >>> _ = next(scan)
+  >>> writer = threading.Thread(target=hf.insertTuple, args=(schema.pack(schema.instantiate(600, 20)),))
+  >>> writer.start(); writer.join(5); writer.is_alive()
+  False
+  >>> len(list(scan))
+  100
+  >>> hf.close()
+
+  # Concurrent commits share log syncs.
+  >>> from concurrent.futures import ThreadPoolExecutor
+  >>> hf = LoggedHeapFile(path, FileId(1), schema=schema, groupDelay=0.01)
+  >>> def work(i):
+  ...   hf.insertTuple(schema.pack(schema.instantiate(1000 + i, 0))); return hf.commit()
+  >>> with ThreadPoolExecutor(16) as pool:
+  ...   _ = list(pool.map(work, range(64)))
+  >>> hf.log.stats['commits'], hf.log.stats['syncs'] < 64
+  (64, True)
+  >>> hf.close()
+  """
+
+  # Logged heap file constructor. In addition to the heap file arguments:
+  #
+  # logPath            : the path of the log, by default next to the heap file
+  # groupDelay         : the log's group commit delay, in seconds
+  # checkpointInterval : the number of seconds between background
+  #                      checkpoints, or None to disable them
+  #
+  # The page class defaults to LoggedPage, and must be a LoggedPageMixin class.
+  def __init__(self, filePath, fileId, **kwargs):
+    kwargs.setdefault("pageClass", LoggedPage)
+    if not issubclass(kwargs["pageClass"], LoggedPageMixin):
+      raise ValueError("Logged heap files require pages with a page LSN")
+    self.lock = threading.RLock()
+    super().__init__(filePath, fileId, **kwargs)
+    self.log = WriteAheadLog(kwargs.get("logPath", filePath + '.wal'),
+                             groupDelay=kwargs.get("groupDelay", 0.0))
+    self.recovered = self.recover()
+
+    self.stopEvent  = threading.Event()
+    self.checkpoints = None
+    interval = kwargs.get("checkpointInterval", 1.0)
+    if interval:
+      self.checkpoints = threading.Thread(target=self.checkpointLoop, args=(interval,),
+                                          daemon=True)
+      self.checkpoints.start()
+
+  # Replays the log, returning the number of records redone.
+  def recover(self):
+    redone = 0
+    with self.lock:
+      for (lsn, kind, pageIndex, tupleIndex, data) in self.log.records():
+        if kind == WriteAheadLog.allocateRecord:
+          while self.pageCount <= pageIndex:
+            HeapFile.allocatePage(self)
+          continue
+        if kind == WriteAheadLog.commitRecord:
+          continue
+
+        pageId = self.pageId(pageIndex)
+        page   = self.bufferPool.getPage(pageId)
+        try:
+          if page.pageLSN() < lsn:
+            tupleId = TupleId(pageId, tupleIndex)
+            if kind == WriteAheadLog.insertRecord:
+              page.redoInsert(tupleIndex, data)
+            elif kind == WriteAheadLog.putRecord:
+              page.putTuple(tupleId, data)
+            elif kind == WriteAheadLog.deleteRecord:
+              page.deleteTuple(tupleId)
+            page.setPageLSN(lsn)
+            redone += 1
+        finally:
+          self.bufferPool.unpinPage(pageId, dirty=True)
+        self.setFreeSpace(pageIndex, page.header.hasFreeTuple())
+    if redone:
+      self.checkpoint()
+    return redone
+
+  # Logs an operation on a resident page, and stamps the page with its LSN.
+  def logOperation(self, kind, pageIndex, tupleIndex, data=b''):
+    lsn    = self.log.append(kind, pageIndex, tupleIndex, data)
+    pageId = self.pageId(pageIndex)
+    page   = self.bufferPool.getPage(pageId)
+    page.setPageLSN(lsn)
+    self.bufferPool.unpinPage(pageId, dirty=True)
+
+  # Heap file overrides logging tuple modifications.
+
+  # Enforces the write-ahead rule before pages are written back.
+  def writePage(self, page):
+    self.log.flush(page.pageLSN())
+    super().writePage(page)
+
+  def allocatePage(self):
+    with self.lock:
+      pageIndex = super().allocatePage()
+      self.log.append(WriteAheadLog.allocateRecord, pageIndex)
+      return pageIndex
+
+  def insertTuple(self, tupleData):
+    with self.lock:
+      return super().insertTuple(tupleData)
+
+  def insertIntoPage(self, pageIndex, tupleData):
+    tupleId = super().insertIntoPage(pageIndex, tupleData)
+    if tupleId is not None:
+      self.logOperation(WriteAheadLog.insertRecord, pageIndex, tupleId.tupleIndex, tupleData)
+    return tupleId
+
+  def getTuple(self, tupleId):
+    with self.lock:
+      return super().getTuple(tupleId)
+
+  def putTuple(self, tupleId, tupleData):
+    with self.lock:
+      super().putTuple(tupleId, tupleData)
+      self.logOperation(WriteAheadLog.putRecord, tupleId.pageId.pageIndex,
+                        tupleId.tupleIndex, tupleData)
+
+  def deleteTuple(self, tupleId):
+    with self.lock:
+      super().deleteTuple(tupleId)
+      self.logOperation(WriteAheadLog.deleteRecord, tupleId.pageId.pageIndex,
+                        tupleId.tupleIndex)
+
+  def bulkLoad(self, batches):
+    with self.lock:
+      loaded = super().bulkLoad(batches)
+      self.file.flush()
+      os.fsync(self.file.fileno())
+      return loaded
+
+  # Scans take the lock for each page in turn, rather than across yields,
+  # so checkpoints and writers may run between pages.
+  def pageTuples(self, pageIndex):
+    with self.lock:
+      return super().pageTuples(pageIndex)
+
+  # Makes all operations logged so far durable. Returns the commit's LSN.
+  def commit(self):
+    return self.log.commit()
+
+  # Writes back all dirty pages and syncs the data file, after which the log
+  # is no longer needed and is truncated.
+  def checkpoint(self):
+    with self.lock:
+      self.log.flush()
+      self.bufferPool.flushPages()
+      self.file.flush()
+      os.fsync(self.file.fileno())
+      self.saveFreeSpaceMap()
+      self.log.truncate()
+
+  def checkpointLoop(self, interval):
+    while not self.stopEvent.wait(interval):
+      with self.lock:
+        if self.file.closed:
+          return
+        self.checkpoint()
+
+  def stopCheckpoints(self):
+    self.stopEvent.set()
+    if self.checkpoints is not None and self.checkpoints is not threading.current_thread():
+      self.checkpoints.join()
+
+  def flush(self):
+    self.checkpoint()
+
+  def close(self):
+    self.stopCheckpoints()
+    with self.lock:
+      if not self.file.closed:
+        self.checkpoint()
+        self.file.close()
+        self.log.close()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,329 @@
+import os, struct
+
+from heapfile import HeapFile
+from structformat import columnFormats
+
+# Returns a column value with any NUL padding of text columns removed.
+def unpadded(value):
+  return value.rstrip(b'\x00') if isinstance(value, bytes) else value
+
+class ZoneMap:
+  """
+  Per-page minimum and maximum values of selected columns of a heap file.
+
+  A zone map holds one zone per page, with a (min, max) pair for each of its
+  columns, or None for pages without tuples. A page whose zone lies outside
+  the range of a predicate cannot hold any matching tuple, and need not be
+  read. Zones are conservative: they always cover the page's tuples, but may
+  be wider than needed.
+
+  Text columns are summarized without their NUL padding, and are compared
+  with query bounds the same way, so that bounds need not be padded.
+
+  Zone maps are stored in a side file next to the heap file, as a header
+  naming the summarized columns and holding the heap file's write epoch,
+  followed by one fixed-size entry per page.
+
+  >>> from Catalog.Schema import DBSchema
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int'), ('name', 'char(4)')])
+  >>> zm     = ZoneMap(schema, ['age', 'name'])
+  >>> zm.add(0, schema.pack(schema.instantiate(1, 30, b'bob')))
+  >>> zm.add(0, schema.pack(schema.instantiate(2, 25, b'al')))
+  >>> zm.zones[0]
+  [[25, 30], [b'al', b'bob']]
+
+  # Pages are matched against (lo, hi) ranges per column, where None leaves
+  # a side of a range open.
+  >>> zm.mayMatch(0, {'age': (20, 26)}), zm.mayMatch(0, {'age': (31, None)})
+  (True, False)
+  >>> zm.mayMatch(0, {'age': (None, 40), 'name': (b'c', None)})
+  False
+  >>> zm.mayMatch(0, {'name': (b'bob', b'bob')})
+  True
+
+  # Zone maps round-trip through their binary representation.
+  >>> zm.add(2, schema.pack(schema.instantiate(3, 40, b'cy')))
+  >>> zm.epoch = 3
+  >>> zm2 = ZoneMap.unpack(schema, zm.pack())
+  >>> zm2.zones == zm.zones, zm2.epoch
+  (True, 3)
+  """
+
+  # Binary representation of the zone map header: a magic string, the heap
+  # file's write epoch, the number of pages, and the length of the
+  # comma-separated column names that follow.
+  binrepr = struct.Struct("<4sQII")
+  magic   = b'ZMAP'
+
+  def __init__(self, schema, columns):
+    fields           = list(schema.fields)
+    codes            = columnFormats(schema.binrepr.format)
+    self.columns     = list(columns)
+    self.indexes     = [fields.index(column) for column in self.columns]
+    self.unpackTuple = schema.binrepr.unpack
+    # Each entry is a flag byte marking non-empty zones, and the min and max
+    # of each column. Entries are packed without padding.
+    self.entry       = struct.Struct("<B" + ''.join(codes[i] * 2 for i in self.indexes))
+    self.empty       = self.entry.pack(0, *[v for i in self.indexes for v in self.defaults(codes[i])])
+    self.zones       = []
+    self.epoch       = 0
+
+  @staticmethod
+  def defaults(code):
+    value = b'' if code.endswith('s') else 0
+    return (value, value)
+
+  # Returns the values of the summarized columns of a packed tuple.
+  def values(self, tupleData):
+    fields = self.unpackTuple(tupleData)
+    return [unpadded(fields[i]) for i in self.indexes]
+
+  def ensure(self, numPages):
+    if len(self.zones) < numPages:
+      self.zones.extend([None] * (numPages - len(self.zones)))
+
+  # Widens the zone of a page to cover a packed tuple.
+  def add(self, pageIndex, tupleData):
+    self.ensure(pageIndex + 1)
+    zone = self.zones[pageIndex]
+    if zone is None:
+      self.zones[pageIndex] = [[v, v] for v in self.values(tupleData)]
+      return
+    for (bounds, v) in zip(zone, self.values(tupleData)):
+      if v < bounds[0]:
+        bounds[0] = v
+      elif v > bounds[1]:
+        bounds[1] = v
+
+  # Recomputes the zone of a page from all of its packed tuples.
+  def summarize(self, pageIndex, tuples):
+    self.ensure(pageIndex + 1)
+    self.zones[pageIndex] = None
+    for tupleData in tuples:
+      self.add(pageIndex, tupleData)
+
+  # Returns whether a page may hold tuples within the given ranges, passed
+  # as a dictionary mapping column names to (lo, hi) pairs. Columns without
+  # a zone do not restrict the match.
+  def mayMatch(self, pageIndex, ranges):
+    zone = self.zones[pageIndex] if pageIndex < len(self.zones) else None
+    if zone is None:
+      return False
+    for (column, (lo, hi)) in ranges.items():
+      if column in self.columns:
+        (zmin, zmax) = zone[self.columns.index(column)]
+        if (lo is not None and zmax < lo) or (hi is not None and zmin > hi):
+          return False
+    return True
+
+  # Returns a binary representation of this zone map.
+  def pack(self):
+    names = ','.join(self.columns).encode()
+    parts = [self.binrepr.pack(self.magic, self.epoch, len(self.zones), len(names)), names]
+    for zone in self.zones:
+      if zone is None:
+        parts.append(self.empty)
+      else:
+        parts.append(self.entry.pack(1, *[v for bounds in zone for v in bounds]))
+    return b''.join(parts)
+
+  # Constructs a zone map from its binary representation. Returns None if the
+  # representation does not hold a zone map of the schema.
+  @classmethod
+  def unpack(cls, schema, buffer):
+    if len(buffer) < cls.binrepr.size:
+      return None
+    (magic, epoch, numPages, length) = cls.binrepr.unpack_from(buffer)
+    if magic != cls.magic:
+      return None
+    start   = cls.binrepr.size
+    columns = buffer[start: start + length].decode().split(',') if length else []
+    zm      = cls(schema, columns)
+    zm.epoch = epoch
+    start  += length
+    if len(buffer) != start + numPages * zm.entry.size:
+      return None
+    for entry in zm.entry.iter_unpack(buffer[start:]):
+      values = [unpadded(v) for v in entry[1:]]
+      zm.zones.append([values[i: i + 2] for i in range(0, len(values), 2)] if entry[0] else None)
+    return zm
+
+
+class ZonedHeapFile(HeapFile):
+  """
+  A heap file maintaining a zone map over selected columns of its tuples.
+
+  Zones are widened on insert and bulk load, and recomputed from the page on
+  updates and deletes. Scans given column ranges skip the pages whose zones
+  cannot match, and count the pages read and skipped in 'scanStats'. The zone
+  map is saved alongside the free-space map, and rebuilt from the pages if
+  its side file is missing, summarizes other columns, or was saved at
+  another write epoch of the heap file, as pages were written after it.
+
+  >>> import tempfile, os
+  >>> from Catalog.Identifiers import FileId
+  >>> from Catalog.Schema      import DBSchema
+
+  # Test harness setup.
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> path   = os.path.join(tempfile.mkdtemp(), 'employee.heap')
+  >>> hf     = ZonedHeapFile(path, FileId(1), schema=schema, pageSize=256, zoneColumns=['id'])
+  >>> hf.bulkLoad([b''.join(schema.pack(schema.instantiate(i, i % 50)) for i in range(1000))])
+  1000
+
+  # Range scans read only the pages whose zones overlap the range.
+  >>> [schema.unpack(t).id for (_, t) in hf.scan({'id': (500, 505)})]
+  [500, 501, 502, 503, 504, 505]
+  >>> hf.scanStats
+  {'pagesRead': 1, 'pagesSkipped': 32}
+
+  # Zones follow inserts, updates and deletes.
+  >>> tId = hf.insertTuple(schema.pack(schema.instantiate(5000, 1)))
+  >>> len(list(hf.scan({'id': (4000, None)}))), hf.scanStats['pagesRead']
+  (1, 1)
+  >>> hf.putTuple(tId, schema.pack(schema.instantiate(3000, 1)))
+  >>> hf.zoneMap.zones[tId.pageId.pageIndex][0][1]
+  3000
+  >>> hf.deleteTuple(tId)
+  >>> len(list(hf.scan({'id': (2000, None)}))), hf.scanStats['pagesRead']
+  (0, 0)
+
+  # The zone map persists across reopening.
+  >>> hf.close()
+  >>> hf = ZonedHeapFile(path, FileId(1), schema=schema, zoneColumns=['id'])
+  >>> len(list(hf.scan({'id': (None, 99)}))), hf.scanStats['pagesRead']
+  (100, 4)
+
+  # A zone map saved before later page writes is rebuilt, e.g., after a
+  # crash following the eviction of a dirty page.
+  >>> tId = hf.insertTuple(schema.pack(schema.instantiate(9000, 1)))
+  >>> hf.bufferPool.flushPages()
+  >>> hf.file.close()
+  >>> hf = ZonedHeapFile(path, FileId(1), schema=schema, zoneColumns=['id'])
+  >>> [schema.unpack(t).id for (_, t) in hf.scan({'id': (9000, None)})]
+  [9000]
+  >>> hf.close()
+
+  # Text columns match unpadded bounds.
+  >>> schema = DBSchema('employee', [('id', 'int'), ('name', 'char(4)')])
+  >>> hf     = ZonedHeapFile(path + '.text', FileId(2), schema=schema, zoneColumns=['name'])
+  >>> tIds   = [hf.insertTuple(schema.pack(schema.instantiate(i, name)))
+  ...             for (i, name) in enumerate([b'al', b'bob', b'cy'])]
+  >>> [schema.unpack(t).id for (_, t) in hf.scan({'name': (b'bob', b'cy')})]
+  [1, 2]
+  >>> [schema.unpack(t).id for (_, t) in hf.scan({'name': (b'cy', b'cy')})]
+  [2]
+  >>> hf.close()
+  """
+
+  # Zoned heap file constructor. In addition to the heap file arguments:
+  #
+  # zoneColumns  : the names of the columns summarized by the zone map
+  def __init__(self, filePath, fileId, **kwargs):
+    super().__init__(filePath, fileId, **kwargs)
+    self.scanStats = { 'pagesRead': 0, 'pagesSkipped': 0 }
+    self.loadZoneMap(kwargs.get("zoneColumns", ()))
+
+  def zoneMapPath(self):
+    return self.filePath + '.zmap'
+
+  # Loads the zone map, rebuilding it from the pages if its side file is
+  # missing, out of date, or summarizes different columns.
+  def loadZoneMap(self, columns):
+    zm = None
+    if os.path.exists(self.zoneMapPath()):
+      with open(self.zoneMapPath(), 'rb') as f:
+        zm = ZoneMap.unpack(self.schema, f.read())
+    if zm is None or zm.columns != list(columns) or zm.epoch != self.epoch \
+       or len(zm.zones) != self.pageCount:
+      zm = ZoneMap(self.schema, columns)
+      for pageIndex in range(self.pageCount):
+        self.summarizePage(pageIndex, zm)
+    self.zoneMap = zm
+
+  def saveZoneMap(self):
+    self.zoneMap.epoch = self.epoch
+    with open(self.zoneMapPath(), 'wb') as f:
+      f.write(self.zoneMap.pack())
+
+  # Recomputes the zone of a page from the tuples held in the buffer pool.
+  def summarizePage(self, pageIndex, zoneMap=None):
+    (zoneMap or self.zoneMap).summarize(pageIndex, [t for (_, t) in self.pageTuples(pageIndex)])
+
+  # Heap file overrides maintaining the zone map.
+
+  def allocatePage(self):
+    pageIndex = super().allocatePage()
+    self.zoneMap.ensure(pageIndex + 1)
+    return pageIndex
+
+  def insertIntoPage(self, pageIndex, tupleData):
+    tupleId = super().insertIntoPage(pageIndex, tupleData)
+    if tupleId is not None:
+      self.zoneMap.add(pageIndex, tupleData)
+    return tupleId
+
+  def appendedPage(self, page, tuples):
+    self.zoneMap.summarize(page.pageId.pageIndex, tuples)
+
+  def putTuple(self, tupleId, tupleData):
+    super().putTuple(tupleId, tupleData)
+    self.summarizePage(tupleId.pageId.pageIndex)
+
+  def deleteTuple(self, tupleId):
+    super().deleteTuple(tupleId)
+    self.summarizePage(tupleId.pageId.pageIndex)
+
+  # Returns the indexes of the pages that may hold tuples within 'ranges',
+  # a dictionary mapping column names to (lo, hi) pairs. Updates 'scanStats'.
+  def matchingPages(self, ranges):
+    if not ranges:
+      matches = list(range(self.pageCount))
+    else:
+      matches = [i for i in range(self.pageCount) if self.zoneMap.mayMatch(i, ranges)]
+    self.scanStats = { 'pagesRead'    : len(matches),
+                       'pagesSkipped' : self.pageCount - len(matches) }
+    return matches
+
+  # Sequential scan, yielding (TupleId, bytes) pairs in file order. With
+  # 'ranges', only pages whose zones match are read, and only their tuples
+  # within all ranges are yielded.
+  def scan(self, ranges=None):
+    fields = list(self.schema.fields)
+    bounds = [(fields.index(column), lo, hi) for (column, (lo, hi)) in (ranges or {}).items()]
+    unpack = self.schema.binrepr.unpack
+    for pageIndex in self.matchingPages(ranges):
+      tuples = self.pageTuples(pageIndex)
+      if bounds:
+        tuples = [(tupleId, t) for (tupleId, t) in tuples
+                    if self.inRanges(unpack(t), bounds)]
+      yield from tuples
+
+  @staticmethod
+  def inRanges(values, bounds):
+    for (i, lo, hi) in bounds:
+      v = unpadded(values[i])
+      if (lo is not None and v < lo) or (hi is not None and v > hi):
+        return False
+    return True
+
+  # Yields the pages whose zones match 'ranges', e.g., as input to a PageScan.
+  # Each page stays pinned until the next page is requested, after which its
+  # buffer pool frame may be reused, so views over the page must not be kept.
+  def scanPages(self, ranges=None):
+    for pageIndex in self.matchingPages(ranges):
+      pageId = self.pageId(pageIndex)
+      page   = self.bufferPool.getPage(pageId)
+      try:
+        yield page
+      finally:
+        self.bufferPool.unpinPage(pageId)
+
+  def flush(self):
+    super().flush()
+    self.saveZoneMap()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,349 @@
+import json, os, platform, shutil, sys, tempfile, time
+from multiprocessing import Pool
+
+import records, tpchgen, warmup
+from records import CompactLineitem
+from warmup import Lineitem, Orders
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+# A benchmark suite for the storage layer, run over synthetic TPC-H tables.
+#
+# For each scale factor, the tables are generated as CSV files, and each case
+# is run over them in a fresh worker process, so that its peak RSS is not
+# inflated by earlier cases. A case times only its measured operations, not
+# its setup, and reports the number of operations and bytes processed.
+# Results are saved as JSON, and may be compared against a baseline run.
+
+hw1Dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'HW1')
+
+defaultScaleFactors = (0.001, 0.01)
+
+# Imports the page-level storage modules from the HW1 directory.
+def storageModules():
+  if hw1Dir not in sys.path:
+    sys.path.insert(0, hw1Dir)
+  from Catalog.Identifiers import FileId, PageId, TupleId
+  from page import Page
+  from heapfile import HeapFile
+  from parallelload import RecordSchema
+  return (FileId, PageId, TupleId, Page, HeapFile, RecordSchema)
+
+def tablePath(workDir, name):
+  return os.path.join(workDir, name)
+
+# Returns the packed lineitem records of the benchmark tables, as bytes objects.
+def lineitemRecords(workDir):
+  with open(tablePath(workDir, 'lineitem.bin'), 'rb') as f:
+    data = f.read()
+  size = Lineitem.byteSize()
+  return [data[i: i + size] for i in range(0, len(data), size)]
+
+# Fills pages with the given packed records, returning the list of pages.
+def fillPages(records, pageSize=4096):
+  (FileId, PageId, TupleId, Page, HeapFile, RecordSchema) = storageModules()
+  schema = RecordSchema(Lineitem)
+  pages  = []
+  page   = None
+  for record in records:
+    if page is None or not page.header.hasFreeTuple():
+      page = Page(pageId=PageId(FileId(0), len(pages)), buffer=bytes(pageSize), schema=schema)
+      pages.append(page)
+    page.insertTuple(record)
+  return pages
+
+# Benchmark cases. Each takes the directory holding the benchmark tables and
+# the scale factor, and returns the number of operations timed, the number of
+# bytes they processed, and the elapsed seconds, optionally followed by a
+# dictionary of further measurements.
+
+def benchGenerate(workDir, scaleFactor):
+  start = time.perf_counter()
+  rows  = sum(tpchgen.writeTables(scaleFactor, tablePath(workDir, 'orders.csv'),
+                                  tablePath(workDir, 'lineitem.csv')))
+  seconds = time.perf_counter() - start
+  return (rows, os.path.getsize(tablePath(workDir, 'orders.csv'))
+                + os.path.getsize(tablePath(workDir, 'lineitem.csv')), seconds)
+
+def benchCsvLoad(workDir, scaleFactor):
+  start = time.perf_counter()
+  rows  = 0
+  byts  = 0
+  for (name, cls) in (('lineitem', Lineitem), ('orders', Orders)):
+    rows += warmup.bulkLoadCsv(tablePath(workDir, name + '.csv'),
+                               tablePath(workDir, name + '.bin'), cls).rows
+    byts += os.path.getsize(tablePath(workDir, name + '.csv'))
+  return (rows, byts, time.perf_counter() - start)
+
+def benchPack(workDir, scaleFactor):
+  objects = warmup.readBinaryFile(tablePath(workDir, 'lineitem.bin'), Lineitem)
+  start   = time.perf_counter()
+  for obj in objects:
+    obj.pack()
+  seconds = time.perf_counter() - start
+  return (len(objects), len(objects) * Lineitem.byteSize(), seconds)
+
+# Unpacks lineitem records with a record class. Also reports the memory
+# allocated per unpacked record, measured in a separate pass.
+def unpackRecords(workDir, cls):
+  packed = lineitemRecords(workDir)
+  start  = time.perf_counter()
+  for record in packed:
+    cls.unpack(record)
+  seconds = time.perf_counter() - start
+  (bytesPerRow, _) = records.rowFootprint(cls, packed)
+  return (len(packed), len(packed) * cls.byteSize(), seconds, {'bytesPerRow': bytesPerRow})
+
+# Constructs records from lineitem column values with a record class, through
+# its constructor or, for compact record classes, 'fromValues'.
+def constructRecords(workDir, cls, fromValues=False):
+  rows  = list(warmup.streamBinaryFile(tablePath(workDir, 'lineitem.bin'), Lineitem))
+  start = time.perf_counter()
+  if fromValues:
+    for row in rows:
+      cls.fromValues(row)
+  else:
+    for row in rows:
+      cls(*row)
+  seconds = time.perf_counter() - start
+  return (len(rows), len(rows) * cls.byteSize(), seconds)
+
+def benchUnpack(workDir, scaleFactor):
+  return unpackRecords(workDir, Lineitem)
+
+def benchCompactUnpack(workDir, scaleFactor):
+  return unpackRecords(workDir, CompactLineitem)
+
+def benchConstruct(workDir, scaleFactor):
+  return constructRecords(workDir, Lineitem)
+
+def benchCompactConstruct(workDir, scaleFactor):
+  return constructRecords(workDir, CompactLineitem, fromValues=True)
+
+def benchBinaryWrite(workDir, scaleFactor):
+  objects = warmup.readBinaryFile(tablePath(workDir, 'lineitem.bin'), Lineitem)
+  start   = time.perf_counter()
+  warmup.writeBinaryFile(tablePath(workDir, 'lineitem.out'), objects)
+  seconds = time.perf_counter() - start
+  return (len(objects), os.path.getsize(tablePath(workDir, 'lineitem.out')), seconds)
+
+def benchBinaryRead(workDir, scaleFactor):
+  start   = time.perf_counter()
+  objects = warmup.readBinaryFile(tablePath(workDir, 'lineitem.bin'), Lineitem)
+  seconds = time.perf_counter() - start
+  return (len(objects), os.path.getsize(tablePath(workDir, 'lineitem.bin')), seconds)
+
+def benchPageInsert(workDir, scaleFactor):
+  records = lineitemRecords(workDir)
+  start   = time.perf_counter()
+  fillPages(records)
+  seconds = time.perf_counter() - start
+  return (len(records), len(records) * Lineitem.byteSize(), seconds)
+
+def benchPageGet(workDir, scaleFactor):
+  pages    = fillPages(lineitemRecords(workDir))
+  tupleIds = [(page, tupleId) for page in pages for tupleId in page.tupleIds()]
+  start    = time.perf_counter()
+  for (page, tupleId) in tupleIds:
+    page.getTuple(tupleId)
+  seconds = time.perf_counter() - start
+  return (len(tupleIds), len(tupleIds) * Lineitem.byteSize(), seconds)
+
+def benchPageIterate(workDir, scaleFactor):
+  pages = fillPages(lineitemRecords(workDir))
+  rows  = 0
+  start = time.perf_counter()
+  for page in pages:
+    for _ in page:
+      rows += 1
+  seconds = time.perf_counter() - start
+  return (rows, rows * Lineitem.byteSize(), seconds)
+
+# Deletes every tuple from the front of its page, so each delete shifts the
+# remaining tuples of the page.
+def benchPageDelete(workDir, scaleFactor):
+  (FileId, PageId, TupleId, Page, HeapFile, RecordSchema) = storageModules()
+  pages   = fillPages(lineitemRecords(workDir))
+  deletes = [(page, TupleId(page.pageId, 0), page.header.numTuples()) for page in pages]
+  rows    = sum(n for (_, _, n) in deletes)
+  start   = time.perf_counter()
+  for (page, tupleId, n) in deletes:
+    for _ in range(n):
+      page.deleteTuple(tupleId)
+  seconds = time.perf_counter() - start
+  return (rows, rows * Lineitem.byteSize(), seconds)
+
+def benchHeapScan(workDir, scaleFactor):
+  (FileId, PageId, TupleId, Page, HeapFile, RecordSchema) = storageModules()
+  path = tablePath(workDir, 'lineitem.heap')
+  with HeapFile(path, FileId(0), schema=RecordSchema(Lineitem)) as hf:
+    hf.bulkLoad(warmup.packBatches(warmup.streamBinaryFile(tablePath(workDir, 'lineitem.bin'),
+                                                          Lineitem), Lineitem))
+  with HeapFile(path, FileId(0), schema=RecordSchema(Lineitem)) as hf:
+    rows  = 0
+    start = time.perf_counter()
+    for _ in hf.scan():
+      rows += 1
+    seconds = time.perf_counter() - start
+  return (rows, os.path.getsize(path), seconds)
+
+def benchMappedScan(workDir, scaleFactor):
+  path  = tablePath(workDir, 'lineitem.bin')
+  rows  = 0
+  start = time.perf_counter()
+  with warmup.mapBinaryFile(path, Lineitem) as f:
+    for _ in f.scan(*Lineitem.columns):
+      rows += 1
+  seconds = time.perf_counter() - start
+  return (rows, os.path.getsize(path), seconds)
+
+# Benchmark cases, in the order they are run. The first two produce the
+# tables used by the others, and always run.
+cases = { 'generate'         : benchGenerate,
+          'csvLoad'          : benchCsvLoad,
+          'pack'             : benchPack,
+          'unpack'           : benchUnpack,
+          'compactUnpack'    : benchCompactUnpack,
+          'construct'        : benchConstruct,
+          'compactConstruct' : benchCompactConstruct,
+          'binaryWrite'      : benchBinaryWrite,
+          'binaryRead'       : benchBinaryRead,
+          'pageInsert'       : benchPageInsert,
+          'pageGet'          : benchPageGet,
+          'pageIterate'      : benchPageIterate,
+          'pageDelete'       : benchPageDelete,
+          'heapScan'         : benchHeapScan,
+          'mappedScan'       : benchMappedScan }
+setupCases = ('generate', 'csvLoad')
+
+# Returns the peak resident set size of this process in MB, or None if unknown.
+def peakRssMB():
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, macOS bytes.
+  return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+# Runs a single case, returning its result dictionary. With 'profile', the
+# case runs with storage instrumentation and a sampling profiler, whose
+# snapshots are added to the result, and whose overhead inflates its timing.
+def runCase(name, workDir, scaleFactor, profile=False):
+  if profile:
+    # Instrumentation wraps the HW1 page classes, which storageModules makes
+    # importable.
+    storageModules()
+    from instrument import SamplingProfiler, instrumentation
+    instrumentation.reset()
+    with instrumentation, SamplingProfiler() as profiler:
+      (ops, byts, seconds, *extra) = cases[name](workDir, scaleFactor)
+    extra.append({ 'instrumentation' : instrumentation.snapshot(pages=False),
+                   'profile'         : profiler.snapshot(top=15) })
+  else:
+    (ops, byts, seconds, *extra) = cases[name](workDir, scaleFactor)
+  result = { 'case'        : name,
+             'scaleFactor' : scaleFactor,
+             'ops'         : ops,
+             'bytes'       : byts,
+             'seconds'     : seconds,
+             'opsPerSec'   : ops / seconds if seconds > 0 else float('inf'),
+             'MBps'        : byts / seconds / 1e6 if seconds > 0 else float('inf'),
+             'peakRssMB'   : peakRssMB() }
+  for measurements in extra:
+    result.update(measurements)
+  return result
+
+# Runs the named cases at each scale factor, returning a list of results.
+# Cases run in fresh worker processes, unless 'isolate' is unset.
+def runBenchmarks(scaleFactors=defaultScaleFactors, names=None, isolate=True, tempDir=None,
+                  profile=False):
+  """
+  >>> results = runBenchmarks([0.0005], ['pageInsert', 'heapScan'])
+  >>> [(r['case'], r['ops']) for r in results]
+  [('generate', 3722), ('csvLoad', 3722), ('pageInsert', 2972), ('heapScan', 2972)]
+  >>> all(r['opsPerSec'] > 0 and r['peakRssMB'] > 0 for r in results)
+  True
+  """
+  names   = [name for name in cases if name in setupCases or names is None or name in names]
+  results = []
+  pool    = Pool(1, maxtasksperchild=1) if isolate else None
+  try:
+    for scaleFactor in scaleFactors:
+      workDir = tempfile.mkdtemp(dir=tempDir)
+      try:
+        for name in names:
+          if pool:
+            results.append(pool.apply(runCase, (name, workDir, scaleFactor, profile)))
+          else:
+            results.append(runCase(name, workDir, scaleFactor, profile))
+      finally:
+        shutil.rmtree(workDir)
+  finally:
+    if pool:
+      pool.close()
+      pool.join()
+  return results
+
+# Saves results as JSON, along with a description of the environment.
+def writeResults(outPath, results):
+  with open(outPath, 'w') as f:
+    json.dump({ 'timestamp' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python'    : platform.python_version(),
+                'platform'  : platform.platform(),
+                'results'   : results }, f, indent=2)
+
+def readResults(inPath):
+  with open(inPath) as f:
+    return json.load(f)['results']
+
+# Returns the throughput of each result relative to the matching baseline
+# result, as a dictionary keyed by (case, scaleFactor).
+def compareResults(baseline, results):
+  """
+  >>> base = [{'case': 'pack', 'scaleFactor': 0.01, 'opsPerSec': 100.0}]
+  >>> compareResults(base, [{'case': 'pack', 'scaleFactor': 0.01, 'opsPerSec': 150.0}])
+  {('pack', 0.01): 1.5}
+  """
+  base = {(r['case'], r['scaleFactor']): r['opsPerSec'] for r in baseline}
+  return {(r['case'], r['scaleFactor']): r['opsPerSec'] / base[(r['case'], r['scaleFactor'])]
+            for r in results if base.get((r['case'], r['scaleFactor']))}
+
+# Formats results as a table, with speedups against a baseline if given.
+# Memory per record is shown for the cases measuring it.
+def formatResults(results, speedups=None):
+  lines = ['%16s %8s %10s %14s %10s %10s %8s' % ('case', 'scale', 'ops', 'ops/s', 'MB/s',
+                                                 'peak MB', 'B/row')]
+  for r in results:
+    rowBytes = '%8.0f' % r['bytesPerRow'] if 'bytesPerRow' in r else '%8s' % '-'
+    line = '%16s %8g %10d %14.0f %10.1f %10.1f %s' % (r['case'], r['scaleFactor'], r['ops'],
+                                                      r['opsPerSec'], r['MBps'],
+                                                      r['peakRssMB'] or 0, rowBytes)
+    if speedups and (r['case'], r['scaleFactor']) in speedups:
+      line += ' %8.2fx' % speedups[(r['case'], r['scaleFactor'])]
+    lines.append(line)
+  return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+  if len(sys.argv) > 1:
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmarks the storage layer.")
+    parser.add_argument('-s', '--scale', type=float, nargs='+', default=defaultScaleFactors,
+                        help="TPC-H scale factors")
+    parser.add_argument('-c', '--cases', nargs='+', choices=list(cases), help="cases to run")
+    parser.add_argument('-o', '--output', help="JSON file to save results to")
+    parser.add_argument('-b', '--baseline', help="JSON results to compare against")
+    parser.add_argument('-p', '--profile', action='store_true',
+                        help="record storage counters and profiles (slows cases down)")
+    args = parser.parse_args()
+
+    results  = runBenchmarks(args.scale, args.cases, profile=args.profile)
+    speedups = compareResults(readResults(args.baseline), results) if args.baseline else None
+    print(formatResults(results, speedups))
+    if args.output:
+      writeResults(args.output, results)
+  else:
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,231 @@
+import mmap, os, struct
+
+import numpy as np
+
+from HW1.structformat import dtypeSpec
+from warmup import columnLayout, ioBufferSize
+
+# A column file stores each column of a record file contiguously.
+#
+# File layout:
+#   file header   : magic, format version, column count and row count.
+#   column header : one entry per column with its name, NumPy dtype string,
+#                   and the byte offset of the column's data in the file.
+#   column data   : each column as a contiguous array, aligned to 'alignment'.
+#
+# Columns are loaded as NumPy arrays over a memory map of the file, so
+# opening a column file does not copy or decode any data.
+
+fileHeader   = struct.Struct("<4sHHQ")
+columnHeader = struct.Struct("<32s8sQ")
+magic        = b'COLF'
+version      = 1
+alignment    = 64
+
+# Number of rows converted per chunk when building a column file.
+chunkRows = 1 << 16
+
+# Returns a NumPy structured dtype matching records packed by the struct
+# format 'fmt' into 'itemsize' bytes, with the given field names.
+def formatDtype(fmt, names, itemsize):
+  """
+  >>> dt = formatDtype("<ib4s", ['a', 'b', 'c'], 9)
+  >>> [(name, dt.fields[name][0].str, dt.fields[name][1]) for name in dt.names]
+  [('a', '<i4', 0), ('b', '|i1', 4), ('c', '|S4', 5)]
+  """
+  return np.dtype(dtypeSpec(fmt, names, itemsize))
+
+# Returns a NumPy structured dtype matching the packed layout of 'cls' records.
+def recordDtype(cls):
+  return formatDtype(cls.fmt, cls.columns, cls.byteSize())
+
+def alignUp(offset):
+  return (offset + alignment - 1) // alignment * alignment
+
+# Convert a binary file of packed 'cls' records (e.g., as written by
+# warmup.bulkLoadCsv) into a column file, in chunks of 'chunkRows' rows.
+def writeColumnarFile(outPath, inPath, cls, chunkSize=chunkRows):
+  dtype   = recordDtype(cls)
+  numRows = os.path.getsize(inPath) // dtype.itemsize
+  rows    = np.memmap(inPath, dtype=dtype, mode='r', shape=(numRows,)) if numRows else np.empty(0, dtype)
+
+  # Lay out the columns after the headers.
+  offsets = []
+  offset  = alignUp(fileHeader.size + len(dtype.names) * columnHeader.size)
+  for name in dtype.names:
+    offsets.append(offset)
+    offset = alignUp(offset + numRows * dtype.fields[name][0].itemsize)
+
+  with open(outPath, 'wb', buffering=ioBufferSize) as f:
+    f.write(fileHeader.pack(magic, version, len(dtype.names), numRows))
+    for name, colOffset in zip(dtype.names, offsets):
+      f.write(columnHeader.pack(name.encode(), dtype.fields[name][0].str.encode(), colOffset))
+    for name, colOffset in zip(dtype.names, offsets):
+      f.seek(colOffset)
+      for start in range(0, numRows, chunkSize):
+        f.write(np.ascontiguousarray(rows[name][start: start + chunkSize]).data)
+    f.truncate(offset)
+  return numRows
+
+class ColumnarFile(object):
+  """
+  A read-only column file, with each column exposed as a NumPy array.
+
+  Column arrays are views over a memory map of the file. Only the pages of
+  the columns a query actually touches are read from disk.
+
+  Column files should be closed once all column arrays are released, for
+  example by using the file as a context manager.
+
+  >>> import os, tempfile
+  >>> from warmup import Lineitem, packBatches, writeBatches
+
+  # Test harness setup: a hand-built lineitem file.
+  >>> d    = tempfile.mkdtemp()
+  >>> rows = [(1, 1, 1, 1, 10.0, 1000.0, 0.0625, 0.125, b'N', b'O', b'1994-03-01'),
+  ...         (1, 2, 1, 2, 30.0, 2000.0, 0.0625, 0.0,   b'R', b'F', b'1994-06-01'),
+  ...         (2, 3, 1, 1,  5.0,  400.0, 0.125,  0.0,   b'A', b'F', b'1994-07-01'),
+  ...         (3, 4, 1, 1, 20.0, 3000.0, 0.0625, 0.0,   b'N', b'O', b'1995-02-01')]
+  >>> rows = [r + (b'1994-01-01', b'1994-01-01', b'NONE', b'MAIL', b'') for r in rows]
+  >>> writeBatches(os.path.join(d, 'lineitem.bin'), packBatches(rows, Lineitem)) // Lineitem.byteSize()
+  4
+  >>> writeColumnarFile(os.path.join(d, 'lineitem.col'), os.path.join(d, 'lineitem.bin'), Lineitem,
+  ...                   chunkSize=3)
+  4
+
+  # Columns hold the records' values.
+  >>> f = ColumnarFile(os.path.join(d, 'lineitem.col'))
+  >>> len(f), f.names() == list(Lineitem.columns)
+  (4, True)
+  >>> f['l_partkey'].tolist(), f['l_shipmode'].tolist()[0]
+  ([1, 2, 3, 4], b'MAIL')
+
+  # Q6 keeps only the first row: the second exceeds the quantity, the third
+  # the discount, and the fourth the ship date range.
+  >>> q6Revenue(f, b'1994-01-01', b'1995-01-01', 0.05, 0.07, 24)
+  62.5
+
+  # Q1 groups the rows shipped by the end of 1994.
+  >>> summary = q1Summary(f, b'1994-12-31')
+  >>> sorted((group, agg['count_order'], float(agg['sum_qty'])) for group, agg in summary.items())
+  [((b'A', b'F'), 1, 5.0), ((b'N', b'O'), 1, 10.0), ((b'R', b'F'), 1, 30.0)]
+  >>> float(summary[(b'N', b'O')]['sum_charge'])
+  1054.6875
+  >>> f.close()
+  """
+
+  def __init__(self, inPath):
+    with open(inPath, 'rb') as f:
+      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    (fileMagic, fileVersion, numColumns, self.numRows) = fileHeader.unpack_from(self.map)
+    if fileMagic != magic or fileVersion != version:
+      self.map.close()
+      raise ValueError("Not a column file: " + inPath)
+
+    self.columns = {}
+    for i in range(numColumns):
+      (name, dtype, offset) = columnHeader.unpack_from(self.map, fileHeader.size + i * columnHeader.size)
+      self.columns[name.rstrip(b'\x00').decode()] = \
+        np.frombuffer(self.map, dtype=np.dtype(dtype.rstrip(b'\x00').decode()),
+                      count=self.numRows, offset=offset)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self):
+    self.columns = {}
+    self.map.close()
+
+  def __len__(self):
+    return self.numRows
+
+  def __getitem__(self, name):
+    return self.columns[name]
+
+  def names(self):
+    return list(self.columns)
+
+# Vectorized scan helpers.
+
+# Returns a boolean mask selecting values in the closed range [lo, hi].
+def between(column, lo, hi):
+  return (column >= lo) & (column <= hi)
+
+# Returns the given columns restricted to the rows selected by 'mask'.
+def select(mask, *columns):
+  return [column[mask] for column in columns]
+
+# Returns the distinct combinations of 'keys', as a list of key tuples, and
+# the group number of every row.
+def groupBy(keys):
+  groups, inverse = np.unique(np.rec.fromarrays(keys), return_inverse=True)
+  return ([tuple(g) for g in groups.tolist()], inverse.ravel())
+
+# Returns a sum of 'values' per distinct combination of 'keys'.
+# The result is a pair of (list of key tuples, NumPy array of sums).
+def groupSum(keys, values):
+  """
+  >>> (groups, sums) = groupSum([np.array([1, 2, 1]), np.array([b'a', b'b', b'a'])],
+  ...                           np.array([1.0, 2.0, 3.0]))
+  >>> groups, sums.tolist()
+  ([(1, b'a'), (2, b'b')], [4.0, 2.0])
+  >>> groupSum([], np.array([1.0, 2.0]))[1].tolist()
+  [3.0]
+  """
+  if not keys:
+    return ([()], np.array([values.sum(dtype=np.float64)]))
+  groups, inverse = groupBy(keys)
+  return (groups, np.bincount(inverse, weights=values, minlength=len(groups)))
+
+# TPC-H Q6: revenue from discounted lineitems shipped in [shipLo, shipHi),
+# with a discount in [discountLo, discountHi] and a quantity below 'quantityMax'.
+def q6Revenue(lineitems, shipLo, shipHi, discountLo, discountHi, quantityMax):
+  shipdate = lineitems['l_shipdate']
+  discount = lineitems['l_discount']
+  mask     = (shipdate >= shipLo) & (shipdate < shipHi) \
+               & between(discount, discountLo, discountHi) \
+               & (lineitems['l_quantity'] < quantityMax)
+  price, discount = select(mask, lineitems['l_extendedprice'], discount)
+  return float(np.dot(price.astype(np.float64), discount.astype(np.float64)))
+
+# TPC-H Q1: pricing summary over lineitems shipped on or before 'shipMax',
+# grouped by return flag and line status.
+# Returns a dict mapping (l_returnflag, l_linestatus) to a dict of aggregates.
+def q1Summary(lineitems, shipMax):
+  mask = lineitems['l_shipdate'] <= shipMax
+  (flag, status, quantity, price, discount, tax) = \
+    select(mask, lineitems['l_returnflag'], lineitems['l_linestatus'],
+           lineitems['l_quantity'], lineitems['l_extendedprice'],
+           lineitems['l_discount'], lineitems['l_tax'])
+
+  price     = price.astype(np.float64)
+  discPrice = price * (1 - discount)
+  groups, inverse = groupBy([flag, status])
+  sums = lambda values: np.bincount(inverse, weights=values, minlength=len(groups))
+  sumQty       = sums(quantity)
+  sumPrice     = sums(price)
+  sumDiscPrice = sums(discPrice)
+  sumCharge    = sums(discPrice * (1 + tax))
+  sumDisc      = sums(discount)
+  count        = np.bincount(inverse, minlength=len(groups))
+
+  result = {}
+  for i, group in enumerate(groups):
+    n = count[i]
+    result[group] = { 'sum_qty'        : sumQty[i],
+                      'sum_base_price' : sumPrice[i],
+                      'sum_disc_price' : sumDiscPrice[i],
+                      'sum_charge'     : sumCharge[i],
+                      'avg_qty'        : sumQty[i] / n,
+                      'avg_price'      : sumPrice[i] / n,
+                      'avg_disc'       : sumDisc[i] / n,
+                      'count_order'    : int(n) }
+  return result
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,269 @@
+import datetime, struct, time
+
+from warmup import Lineitem, Orders, LoadStats, batchRows, columnFormats, ioBufferSize, \
+                   packBatches, streamCsvFile
+
+# An encoded record format stores DATE columns as int32 day numbers, and
+# dictionary-encodes low-cardinality TEXT columns as one-byte codes.
+# All other columns keep their representation from the record class.
+#
+# Encoded files begin with a header of 'headerCapacity' bytes, holding the
+# encoded struct format and the dictionary of each encoded column. Packed
+# rows follow immediately after the header.
+#
+# Header layout:
+#   magic, format version, and the number of dictionary-encoded columns.
+#   the encoded format string, as a length-prefixed string.
+#   for each dictionary-encoded column: its length-prefixed name, followed by
+#   the number of entries and each entry as a length-prefixed string.
+
+headerPrefix   = struct.Struct("<4sHH")
+lengthPrefix   = struct.Struct("<H")
+magic          = b'ENCF'
+version        = 1
+headerCapacity = 4096
+
+# Default DATE and dictionary-encoded columns for each record class.
+encodedColumns = {
+  Lineitem : (("l_shipdate", "l_commitdate", "l_receiptdate"),
+              ("l_shipinstruct", "l_shipmode")),
+  Orders   : (("o_orderdate",),
+              ("o_orderpriority",)),
+}
+
+epoch = datetime.date(1970, 1, 1).toordinal()
+
+# Convert a 'YYYY-MM-DD' date string to the number of days since 1970-01-01.
+def dateToDays(date):
+  if isinstance(date, bytes):
+    date = date.decode()
+  return datetime.date.fromisoformat(date).toordinal() - epoch
+
+# Convert a day number back to a 'YYYY-MM-DD' byte string.
+def daysToDate(days):
+  return datetime.date.fromordinal(days + epoch).isoformat().encode()
+
+class EncodedFormat(object):
+  """
+  An encoded record format for a record class.
+
+  The format converts value tuples of the record class (e.g., as produced by
+  warmup.streamCsvFile) to and from encoded value tuples, and provides a
+  'binrepr' struct for packing encoded tuples. The dictionaries of encoded
+  columns grow as new values are encoded, up to 256 entries per column.
+
+  >>> fmt = EncodedFormat(Orders)
+  >>> fmt.fmt
+  '<IIsfiB15sI79s'
+  >>> fmt.byteSize() < Orders.byteSize()
+  True
+
+  >>> row = (1, 370, b'O', 172799.5, b'1996-01-02', b'5-LOW', b'Clerk#000000951', 0, b'nstructions')
+  >>> enc = fmt.encode(row)
+  >>> enc[4:6]
+  (9497, 0)
+  >>> fmt.decode(enc) == row
+  True
+
+  # Dictionaries round-trip through the file header.
+  >>> fmt2 = EncodedFormat.unpackHeader(Orders, fmt.packHeader())
+  >>> fmt2.fmt == fmt.fmt and fmt2.dictionaries == fmt.dictionaries
+  True
+  >>> fmt2.code("o_orderpriority", b'5-LOW')
+  0
+  """
+
+  maxDictionarySize = 256
+
+  def __init__(self, cls, dateColumns=None, dictColumns=None, dictionaries=None):
+    defaultDates, defaultDicts = encodedColumns.get(cls, ((), ()))
+    self.cls          = cls
+    self.dateColumns  = tuple(defaultDates if dateColumns is None else dateColumns)
+    self.dictColumns  = tuple(defaultDicts if dictColumns is None else dictColumns)
+    self.dictionaries = dictionaries or {name: [] for name in self.dictColumns}
+    self.codes        = {name: {v: i for i, v in enumerate(values)}
+                           for name, values in self.dictionaries.items()}
+
+    codes = []
+    for name, code in zip(cls.columns, columnFormats(cls.fmt)):
+      if name in self.dateColumns:
+        codes.append('i')
+      elif name in self.dictColumns:
+        codes.append('B')
+      else:
+        codes.append(code)
+    self.fmt     = '<' + ''.join(codes)
+    self.binrepr = struct.Struct(self.fmt)
+
+    self.dateIndexes = [cls.columns.index(name) for name in self.dateColumns]
+    self.dictIndexes = [(cls.columns.index(name), name) for name in self.dictColumns]
+
+  def byteSize(self):
+    return self.binrepr.size
+
+  # Returns the dictionary code of 'value' in the given column, or None if
+  # the value does not occur in the column.
+  def code(self, column, value):
+    return self.codes[column].get(value)
+
+  # Returns the code of 'value', adding it to the column's dictionary if needed.
+  def encodeValue(self, column, value):
+    codes = self.codes[column]
+    code  = codes.get(value)
+    if code is None:
+      if len(codes) >= self.maxDictionarySize:
+        raise ValueError("Too many distinct values for encoded column " + column)
+      code = codes[value] = len(codes)
+      self.dictionaries[column].append(value)
+    return code
+
+  # Encode a value tuple of the record class.
+  def encode(self, row):
+    row = list(row)
+    for i in self.dateIndexes:
+      row[i] = dateToDays(row[i])
+    for i, name in self.dictIndexes:
+      row[i] = self.encodeValue(name, row[i])
+    return tuple(row)
+
+  # Decode an encoded value tuple, stripping any NUL padding from text columns.
+  def decode(self, row):
+    row = [v.rstrip(b'\x00') if isinstance(v, bytes) else v for v in row]
+    for i in self.dateIndexes:
+      row[i] = daysToDate(row[i])
+    for i, name in self.dictIndexes:
+      row[i] = self.dictionaries[name][row[i]]
+    return tuple(row)
+
+  # Returns a binary representation of the format and its dictionaries.
+  def packHeader(self):
+    def string(s):
+      return lengthPrefix.pack(len(s)) + s
+
+    parts = [headerPrefix.pack(magic, version, len(self.dictColumns)), string(self.fmt.encode())]
+    for name in self.dictColumns:
+      values = self.dictionaries[name]
+      parts.append(string(name.encode()))
+      parts.append(lengthPrefix.pack(len(values)))
+      parts.extend(string(v) for v in values)
+    header = b''.join(parts)
+    if len(header) > headerCapacity:
+      raise ValueError("Encoded file header exceeds %d bytes" % headerCapacity)
+    return header
+
+  # Constructs an encoded format for 'cls' from a binary header.
+  @classmethod
+  def unpackHeader(cls, recordClass, buffer):
+    offset = 0
+
+    def string():
+      nonlocal offset
+      (n,) = lengthPrefix.unpack_from(buffer, offset)
+      offset += lengthPrefix.size + n
+      return bytes(buffer[offset - n: offset])
+
+    (fileMagic, fileVersion, numDicts) = headerPrefix.unpack_from(buffer)
+    if fileMagic != magic or fileVersion != version:
+      raise ValueError("Not an encoded record file")
+    offset = headerPrefix.size
+    fmt    = string().decode()
+
+    dictionaries = {}
+    for _ in range(numDicts):
+      name = string().decode()
+      (n,) = lengthPrefix.unpack_from(buffer, offset)
+      offset += lengthPrefix.size
+      dictionaries[name] = [string() for _ in range(n)]
+
+    dateColumns = [name for name, code in zip(recordClass.columns, columnFormats(fmt[1:]))
+                     if code == 'i' and name not in dictionaries]
+    result = cls(recordClass, dateColumns, list(dictionaries), dictionaries)
+    if result.fmt != fmt:
+      raise ValueError("Encoded file format does not match " + recordClass.__name__)
+    return result
+
+# Write a stream of 'cls' value tuples to an encoded file.
+# Returns a pair of the encoded format used and the number of rows written.
+def writeEncodedFile(outPath, rows, cls, fmt=None):
+  """
+  >>> import os, tempfile
+  >>> path = os.path.join(tempfile.mkdtemp(), 'orders.enc')
+  >>> rows = [(i, 10 * i, b'O', i / 2, b'1996-01-%02d' % (i + 1), (b'5-LOW', b'1-URGENT')[i % 2],
+  ...          b'Clerk#%d' % i, 0, b'') for i in range(5)]
+  >>> fmt, n = writeEncodedFile(path, rows, Orders)
+  >>> n, os.path.getsize(path) == headerCapacity + 5 * fmt.byteSize()
+  (5, True)
+
+  # Encoded rows hold day numbers and codes, and decode to the original rows.
+  >>> encoded = list(streamEncodedFile(path, readEncodedHeader(path, Orders), batchSize=2))
+  >>> [(r[0], r[4], r[5]) for r in encoded]
+  [(0, 9496, 0), (1, 9497, 1), (2, 9498, 0), (3, 9499, 1), (4, 9500, 0)]
+  >>> [o.pack() for o in readEncodedFile(path, Orders)] == [Orders(*r).pack() for r in rows]
+  True
+  """
+  fmt     = fmt or EncodedFormat(cls)
+  written = 0
+  with open(outPath, 'wb', buffering=ioBufferSize) as f:
+    f.seek(headerCapacity)
+    for batch in packBatches(map(fmt.encode, rows), fmt):
+      f.write(batch)
+      written += len(batch)
+    f.seek(0)
+    f.write(fmt.packHeader())
+  return (fmt, written // fmt.byteSize())
+
+# Convert a CSV file into an encoded file in constant memory.
+# Returns a LoadStats object describing the load.
+def bulkLoadEncodedCsv(inPath, outPath, cls, delim='|'):
+  start        = time.perf_counter()
+  fmt, numRows = writeEncodedFile(outPath, streamCsvFile(inPath, cls, delim), cls)
+  return LoadStats(numRows, headerCapacity + numRows * fmt.byteSize(), time.perf_counter() - start)
+
+# Returns the encoded format stored in an encoded file's header.
+def readEncodedHeader(inPath, cls):
+  with open(inPath, 'rb') as f:
+    return EncodedFormat.unpackHeader(cls, f.read(headerCapacity))
+
+# Stream an encoded file as encoded value tuples.
+# Date columns are day numbers and dictionary columns are codes, so range
+# and equality predicates on them can be evaluated as integer comparisons.
+def streamEncodedFile(inPath, fmt, batchSize=batchRows):
+  rowSize = fmt.byteSize()
+  with open(inPath, 'rb', buffering=ioBufferSize) as f:
+    f.seek(headerCapacity)
+    while True:
+      chunk = f.read(rowSize * batchSize)
+      if not chunk:
+        break
+      usable = len(chunk) - len(chunk) % rowSize
+      yield from fmt.binrepr.iter_unpack(memoryview(chunk)[:usable])
+
+# Returns a predicate on encoded value tuples, holding when the given DATE
+# column lies in ['lo', 'hi'). The bounds are converted to day numbers once,
+# so each row is tested with integer comparisons only.
+def dateRange(fmt, column, lo, hi):
+  """
+  >>> fmt = EncodedFormat(Orders)
+  >>> inJanuary = dateRange(fmt, 'o_orderdate', '1996-01-01', b'1996-02-01')
+  >>> [inJanuary(fmt.encode((1, 1, b'O', 1.0, d, b'5-LOW', b'', 0, b'')))
+  ...    for d in (b'1995-12-31', b'1996-01-01', b'1996-01-31', b'1996-02-01')]
+  [False, True, True, False]
+  >>> dateRange(fmt, 'o_orderpriority', '1996-01-01', '1996-02-01')
+  Traceback (most recent call last):
+  ...
+  ValueError: Not an encoded DATE column: o_orderpriority
+  """
+  if column not in fmt.dateColumns:
+    raise ValueError("Not an encoded DATE column: " + column)
+  index    = fmt.cls.columns.index(column)
+  (lo, hi)   = (dateToDays(lo), dateToDays(hi))
+  return lambda row: lo <= row[index] < hi
+
+# Read an encoded file, and return a list of decoded 'cls' objects.
+def readEncodedFile(inPath, cls):
+  fmt = readEncodedHeader(inPath, cls)
+  return [cls(*fmt.decode(row)) for row in streamEncodedFile(inPath, fmt)]
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,200 @@
+import errno, heapq, os, shutil, tempfile, time
+from operator import itemgetter
+
+from warmup import LoadStats, columnLayout, ioBufferSize, projectionStruct
+
+# External merge sort of binary record files, as written by 'Lineitem.pack'.
+#
+# Run generation reads as many records as fit in the memory budget, decodes
+# only the sort key columns straight from the packed bytes, sorts record
+# indexes by key, and writes the records out in key order as a sorted run.
+# Runs are then combined with k-way heap merges, reading each run through its
+# own large buffer. When there are more runs than buffers fitting in memory,
+# runs are merged in several passes. The sort is stable.
+
+# Default memory budget of a sort, in bytes.
+defaultMemoryLimit = 64 << 20
+
+# Estimated memory used per record by run generation, in addition to the
+# packed record: its decoded key, and its entries in the key and index lists.
+keyOverhead = 128
+
+# Smallest read buffer given to each run during a merge.
+minMergeBuffer = 256 << 10
+
+# Statistics reported by the external sort.
+class SortStats(LoadStats):
+  def __init__(self, rows, byts, seconds, runs, passes):
+    LoadStats.__init__(self, rows, byts, seconds)
+    self.runs   = runs
+    self.passes = passes
+
+  def __repr__(self):
+    return "SortStats(rows=%d, bytes=%d, seconds=%.3f, rowsPerSec=%.0f, runs=%d, passes=%d)" \
+             % (self.rows, self.bytes, self.seconds, self.rowsPerSec(), self.runs, self.passes)
+
+# Returns a function decoding the sort keys of all 'cls' records in a buffer.
+# Only the key columns are read from the packed bytes, and single-column
+# keys are returned as plain values rather than 1-tuples.
+def keyDecoder(cls, keys):
+  positions  = {name: i for i, (name, _, _) in enumerate(columnLayout(cls))}
+  ordered    = sorted(keys, key=positions.__getitem__)
+  iterUnpack = projectionStruct(cls, ordered).iter_unpack
+  if len(keys) == 1:
+    return lambda buf: [k for (k,) in iterUnpack(buf)]
+  if ordered == list(keys):
+    return lambda buf: list(iterUnpack(buf))
+  reorder = itemgetter(*[ordered.index(name) for name in keys])
+  return lambda buf: [reorder(k) for k in iterUnpack(buf)]
+
+# Splits 'inPath' into sorted runs of at most 'runRows' records in 'runDir'.
+# Returns the run paths and the number of records read.
+def writeRuns(inPath, cls, decode, runRows, runDir):
+  rowSize = cls.byteSize()
+  runs    = []
+  numRows = 0
+  with open(inPath, 'rb', buffering=ioBufferSize) as f:
+    while True:
+      chunk = f.read(runRows * rowSize)
+      if not chunk:
+        break
+      # Drop any trailing partial record.
+      view   = memoryview(chunk)[:len(chunk) - len(chunk) % rowSize]
+      keys   = decode(view)
+      order  = sorted(range(len(keys)), key=keys.__getitem__)
+      path   = os.path.join(runDir, 'run%d' % len(runs))
+      with open(path, 'wb', buffering=ioBufferSize) as out:
+        for i in order:
+          out.write(view[i * rowSize: (i + 1) * rowSize])
+      view.release()
+      runs.append(path)
+      numRows += len(keys)
+  return (runs, numRows)
+
+# Yields (key, record) pairs of a sorted run, reading 'bufferSize' bytes at a time.
+def readRun(path, rowSize, decode, bufferSize):
+  bufferSize = max(rowSize, bufferSize - bufferSize % rowSize)
+  with open(path, 'rb', buffering=0) as f:
+    while True:
+      chunk = f.read(bufferSize)
+      if not chunk:
+        break
+      # Unbuffered reads may return less than requested, so carry over any
+      # partial record to the next chunk.
+      while len(chunk) % rowSize:
+        more = f.read(rowSize - len(chunk) % rowSize)
+        if not more:
+          raise ValueError("Truncated run file: " + path)
+        chunk += more
+      for (i, key) in enumerate(decode(chunk)):
+        yield (key, chunk[i * rowSize: (i + 1) * rowSize])
+
+# Merges sorted runs into 'outPath', dividing 'memoryLimit' between one read
+# buffer per run and an output buffer.
+def mergeRuns(runs, outPath, rowSize, decode, memoryLimit):
+  bufferSize = memoryLimit // (len(runs) + 1)
+  readers    = [readRun(path, rowSize, decode, bufferSize) for path in runs]
+  with open(outPath, 'wb', buffering=max(rowSize, bufferSize)) as out:
+    for (_, record) in heapq.merge(*readers, key=itemgetter(0)):
+      out.write(record)
+
+# Moves a file, copying it when 'tempDir' is on another file system than
+# the destination.
+def moveFile(path, outPath):
+  try:
+    os.replace(path, outPath)
+  except OSError as e:
+    if e.errno != errno.EXDEV:
+      raise
+    shutil.move(path, outPath)
+
+# Sorts the binary file of packed 'cls' records at 'inPath' on the given key
+# columns, writing the sorted records to 'outPath'.
+#
+# memoryLimit : the approximate peak memory of the sort, in bytes
+# tempDir     : the directory under which runs are written, by default the
+#               directory of 'outPath'
+#
+# Returns a SortStats object describing the sort, with the number of runs
+# generated and the number of merge passes over them.
+def externalSort(inPath, outPath, cls, keys, **kwargs):
+  """
+  >>> import os, random, tempfile
+  >>> from warmup import Orders, packBatches, writeBatches, streamBinaryFile
+
+  >>> d    = tempfile.mkdtemp()
+  >>> rows = [(random.randrange(1000), i, b'O', 1.0, b'1996-%02d-01' % (i % 12 + 1),
+  ...          b'5-LOW', b'Clerk', 0, b'') for i in range(20000)]
+  >>> writeBatches(os.path.join(d, 'orders.bin'), packBatches(rows, Orders)) // Orders.byteSize()
+  20000
+
+  # A small memory limit produces several runs, merged in multiple passes.
+  >>> stats = externalSort(os.path.join(d, 'orders.bin'), os.path.join(d, 'sorted.bin'), Orders,
+  ...                      ['o_orderkey'], memoryLimit=1 << 20)
+  >>> stats.rows, stats.runs > 1, stats.passes > 1
+  (20000, True, True)
+  >>> out = list(streamBinaryFile(os.path.join(d, 'sorted.bin'), Orders))
+  >>> [r[:2] for r in out] == sorted(r[:2] for r in rows)
+  True
+
+  # Multi-column keys need not follow the record's column order.
+  >>> stats = externalSort(os.path.join(d, 'orders.bin'), os.path.join(d, 'sorted.bin'), Orders,
+  ...                      ['o_orderdate', 'o_orderkey'], memoryLimit=1 << 20)
+  >>> out = list(streamBinaryFile(os.path.join(d, 'sorted.bin'), Orders))
+  >>> [(r[4][:10], r[0]) for r in out] == sorted((r[4], r[0]) for r in rows)
+  True
+  >>> sorted(os.listdir(d))
+  ['orders.bin', 'sorted.bin']
+
+  # Runs may be written on another file system than the output.
+  >>> from unittest import mock
+  >>> crossDevice = OSError(errno.EXDEV, 'Invalid cross-device link')
+  >>> with mock.patch('os.replace', side_effect=crossDevice):
+  ...   stats = externalSort(os.path.join(d, 'orders.bin'), os.path.join(d, 'sorted.bin'), Orders,
+  ...                        ['o_orderkey'], tempDir=tempfile.mkdtemp())
+  >>> stats.runs, os.path.getsize(os.path.join(d, 'sorted.bin')) // Orders.byteSize()
+  (1, 20000)
+  """
+  memoryLimit = kwargs.get("memoryLimit", defaultMemoryLimit)
+  tempDir     = kwargs.get("tempDir", None) or os.path.dirname(os.path.abspath(outPath))
+
+  start   = time.perf_counter()
+  rowSize = cls.byteSize()
+  decode  = keyDecoder(cls, keys)
+  runRows = max(1, memoryLimit // (rowSize + keyOverhead))
+  fanIn   = max(2, memoryLimit // minMergeBuffer - 1)
+  runDir  = tempfile.mkdtemp(dir=tempDir)
+  try:
+    (runs, numRows) = writeRuns(inPath, cls, decode, runRows, runDir)
+    numRuns = len(runs)
+    passes  = 0
+
+    # Merge groups of runs until a single pass can merge the remainder.
+    merged = 0
+    while len(runs) > fanIn:
+      nextRuns = []
+      for i in range(0, len(runs), fanIn):
+        path    = os.path.join(runDir, 'merge%d' % merged)
+        merged += 1
+        mergeRuns(runs[i: i + fanIn], path, rowSize, decode, memoryLimit)
+        for run in runs[i: i + fanIn]:
+          os.remove(run)
+        nextRuns.append(path)
+      runs    = nextRuns
+      passes += 1
+
+    if len(runs) == 1:
+      moveFile(runs[0], outPath)
+    else:
+      # Also covers an empty input, producing an empty output file.
+      mergeRuns(runs, outPath, rowSize, decode, memoryLimit)
+      passes += 1 if runs else 0
+  finally:
+    shutil.rmtree(runDir)
+
+  return SortStats(numRows, numRows * rowSize, time.perf_counter() - start, numRuns, passes)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
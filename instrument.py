@@ -0,0 +1,348 @@
+import functools, json, os, sys, threading, time
+from collections import Counter
+
+import warmup
+
+# Instrumentation of the storage layer.
+#
+# When enabled, instrumentation wraps the methods of the page classes and of
+# record classes with counting versions, and restores the original methods
+# when disabled, so disabled instrumentation costs nothing at all. Counters
+# are kept per page, keyed by page id, and aggregated into global totals:
+#
+#   tuplesInserted : tuples added to the page
+#   tuplesDeleted  : tuples removed from the page
+#   tuplesShifted  : tuples moved by deletes shifting later tuples, or by
+#                    compaction of slotted pages
+#   bytesMoved     : bytes copied when shifting or compacting tuples
+#   pagePacks      : page images packed, refreshing their header in place,
+#                    e.g., for writes (Page.pack and Page.packView)
+#   pageUnpacks    : pages constructed over page images, parsing their
+#                    header, e.g., for reads (Page.unpack and Page.wrap)
+#
+# Record classes count calls and seconds spent in their 'pack' and 'unpack'
+# methods. Counter updates are not synchronized, so counts taken while
+# several threads modify pages are approximate.
+#
+# A sampling profiler can be attached to any code, independently of the
+# counters. Snapshots of both can be exported as JSON.
+
+pageCounterNames = ('tuplesInserted', 'tuplesDeleted', 'tuplesShifted', 'bytesMoved',
+                    'pagePacks', 'pageUnpacks')
+recordCounterNames = ('packs', 'packSeconds', 'unpacks', 'unpackSeconds')
+
+# Imports the page classes from the HW1 directory, which must be importable,
+# e.g., with PYTHONPATH=HW1, so that they are the classes used by the other
+# HW1 modules.
+def pageClasses():
+  from page import Page
+  from slottedpage import SlottedPage
+  return (Page, SlottedPage)
+
+class Instrumentation:
+  """
+  Storage-layer counters, maintained while instrumentation is enabled.
+
+  >>> from Catalog.Identifiers import FileId, PageId
+  >>> from Catalog.Schema      import DBSchema
+  >>> (Page, SlottedPage) = pageClasses()
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> pId    = PageId(FileId(1), 0)
+
+  # Counters follow page operations while enabled.
+  >>> inst = Instrumentation()
+  >>> with inst:
+  ...   p = Page(pageId=pId, buffer=bytes(4096), schema=schema)
+  ...   tIds = [p.insertTuple(schema.pack(schema.instantiate(i, 20))) for i in range(9)]
+  ...   tIds.append(p.insertTuple(tupleData=schema.pack(schema.instantiate(9, 20))))
+  ...   p.deleteTuple(tIds[2])
+  ...   p2 = Page.unpack(pId, p.pack())
+  >>> inst.pageCounters(pId)
+  {'tuplesInserted': 10, 'tuplesDeleted': 1, 'tuplesShifted': 7, 'bytesMoved': 56, 'pagePacks': 1, 'pageUnpacks': 1}
+
+  # Once disabled, the original methods are restored, and nothing is counted.
+  >>> inst.enabled(), hasattr(Page.insertTuple, '__wrapped__')
+  (False, False)
+  >>> _ = p.insertTuple(schema.pack(schema.instantiate(10, 20)))
+  >>> inst.totals()['tuplesInserted']
+  10
+
+  # Record classes count codec calls and time.
+  >>> with inst:
+  ...   data = warmup.Orders(1, 2, b'O', 1.5, b'1996-01-02', b'5-LOW', b'Clerk#1', 0, b'').pack()
+  ...   _ = warmup.Orders.unpack(data)
+  >>> stats = inst.recordCounters(warmup.Orders)
+  >>> stats['packs'], stats['unpacks'], stats['packSeconds'] > 0
+  (1, 1, True)
+  >>> sorted(inst.snapshot()['records'])
+  ['Lineitem', 'Orders']
+  """
+
+  def __init__(self):
+    self.pages     = {}
+    self.records   = {}
+    self.originals = {}
+
+  def enabled(self):
+    return bool(self.originals)
+
+  # Returns the counters of a page, creating them if needed.
+  def pageCounters(self, pageId):
+    counters = self.pages.get(pageId)
+    if counters is None:
+      counters = self.pages[pageId] = dict.fromkeys(pageCounterNames, 0)
+    return counters
+
+  # Returns the codec counters of a record class, creating them if needed.
+  def recordCounters(self, cls):
+    counters = self.records.get(cls)
+    if counters is None:
+      counters = self.records[cls] = dict.fromkeys(recordCounterNames, 0)
+    return counters
+
+  # Clears all counters. Record counters are zeroed in place, as enabled
+  # record classes hold on to them.
+  def reset(self):
+    self.pages.clear()
+    for counters in self.records.values():
+      counters.update(dict.fromkeys(recordCounterNames, 0))
+
+  # Replaces a method defined by 'cls' with 'makeWrapper(original)'.
+  def patch(self, cls, name, makeWrapper):
+    original = cls.__dict__[name]
+    if isinstance(original, classmethod):
+      wrapper = classmethod(makeWrapper(original.__func__))
+    else:
+      wrapper = makeWrapper(original)
+    self.originals[(cls, name)] = original
+    setattr(cls, name, wrapper)
+
+  # Enables instrumentation of the page classes, and of the given record
+  # classes, by default warmup.Lineitem and warmup.Orders.
+  def enable(self, recordClasses=None):
+    if self.enabled():
+      return
+    (Page, SlottedPage) = pageClasses()
+    counters = self.pageCounters
+
+    def counting(name, result=lambda r: 1):
+      def makeWrapper(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+          r = method(self, *args, **kwargs)
+          counters(self.pageId)[name] += result(r)
+          return r
+        return wrapper
+      return makeWrapper
+
+    # Deletes from a Page shift all later tuples towards the page header.
+    def shiftingDelete(method):
+      @functools.wraps(method)
+      def deleteTuple(self, tupleId):
+        numTuples = self.header.numTuples()
+        method(self, tupleId)
+        shifted   = numTuples - tupleId.tupleIndex - 1
+        c         = counters(self.pageId)
+        c['tuplesDeleted'] += 1
+        c['tuplesShifted'] += shifted
+        c['bytesMoved']    += shifted * self.header.tupleSize
+      return deleteTuple
+
+    def compactingVacuum(method):
+      @functools.wraps(method)
+      def vacuum(self):
+        slots = list(self.header.slots)
+        method(self)
+        moved = [new[1] for (old, new) in zip(slots, self.header.slots) if old != new]
+        c     = counters(self.pageId)
+        c['tuplesShifted'] += len(moved)
+        c['bytesMoved']    += sum(moved)
+      return vacuum
+
+    def unpackingWrap(method):
+      @functools.wraps(method)
+      def wrap(cls, pageId, frame):
+        page = method(cls, pageId, frame)
+        counters(pageId)['pageUnpacks'] += 1
+        return page
+      return wrap
+
+    self.patch(Page, 'insertTuple', counting('tuplesInserted'))
+    self.patch(Page, 'insertPackedTuples', counting('tuplesInserted', len))
+    self.patch(Page, 'deleteTuple', shiftingDelete)
+    self.patch(Page, 'packView', counting('pagePacks'))
+    self.patch(Page, 'wrap', unpackingWrap)
+    # Slotted pages insert packed tuples one at a time, through insertTuple.
+    self.patch(SlottedPage, 'insertTuple', counting('tuplesInserted'))
+    self.patch(SlottedPage, 'deleteTuple', counting('tuplesDeleted'))
+    self.patch(SlottedPage, 'vacuum', compactingVacuum)
+
+    for cls in (warmup.Lineitem, warmup.Orders) if recordClasses is None else recordClasses:
+      self.patchRecordClass(cls)
+
+  def patchRecordClass(self, cls):
+    counters = self.recordCounters(cls)
+    clock    = time.perf_counter
+
+    def timedPack(method):
+      @functools.wraps(method)
+      def pack(self):
+        start = clock()
+        data  = method(self)
+        counters['packSeconds'] += clock() - start
+        counters['packs']       += 1
+        return data
+      return pack
+
+    def timedUnpack(method):
+      @functools.wraps(method)
+      def unpack(cls, byts):
+        start  = clock()
+        record = method(cls, byts)
+        counters['unpackSeconds'] += clock() - start
+        counters['unpacks']       += 1
+        return record
+      return unpack
+
+    self.patch(cls, 'pack', timedPack)
+    self.patch(cls, 'unpack', timedUnpack)
+
+  # Restores the original methods.
+  def disable(self):
+    for ((cls, name), original) in reversed(list(self.originals.items())):
+      setattr(cls, name, original)
+    self.originals.clear()
+
+  def __enter__(self):
+    self.enable()
+    return self
+
+  def __exit__(self, *exc):
+    self.disable()
+
+  # Returns the page counters summed over all pages.
+  def totals(self):
+    totals = dict.fromkeys(pageCounterNames, 0)
+    for counters in self.pages.values():
+      for name in pageCounterNames:
+        totals[name] += counters[name]
+    totals['pages'] = len(self.pages)
+    return totals
+
+  # Returns a JSON-serializable copy of all counters. Per-page counters are
+  # keyed by the page id's representation, and only included with 'pages'.
+  def snapshot(self, pages=True):
+    snapshot = { 'totals'  : self.totals(),
+                 'records' : { cls.__name__: dict(c) for (cls, c) in self.records.items() } }
+    if pages:
+      snapshot['pages'] = { repr(pageId): dict(c) for (pageId, c) in self.pages.items() }
+    return snapshot
+
+# The global instrumentation.
+instrumentation = Instrumentation()
+
+
+class SamplingProfiler:
+  """
+  A statistical profiler, sampling the call stack of a thread at regular
+  intervals from a background thread.
+
+  Each sample records the stack of (file, function) frames of the profiled
+  thread, by default the one starting the profiler. The profiler only costs
+  anything while running. Samples are taken when the sampling thread holds
+  the interpreter lock, so the effective interval is at least the
+  interpreter's thread switch interval (sys.getswitchinterval()).
+
+  >>> def spin(n):
+  ...   return sum(i * i for i in range(n))
+  >>> with SamplingProfiler(interval=0.001) as profiler:
+  ...   _ = [spin(100000) for _ in range(20)]
+  >>> profiler.samples > 0
+  True
+  >>> snapshot = profiler.snapshot()
+  >>> any(stack.endswith(':spin;' + snapshot['functions'][0]['function'])
+  ...     for stack in snapshot['stacks'])
+  True
+  """
+
+  # Profiler constructor.
+  #
+  # interval     : the number of seconds between samples
+  # threadId     : the identifier of the profiled thread, by default the
+  #                thread calling 'start'
+  # maxDepth     : the number of innermost frames recorded per sample
+  def __init__(self, **kwargs):
+    self.interval = kwargs.get("interval", 0.005)
+    self.threadId = kwargs.get("threadId", None)
+    self.maxDepth = kwargs.get("maxDepth", 64)
+    self.stacks   = Counter()
+    self.samples  = 0
+    self.seconds  = 0.0
+    self.stopping = threading.Event()
+    self.sampler  = None
+
+  def start(self):
+    self.target = self.threadId or threading.get_ident()
+    self.stopping.clear()
+    self.started = time.perf_counter()
+    self.sampler = threading.Thread(target=self.run, daemon=True)
+    self.sampler.start()
+
+  def stop(self):
+    self.stopping.set()
+    self.sampler.join()
+    self.seconds += time.perf_counter() - self.started
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.stop()
+
+  def run(self):
+    while not self.stopping.wait(self.interval):
+      frame = sys._current_frames().get(self.target)
+      if frame is None:
+        continue
+      stack = []
+      while frame is not None and len(stack) < self.maxDepth:
+        code = frame.f_code
+        stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+      self.stacks[tuple(reversed(stack))] += 1
+      self.samples += 1
+
+  # Returns a JSON-serializable summary of the samples: for the 'top'
+  # functions with the most samples in the function itself, those samples
+  # and the samples in the function or its callees, and all stacks in the
+  # collapsed format of flame graph tools ('outer;inner' to a sample count).
+  def snapshot(self, top=25):
+    own   = Counter()
+    total = Counter()
+    for (stack, n) in self.stacks.items():
+      own[stack[-1]] += n
+      for function in set(stack):
+        total[function] += n
+    return { 'interval'  : self.interval,
+             'samples'   : self.samples,
+             'seconds'   : self.seconds,
+             'functions' : [{ 'function': f, 'self': n, 'total': total[f] }
+                              for (f, n) in own.most_common(top)],
+             'stacks'    : { ';'.join(stack): n for (stack, n) in self.stacks.items() } }
+
+# Writes a snapshot of the instrumentation, and optionally of a profiler, to
+# a JSON file.
+def exportJson(outPath, inst=instrumentation, profiler=None, pages=True):
+  snapshot = { 'timestamp'       : time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'instrumentation' : inst.snapshot(pages) }
+  if profiler is not None:
+    snapshot['profile'] = profiler.snapshot()
+  with open(outPath, 'w') as f:
+    json.dump(snapshot, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'HW1'))
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,220 @@
+import keyword, struct, sys
+from operator import itemgetter
+
+from warmup import Lineitem, Orders, columnFormats
+
+# Compact record classes, generated from a column list and a struct format.
+#
+# Records are tuple subclasses without a per-instance __dict__, so a record
+# costs one tuple of its values. Columns are read-only properties over the
+# tuple's items, as with namedtuple. The constructor converting raw fields
+# (e.g., CSV text) to column values, and the unpacking method stripping NUL
+# padding from text columns, are generated for each class as straight-line
+# code, avoiding per-column loops and dispatch.
+#
+# Low-cardinality columns, such as dates, flags and discounts, may be shared: each
+# distinct value of a shared column is then stored once per class, and
+# records hold references to it rather than their own copies. The values of
+# a shared column are kept for the lifetime of the class, so only columns
+# with a bounded number of distinct values should be shared.
+#
+# Generated classes provide the same class attributes as warmup.Lineitem and
+# warmup.Orders ('fmt', 'binrepr', 'fieldTypes', 'columns' and 'byteSize'),
+# so they can be used wherever those record classes are.
+
+recordClasses = {}
+
+# Returns the conversion from a raw field to a value of a format code's column.
+def codeType(code):
+  if code.endswith('s'):
+    return bytes
+  if code in 'efd':
+    return float
+  if code in '?':
+    return bool
+  return int
+
+# A dictionary mapping each value to its first occurrence.
+class SharedValues(dict):
+  def __missing__(self, value):
+    self[value] = value
+    return value
+
+def recordProperty(index, doc):
+  return property(itemgetter(index), doc=doc)
+
+# Generated methods take column names as parameters. Every other name in
+# the generated source starts with an underscore, which column names may not,
+# so columns never shadow them.
+recordSource = """
+def __new__(_cls, {args}):
+  return _tupleNew(_cls, ({converted},))
+
+def fromValues(_cls, _values):
+  ({values},) = _values
+  return _tupleNew(_cls, ({shared},))
+
+def unpack(_cls, _byts):
+  ({values},) = _unpackFields(_byts)
+  return _tupleNew(_cls, ({stripped},))
+"""
+
+# Class attributes of generated record classes, which columns may not replace.
+reservedNames = ('fmt', 'binrepr', 'fieldTypes', 'columns', 'byteSize', 'pack', 'unpack',
+                 'fromValues')
+
+# Returns a compact record class named 'name', with the given columns packed
+# by the struct format 'fmt', and sharing the values of the 'shared' columns.
+# Classes are cached by their arguments.
+def recordClass(name, columns, fmt, shared=()):
+  """
+  >>> Point = recordClass('Point', ('x', 'y', 'label'), 'ii4s', shared=('label',))
+  >>> p = Point('1', 2, b'ab')
+  >>> p, p.x, p.label
+  (Point(x=1, y=2, label=b'ab'), 1, b'ab')
+  >>> Point.unpack(p.pack()) == p, Point.byteSize()
+  (True, 12)
+  >>> Point.unpack(p.pack()).label is p.label
+  True
+  >>> Point.fromValues((3, 4, b'cd')).y
+  4
+  >>> p.x = 5
+  Traceback (most recent call last):
+  ...
+  AttributeError: property 'x' of 'Point' object has no setter
+  >>> recordClass('Point', ('x', 'y'), 'ii4s')
+  Traceback (most recent call last):
+  ...
+  ValueError: Format 'ii4s' has 3 fields for 2 columns
+
+  # Columns may share the names of builtins and of generated code parameters.
+  >>> Odd = recordClass('Odd', ('cls', 'int', 'bytes', 'float', 'tupleNew', 'unpackFields'),
+  ...                   'iiifi4s', shared=('bytes',))
+  >>> o = Odd('1', 2, 3, 4.5, 5, b'x')
+  >>> o.cls, o.int, o.float, o.unpackFields, Odd.unpack(o.pack()) == o, Odd(cls=1, int=2, bytes=3,
+  ...   float=4.5, tupleNew=5, unpackFields=b'x') == o
+  (1, 2, 4.5, b'x', True, True)
+
+  # Invalid, reserved and duplicate column names are rejected.
+  >>> recordClass('Bad', ('x', 'not valid'), 'ii')
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid column name: 'not valid'
+  >>> recordClass('Bad', ('x', 3), 'ii')
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid column name: 3
+  >>> recordClass('Bad', ('x', 'pack'), 'ii')
+  Traceback (most recent call last):
+  ...
+  ValueError: Reserved column name: 'pack'
+  >>> recordClass('Bad', ('x', 'x'), 'ii')
+  Traceback (most recent call last):
+  ...
+  ValueError: Duplicate column names in ('x', 'x')
+  """
+  columns = tuple(columns)
+  shared  = tuple(shared)
+  cached  = recordClasses.get((name, columns, fmt, shared))
+  if cached is not None:
+    return cached
+
+  codes = columnFormats(fmt)
+  if len(codes) != len(columns):
+    raise ValueError("Format '%s' has %d fields for %d columns" % (fmt, len(codes), len(columns)))
+  for column in columns:
+    if (not isinstance(column, str) or not column.isidentifier() or keyword.iskeyword(column)
+        or column.startswith('_')):
+      raise ValueError("Invalid column name: " + repr(column))
+    if column in reservedNames:
+      raise ValueError("Reserved column name: " + repr(column))
+  if len(set(columns)) != len(columns):
+    raise ValueError("Duplicate column names in " + repr(columns))
+  for column in shared:
+    if column not in columns:
+      raise ValueError("No such column: " + repr(column))
+
+  binrepr    = struct.Struct(fmt)
+  fieldTypes = tuple(codeType(code) for code in codes)
+  namespace  = { '_tupleNew': tuple.__new__, '_unpackFields': binrepr.unpack,
+                 '_int': int, '_float': float, '_bool': bool, '_bytes': bytes }
+
+  # Expressions producing each column's value from the given expressions.
+  def share(i, expr):
+    if columns[i] not in shared:
+      return expr
+    namespace.setdefault('_shared%d' % i, SharedValues())
+    return '_shared%d[%s]' % (i, expr)
+  def strip(i, expr):
+    return "%s.rstrip(b'\\x00')" % expr if fieldTypes[i] is bytes else expr
+
+  values = ['_v%d' % i for i in range(len(columns))]
+  source = recordSource.format(
+    args      = ', '.join(columns),
+    converted = ', '.join(share(i, '_%s(%s)' % (t.__name__, c))
+                            for i, (t, c) in enumerate(zip(fieldTypes, columns))),
+    values    = ', '.join(values),
+    shared    = ', '.join(share(i, v) for i, v in enumerate(values)),
+    stripped  = ', '.join(share(i, strip(i, v)) for i, v in enumerate(values)))
+  exec(source, namespace)
+
+  attrs = { name: recordProperty(i, "Column %d, '%s'" % (i, codes[i]))
+              for i, name in enumerate(columns) }
+  attrs.update({
+    '__slots__'      : (),
+    '__new__'        : namespace['__new__'],
+    '__repr__'       : lambda self: '%s(%s)' % (type(self).__name__,
+                         ', '.join('%s=%r' % nv for nv in zip(columns, self))),
+    '__getnewargs__' : lambda self: tuple(self),
+    '__module__'     : sys._getframe(1).f_globals.get('__name__', __name__),
+    'fmt'            : fmt,
+    'binrepr'        : binrepr,
+    'fieldTypes'     : fieldTypes,
+    'columns'        : columns,
+    'byteSize'       : classmethod(lambda cls: binrepr.size),
+    'pack'           : lambda self, pack=binrepr.pack: pack(*self),
+    'unpack'         : classmethod(namespace['unpack']),
+    # Builds a record from converted column values, e.g., as produced by
+    # warmup.streamCsvFile or struct iter_unpack.
+    'fromValues'     : classmethod(namespace['fromValues']),
+  })
+  cls = type(name, (tuple,), attrs)
+  recordClasses[(name, columns, fmt, shared)] = cls
+  return cls
+
+# Compact counterparts of warmup.Lineitem and warmup.Orders.
+# Their DATE columns, and columns with a handful of distinct values, are shared.
+CompactLineitem = recordClass('CompactLineitem', Lineitem.columns, Lineitem.fmt,
+                              shared=("l_quantity", "l_discount", "l_tax", "l_shipdate",
+                                      "l_commitdate", "l_receiptdate", "l_shipinstruct",
+                                      "l_shipmode"))
+CompactOrders   = recordClass('CompactOrders', Orders.columns, Orders.fmt,
+                              shared=("o_orderdate", "o_orderpriority"))
+
+# Returns the average number of bytes allocated per record when unpacking
+# 'cls' records from the given packed records, and the records themselves.
+def rowFootprint(cls, packed):
+  """
+  >>> import tpchgen
+  >>> rows   = [l for (_, ls) in tpchgen.generateOrders(0.001) for l in ls]
+  >>> packed = [Lineitem.binrepr.pack(*row) for row in rows]
+  >>> (compact, records) = rowFootprint(CompactLineitem, packed)
+  >>> (plain, _)         = rowFootprint(Lineitem, packed)
+  >>> records[0].pack() == packed[0]
+  True
+  >>> compact < 0.7 * plain
+  True
+  """
+  import tracemalloc
+  tracemalloc.start()
+  try:
+    before  = tracemalloc.get_traced_memory()[0]
+    records = [cls.unpack(record) for record in packed]
+    after   = tracemalloc.get_traced_memory()[0]
+  finally:
+    tracemalloc.stop()
+  return ((after - before) / len(packed) if packed else 0, records)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,177 @@
+import datetime, random
+
+from warmup import ioBufferSize
+
+# A synthetic generator for the TPC-H orders and lineitem tables.
+#
+# Rows follow the value distributions and correlations of the TPC-H
+# specification closely enough for storage benchmarks: sparse order keys,
+# 1 to 7 lineitems per order, dates derived from the order date, flags and
+# order status derived from the current date, and prices derived from part
+# keys. Text comments are random slices of a fixed pool of words, much like
+# dbgen's text pool. Generation is deterministic for a given seed.
+#
+# Generated rows are tuples of converted column values, as produced by
+# 'warmup.streamCsvFile', so they can be packed directly by a record class'
+# 'binrepr'. CSV files use dbgen's '|'-terminated format.
+
+ordersPerScale    = 1500000
+customersPerScale = 150000
+partsPerScale     = 200000
+suppliersPerScale = 10000
+clerksPerScale    = 1000
+
+startDate   = datetime.date(1992, 1, 1)
+endDate     = datetime.date(1998, 12, 31)
+currentDate = datetime.date(1995, 6, 17)
+
+priorities    = (b"1-URGENT", b"2-HIGH", b"3-MEDIUM", b"4-NOT SPECIFIED", b"5-LOW")
+instructions  = (b"DELIVER IN PERSON", b"COLLECT COD", b"NONE", b"TAKE BACK RETURN")
+modes         = (b"REG AIR", b"AIR", b"RAIL", b"SHIP", b"TRUCK", b"MAIL", b"FOB")
+commentWords  = (b"furiously", b"carefully", b"blithely", b"quickly", b"slyly", b"fluffily",
+                 b"regular", b"final", b"express", b"pending", b"ironic", b"special", b"bold",
+                 b"even", b"silent", b"unusual", b"accounts", b"deposits", b"packages",
+                 b"requests", b"instructions", b"foxes", b"ideas", b"theodolites", b"pinto",
+                 b"beans", b"dependencies", b"platelets", b"asymptotes", b"courts", b"dolphins",
+                 b"sleep", b"wake", b"are", b"haggle", b"nag", b"use", b"boost", b"affix",
+                 b"detect", b"integrate", b"cajole", b"among", b"above", b"along", b"across",
+                 b"about", b"after", b"against", b"the")
+textPoolSize  = 1 << 20
+
+# Dates as the number of days since 'startDate', and their text form.
+orderDays    = (endDate - startDate).days - 151
+currentDays  = (currentDate - startDate).days
+dateText     = [(startDate + datetime.timedelta(days)).isoformat().encode()
+                  for days in range(orderDays + 152)]
+
+# Returns the i-th order key. As in dbgen, only the first 8 of every 32 keys
+# are used, leaving gaps for inserts.
+def orderKey(i):
+  return ((i >> 3) << 5) | (i & 7)
+
+# Returns the retail price of a part, as defined by the specification.
+def retailPrice(partKey):
+  return (90000 + ((partKey // 10) % 20001) + 100 * (partKey % 1000)) / 100
+
+# Returns a text pool of random words, from which comments are sliced.
+def textPool(rnd, size=textPoolSize):
+  words = []
+  total = 0
+  while total < size:
+    word   = rnd.choice(commentWords)
+    words.append(word)
+    total += len(word) + 1
+  return b' '.join(words)[:size]
+
+# Yields (order, lineitems) pairs for the given scale factor, where 'order'
+# is an orders row, and 'lineitems' is the list of the order's lineitem rows.
+def generateOrders(scaleFactor, seed=0):
+  """
+  >>> orders = list(generateOrders(0.0001))
+  >>> len(orders), [o[0] for (o, _) in orders[6:10]]
+  (150, [7, 32, 33, 34])
+  >>> all(1 <= len(ls) <= 7 and all(l[0] == o[0] for l in ls) for (o, ls) in orders)
+  True
+  >>> all(o[2] in (b'F', b'O', b'P') and o[1] % 3 != 0 for (o, _) in orders)
+  True
+  >>> all(l[12] > l[10] > o[4] and l[11] > o[4] for (o, ls) in orders for l in ls)
+  True
+  >>> orders == list(generateOrders(0.0001))
+  True
+  """
+  rnd          = random.Random(seed)
+  randint      = rnd.randint
+  pool         = textPool(rnd)
+  numOrders    = max(1, int(ordersPerScale * scaleFactor))
+  numCustomers = max(3, int(customersPerScale * scaleFactor))
+  numParts     = max(1, int(partsPerScale * scaleFactor))
+  numSuppliers = max(1, int(suppliersPerScale * scaleFactor))
+  numClerks    = max(1, int(clerksPerScale * scaleFactor))
+
+  def comment(lo, hi):
+    length = randint(lo, hi)
+    offset = randint(0, len(pool) - length)
+    return pool[offset: offset + length]
+
+  for i in range(1, numOrders + 1):
+    key       = orderKey(i)
+    custKey   = randint(1, numCustomers)
+    while custKey % 3 == 0:
+      custKey = randint(1, numCustomers)
+    orderDay  = randint(0, orderDays)
+    lineitems = []
+    total     = 0.0
+    shipped   = 0
+    for lineNumber in range(1, randint(1, 7) + 1):
+      partKey    = randint(1, numParts)
+      quantity   = randint(1, 50)
+      price      = round(quantity * retailPrice(partKey), 2)
+      discount   = randint(0, 10) / 100
+      tax        = randint(0, 8) / 100
+      shipDay    = orderDay + randint(1, 121)
+      commitDay  = orderDay + randint(30, 90)
+      receiptDay = shipDay + randint(1, 30)
+      if receiptDay <= currentDays:
+        returnFlag = b'R' if randint(0, 1) else b'A'
+      else:
+        returnFlag = b'N'
+      lineStatus = b'O' if shipDay > currentDays else b'F'
+      shipped   += lineStatus == b'F'
+      total     += price * (1 + tax) * (1 - discount)
+      lineitems.append((key, partKey, randint(1, numSuppliers), lineNumber,
+                        float(quantity), price, discount, tax, returnFlag, lineStatus,
+                        dateText[shipDay], dateText[commitDay], dateText[receiptDay],
+                        rnd.choice(instructions), rnd.choice(modes), comment(10, 43)))
+
+    if shipped == len(lineitems):
+      status = b'F'
+    elif shipped == 0:
+      status = b'O'
+    else:
+      status = b'P'
+    order = (key, custKey, status, round(total, 2), dateText[orderDay],
+             rnd.choice(priorities), b"Clerk#%09d" % randint(1, numClerks), 0,
+             comment(19, 78))
+    yield (order, lineitems)
+
+# Formats a row of column values as a '|'-delimited CSV line.
+def formatRow(row):
+  return b'|'.join(b'%.2f' % v if isinstance(v, float) else
+                   b'%d' % v if isinstance(v, int) else v for v in row) + b'|\n'
+
+# Writes the orders and lineitem tables for the given scale factor as CSV
+# files, readable by 'warmup.streamCsvFile' and 'warmup.bulkLoadCsv'.
+# Returns the number of orders and lineitem rows written.
+def writeTables(scaleFactor, ordersPath, lineitemPath, seed=0):
+  """
+  >>> import os, tempfile, warmup
+  >>> workDir = tempfile.mkdtemp()
+  >>> (ordersPath, lineitemPath) = (os.path.join(workDir, 'orders.csv'), os.path.join(workDir, 'lineitem.csv'))
+  >>> writeTables(0.0001, ordersPath, lineitemPath)
+  (150, 603)
+  >>> next(warmup.streamCsvFile(ordersPath, warmup.Orders))[:4]
+  (1, 4, b'O', 43400.08)
+  >>> warmup.bulkLoadCsv(lineitemPath, os.path.join(workDir, 'lineitem.bin'), warmup.Lineitem).rows
+  603
+  """
+  numOrders    = 0
+  numLineitems = 0
+  with open(ordersPath, 'wb', buffering=ioBufferSize) as orders, \
+       open(lineitemPath, 'wb', buffering=ioBufferSize) as lineitem:
+    for (order, lineitems) in generateOrders(scaleFactor, seed):
+      orders.write(formatRow(order))
+      lineitem.write(b''.join(formatRow(row) for row in lineitems))
+      numOrders    += 1
+      numLineitems += len(lineitems)
+  return (numOrders, numLineitems)
+
+
+if __name__ == "__main__":
+  import sys
+  if len(sys.argv) == 4:
+    print(writeTables(float(sys.argv[1]), sys.argv[2], sys.argv[3]))
+  elif len(sys.argv) == 1:
+    import doctest
+    doctest.testmod()
+  else:
+    sys.exit("usage: tpchgen.py <scaleFactor> <orders.csv> <lineitem.csv>")
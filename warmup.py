@@ -1,4 +1,11 @@
-import struct
+import mmap, struct, time
+
+from HW1.structformat import columnFormats, formatLayout, parseCsvLine
+
+# Number of rows packed into a single batch buffer by the bulk loader, and the
+# size of the buffered file I/O used for CSV and binary files.
+batchRows    = 8192
+ioBufferSize = 1 << 20
 
 # Construct objects w/ fields corresponding to columns.
 # Store fields using the appropriate representation:
@@ -10,6 +17,13 @@ import struct
 class Lineitem(object):
   # The format string, for use with the struct module.
   fmt = "4I4fss10s10s10s25s10s44s"
+  binrepr = struct.Struct(fmt)
+  # Conversions from raw CSV fields, in column order.
+  fieldTypes = (int,) * 4 + (float,) * 4 + (bytes,) * 8
+  columns = ("l_orderkey", "l_partkey", "l_suppkey", "l_linenumber",
+             "l_quantity", "l_extendedprice", "l_discount", "l_tax",
+             "l_returnflag", "l_linestatus", "l_shipdate", "l_commitdate",
+             "l_receiptdate", "l_shipinstruct", "l_shipmode", "l_comment")
   # Initialize the columns in Lineitem with proper representation.
   l_orderkey = int
   l_partkey = int
@@ -77,6 +91,12 @@ class Lineitem(object):
 class Orders(object):
   # The format string, for use with the struct module.
   fmt = "2Isf10s15s15sI79s"
+  binrepr = struct.Struct(fmt)
+  # Conversions from raw CSV fields, in column order.
+  fieldTypes = (int, int, bytes, float, bytes, bytes, bytes, int, bytes)
+  columns = ("o_orderkey", "o_custkey", "o_orderstatus", "o_totalprice",
+             "o_orderdate", "o_orderpriority", "o_clerk", "o_shippriority",
+             "o_comment")
 
   # Initialize the columns 
   o_orderkey = int
@@ -137,12 +157,341 @@ def readCsvFile(inPath, cls, delim='|'):
       lst.append(cls(*fields))
   return lst
 
+# Stream the CSV file as tuples of converted column values, one row at a time.
+# The file is read in binary mode, so that text columns are produced directly
+# as bytes, ready to be packed by 'cls.binrepr'. Blank lines are skipped.
+def streamCsvFile(inPath, cls, delim='|'):
+  sep   = delim.encode()
+  casts = cls.fieldTypes
+  with open(inPath, 'rb', buffering=ioBufferSize) as f:
+    for line in f:
+      values = parseCsvLine(line, sep, casts)
+      if values is not None:
+        yield values
+
+# Pack a stream of value tuples into batches of at most 'batchSize' rows.
+# Yields memoryviews over a single reusable buffer, so each batch must be
+# consumed (e.g., written out) before the next one is requested.
+def packBatches(rows, cls, batchSize=batchRows):
+  """
+  >>> rows    = [(i, i, b'O', 1.5, b'1996-01-02', b'5-LOW', b'Clerk', 0, b'') for i in range(5)]
+  >>> batches = [bytes(b) for b in packBatches(rows, Orders, batchSize=2)]
+  >>> [len(b) // Orders.byteSize() for b in batches]
+  [2, 2, 1]
+  >>> [Orders.binrepr.unpack_from(b)[0] for b in batches]
+  [0, 2, 4]
+  >>> [len(b) for b in packBatches(rows[:4], Orders, batchSize=2)] == [2 * Orders.byteSize()] * 2
+  True
+  >>> list(packBatches([], Orders))
+  []
+  """
+  packInto = cls.binrepr.pack_into
+  rowSize  = cls.binrepr.size
+  buf      = bytearray(rowSize * batchSize)
+  view     = memoryview(buf)
+  offset   = 0
+  for row in rows:
+    packInto(buf, offset, *row)
+    offset += rowSize
+    if offset == len(buf):
+      yield view
+      offset = 0
+  if offset:
+    yield view[:offset]
+
+# Statistics reported by the bulk loader.
+class LoadStats(object):
+  """
+  >>> LoadStats(1000, 64000, 0.5)
+  LoadStats(rows=1000, bytes=64000, seconds=0.500, rowsPerSec=2000)
+  >>> LoadStats(10, 640, 0.0).rowsPerSec()
+  inf
+  """
+
+  def __init__(self, rows, byts, seconds):
+    self.rows    = rows
+    self.bytes   = byts
+    self.seconds = seconds
+
+  def rowsPerSec(self):
+    return self.rows / self.seconds if self.seconds > 0 else float('inf')
+
+  def __repr__(self):
+    return "LoadStats(rows=%d, bytes=%d, seconds=%.3f, rowsPerSec=%.0f)" \
+             % (self.rows, self.bytes, self.seconds, self.rowsPerSec())
+
+# Write packed batches to the output file, returning the number of bytes written.
+def writeBatches(outPath, batches):
+  written = 0
+  with open(outPath, 'wb', buffering=ioBufferSize) as f:
+    for batch in batches:
+      f.write(batch)
+      written += len(batch)
+  return written
+
+# Convert a CSV file into its packed binary form in constant memory.
+# Returns a LoadStats object describing the load.
+def bulkLoadCsv(inPath, outPath, cls, delim='|', batchSize=batchRows):
+  """
+  >>> import os, tempfile
+  >>> d = tempfile.mkdtemp()
+  >>> with open(os.path.join(d, 'orders.csv'), 'w') as f:
+  ...   _ = f.write('1|370|O|172799.49|1996-01-02|5-LOW|Clerk#000000951|0|sleep furiously|\\n'
+  ...               '2|781|O|38426.09|1996-12-01|1-URGENT|Clerk#000000880|0|foxes|\\n'
+  ...               '3|1234|F|205654.30|1993-10-14|5-LOW|Clerk#000000955|0|deposits|\\n'
+  ...               '\\n')
+
+  # CSV rows are streamed as converted column values.
+  >>> next(streamCsvFile(os.path.join(d, 'orders.csv'), Orders))
+  (1, 370, b'O', 172799.49, b'1996-01-02', b'5-LOW', b'Clerk#000000951', 0, b'sleep furiously')
+
+  # Loading packs every row, whatever the batch size, skipping blank lines.
+  >>> stats = bulkLoadCsv(os.path.join(d, 'orders.csv'), os.path.join(d, 'orders.bin'), Orders,
+  ...                     batchSize=2)
+  >>> stats.rows, stats.bytes == 3 * Orders.byteSize()
+  (3, True)
+
+  # Streaming the binary file returns the packed values, with padded text.
+  >>> rows = list(streamBinaryFile(os.path.join(d, 'orders.bin'), Orders, batchSize=2))
+  >>> [r[0] for r in rows], rows[1][5]
+  ([1, 2, 3], b'1-URGENT\\x00\\x00\\x00\\x00\\x00\\x00\\x00')
+
+  # Reading the binary file constructs record objects without the padding.
+  >>> orders = readBinaryFile(os.path.join(d, 'orders.bin'), Orders)
+  >>> [(o.o_orderkey, o.o_orderpriority, o.o_totalprice) for o in orders]
+  [(1, b'5-LOW', 172799.484375), (2, b'1-URGENT', 38426.08984375), (3, b'5-LOW', 205654.296875)]
+  >>> writeBinaryFile(os.path.join(d, 'copy.bin'), orders)
+  >>> open(os.path.join(d, 'copy.bin'), 'rb').read() == open(os.path.join(d, 'orders.bin'), 'rb').read()
+  True
+  """
+  start   = time.perf_counter()
+  written = writeBatches(outPath, packBatches(streamCsvFile(inPath, cls, delim), cls, batchSize))
+  return LoadStats(written // cls.byteSize(), written, time.perf_counter() - start)
+
 # Write the list of objects to the file in packed form.
 # Each object provides a 'pack' method for conversion to bytes.
 def writeBinaryFile(outPath, lst):
-  raise NotImplementedError()
+  with open(outPath, 'wb', buffering=ioBufferSize) as f:
+    for obj in lst:
+      f.write(obj.pack())
+
+# Stream the binary file as tuples of unpacked column values.
+# The file is read in chunks of 'batchSize' rows, and decoded with iter_unpack.
+def streamBinaryFile(inPath, cls, batchSize=batchRows):
+  rowSize   = cls.byteSize()
+  chunkSize = rowSize * batchSize
+  with open(inPath, 'rb', buffering=ioBufferSize) as f:
+    while True:
+      chunk = f.read(chunkSize)
+      if not chunk:
+        break
+      # Drop any trailing partial record.
+      usable = len(chunk) - len(chunk) % rowSize
+      yield from cls.binrepr.iter_unpack(memoryview(chunk)[:usable])
 
 # Read the binary file, and return a list of 'cls' objects.
 # 'cls' provicdes 'byteSize' and 'unpack' methods for reading and conversion.
 def readBinaryFile(inPath, cls):
-  raise NotImplementedError()
+  return [cls(*[v.rstrip(b'\x00') if isinstance(v, bytes) else v for v in row])
+            for row in streamBinaryFile(inPath, cls)]
+
+# Return a list of (column, format code, byte offset) triples for 'cls'.
+def columnLayout(cls):
+  """
+  >>> columnLayout(Orders)[:5]
+  [('o_orderkey', 'I', 0), ('o_custkey', 'I', 4), ('o_orderstatus', 's', 8), ('o_totalprice', 'f', 12), ('o_orderdate', '10s', 16)]
+  >>> [code for _, code, _ in columnLayout(Orders)] == columnFormats(Orders.fmt)
+  True
+  >>> columnLayout(Orders)[-2:]
+  [('o_shippriority', 'I', 56), ('o_comment', '79s', 60)]
+  """
+  return formatLayout(cls.fmt, cls.columns)
+
+# Build a struct that decodes only the given columns of a 'cls' record,
+# skipping over all other bytes with pad bytes.
+def projectionStruct(cls, names):
+  """
+  >>> o = Orders(7, 8, b'F', 2.5, b'1995-03-01', b'1-URGENT', b'Clerk', 1, b'hi')
+  >>> s = projectionStruct(Orders, ['o_orderkey', 'o_totalprice', 'o_comment'])
+  >>> s.size == Orders.byteSize(), s.unpack(o.pack())[:2]
+  (True, (7, 2.5))
+  >>> projectionStruct(Orders, ['o_totalprice', 'o_orderkey'])
+  Traceback (most recent call last):
+  ...
+  ValueError: Projected columns must be given in record order
+  """
+  offsets = {name: (code, offset) for name, code, offset in columnLayout(cls)}
+  fmt     = '='
+  pos     = 0
+  for name in names:
+    code, offset = offsets[name]
+    if offset < pos:
+      raise ValueError("Projected columns must be given in record order")
+    fmt += '%dx%s' % (offset - pos, code)
+    pos  = offset + struct.calcsize('=' + code)
+  fmt += '%dx' % (cls.byteSize() - pos)
+  return struct.Struct(fmt)
+
+class RecordView(object):
+  """
+  A lightweight, read-only view of a single packed record.
+
+  A record view holds only a reference to a backing buffer and the offset of
+  the record within it. Each column is decoded from the buffer when it is
+  read, so accessing a few columns of a wide record costs only those
+  conversions. Text columns are returned without their NUL padding.
+
+  Concrete view classes are generated per record class by 'viewClass'.
+  """
+  __slots__ = ('buffer', 'offset')
+  recordClass = None
+
+  def __init__(self, buffer, offset):
+    self.buffer = buffer
+    self.offset = offset
+
+  # Returns the raw packed bytes of this record.
+  def tobytes(self):
+    return bytes(self.buffer[self.offset: self.offset + self.recordClass.byteSize()])
+
+  # Decode every column and construct a full record object.
+  def materialize(self):
+    return self.recordClass(*[getattr(self, name) for name in self.recordClass.columns])
+
+  def __repr__(self):
+    return "%s(offset=%d)" % (type(self).__name__, self.offset)
+
+# Returns a column accessor decoding a single field at a fixed record offset.
+def columnProperty(code, offset):
+  unpack = struct.Struct(code).unpack_from
+  if code.endswith('s'):
+    return property(lambda self: unpack(self.buffer, self.offset + offset)[0].rstrip(b'\x00'))
+  return property(lambda self: unpack(self.buffer, self.offset + offset)[0])
+
+viewClasses = {}
+
+# Returns the RecordView subclass for the record class 'cls'.
+def viewClass(cls):
+  view = viewClasses.get(cls)
+  if view is None:
+    attrs = {name: columnProperty(code, offset) for name, code, offset in columnLayout(cls)}
+    attrs['__slots__']   = ()
+    attrs['recordClass'] = cls
+    view = type(cls.__name__ + 'View', (RecordView,), attrs)
+    viewClasses[cls] = view
+  return view
+
+class MappedBinaryFile(object):
+  """
+  A read-only, memory-mapped binary file of packed 'cls' records.
+
+  Records are not decoded when the file is opened. Indexing and iteration
+  return RecordView objects pointing directly into the mapped file, while
+  'scan' decodes only the requested columns of each record. Any trailing
+  partial record is ignored.
+
+  Mapped files should be closed once all views over them are released, for
+  example by using the file as a context manager.
+
+  Views and scans agree on column values: text columns are returned without
+  their NUL padding by both.
+
+  >>> import os, tempfile
+  >>> path = os.path.join(tempfile.mkdtemp(), 'orders.bin')
+  >>> rows = [(i, 10 * i, b'O', i / 2, b'1996-01-02', b'5-LOW', b'Clerk#%d' % i, 0, b'')
+  ...           for i in range(4)]
+  >>> writeBatches(path, packBatches(rows, Orders)) // Orders.byteSize()
+  4
+
+  >>> with mapBinaryFile(path, Orders) as f:
+  ...   view = f[-1]
+  ...   (len(f), type(view).__name__, view.o_custkey, view.o_clerk, view.tobytes() == f[3].tobytes(),
+  ...    view.materialize().o_orderpriority)
+  ...   del view
+  (4, 'OrdersView', 30, b'Clerk#3', True, b'5-LOW')
+
+  >>> with mapBinaryFile(path, Orders) as f:
+  ...   scanned = list(f.scan('o_orderkey', 'o_orderpriority', 'o_clerk'))
+  ...   viewed  = [(v.o_orderkey, v.o_orderpriority, v.o_clerk) for v in f]
+  >>> scanned == viewed, scanned[2]
+  (True, (2, b'5-LOW', b'Clerk#2'))
+
+  >>> with mapBinaryFile(path, Orders) as f:
+  ...   f[4]
+  Traceback (most recent call last):
+  ...
+  IndexError: Record index out of range
+  """
+
+  def __init__(self, inPath, cls):
+    self.cls      = cls
+    self.rowSize  = cls.byteSize()
+    self.viewType = viewClass(cls)
+    with open(inPath, 'rb') as f:
+      size = f.seek(0, 2)
+      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+    self.numRecords = size // self.rowSize
+    self.buffer     = memoryview(self.map) if self.map else memoryview(b'')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self):
+    self.buffer.release()
+    if self.map:
+      self.map.close()
+      self.map = None
+
+  def __len__(self):
+    return self.numRecords
+
+  def __getitem__(self, index):
+    if index < 0:
+      index += self.numRecords
+    if not 0 <= index < self.numRecords:
+      raise IndexError("Record index out of range")
+    return self.viewType(self.buffer, index * self.rowSize)
+
+  def __iter__(self):
+    view = self.viewType
+    buf  = self.buffer
+    for offset in range(0, self.numRecords * self.rowSize, self.rowSize):
+      yield view(buf, offset)
+
+  # Yields tuples holding only the named columns of each record, in record order.
+  # Text columns are returned without their NUL padding, as by record views.
+  def scan(self, *names):
+    codes  = {name: code for name, code, _ in columnLayout(self.cls)}
+    text   = tuple(codes[name].endswith('s') for name in names)
+    usable = self.buffer[:self.numRecords * self.rowSize]
+    try:
+      if any(text):
+        yield from self.stripped(projectionStruct(self.cls, names).iter_unpack(usable), text)
+      else:
+        yield from projectionStruct(self.cls, names).iter_unpack(usable)
+    finally:
+      usable.release()
+
+  # Strips the NUL padding of the text columns of projected rows.
+  @staticmethod
+  def stripped(rows, text):
+    for row in rows:
+      yield tuple(v.rstrip(b'\x00') if isText else v for (isText, v) in zip(text, row))
+
+# Memory-map a binary file of packed 'cls' records for lazy, zero-copy access.
+def mapBinaryFile(inPath, cls):
+  return MappedBinaryFile(inPath, cls)
+
+if __name__ == "__main__":
+  import sys
+  if len(sys.argv) > 1:
+    if len(sys.argv) != 4 or sys.argv[1] not in ('lineitem', 'orders'):
+      sys.exit("usage: warmup.py (lineitem|orders) <input.csv> <output.bin>")
+    cls = Lineitem if sys.argv[1] == 'lineitem' else Orders
+    print(bulkLoadCsv(sys.argv[2], sys.argv[3], cls))
+  else:
+    import doctest
+    doctest.testmod()